@@ -0,0 +1,76 @@
+import numpy as np
+
+import src.configuration as C
+import src.transforms as transforms
+import src.utils as utils
+
+from fastprogress import progress_bar
+from joblib import delayed, Parallel
+
+from src.storage import VariantBankWriter, read_audio
+
+
+def get_transform_config(config: dict, name: str):
+    for trns_conf in config["transforms"]["train"]:
+        if trns_conf["name"] == name:
+            return trns_conf
+    raise ValueError(f"{name} is not in the train transforms of the config")
+
+
+def compute_variants(transform, datadir, ebird_code: str, wav_name: str, variants: list):
+    y, _ = read_audio(datadir, ebird_code, wav_name)
+    y = y.astype(np.float32)
+    return len(y), [transform.apply_variant(y, variant).astype(np.float32) for variant in variants]
+
+
+if __name__ == "__main__":
+    parser = utils.get_parser()
+    parser.add_argument("--output", required=True, help="bank directory (`bank_dir` of StoredVariants)")
+    parser.add_argument("--transform", default="PitchShift", help="name of a transform of `transforms.train`")
+    parser.add_argument("--n_variants", default=None, type=int,
+                        help="variants per recording, by default all the shifts of PitchShift or 8 rates")
+    parser.add_argument("--max_gb", default=None, type=float, help="size budget of the bank")
+    parser.add_argument("--n_jobs", default=8, type=int)
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    df, datadir = C.get_metadata(config)
+
+    trns_conf = get_transform_config(config, args.transform)
+    transform = getattr(transforms, trns_conf["name"])(**(trns_conf.get("params") or {}))
+    if args.n_variants is None:
+        variants = transform.get_variants()
+    else:
+        variants = transform.get_variants(args.n_variants)
+    max_bytes = None if args.max_gb is None else int(args.max_gb * 2 ** 30)
+
+    codes = df["ebird_code"].values.astype(str)
+    wav_names = df["resampled_filename"].values.astype(str)
+    print(f"{args.transform} variants: {variants}, recordings: {len(df)}")
+
+    # recordings are processed in order until the budget is reached, the
+    # rest is computed online by StoredVariants
+    n_written = 0
+    block_size = 4 * args.n_jobs
+    with VariantBankWriter(args.output, trns_conf, variants, max_bytes) as writer:
+        for begin in progress_bar(range(0, len(df), block_size)):
+            block = list(zip(codes[begin:begin + block_size], wav_names[begin:begin + block_size]))
+            results = Parallel(n_jobs=args.n_jobs)(
+                delayed(compute_variants)(transform, datadir, ebird_code, wav_name, variants)
+                for ebird_code, wav_name in block)
+            full = False
+            for (ebird_code, wav_name), (source_length, augmented) in zip(block, results):
+                for variant, y in zip(variants, augmented):
+                    if not writer.append(ebird_code, wav_name, variant, y, source_length):
+                        full = True
+                        break
+                    n_written += 1
+                if full:
+                    break
+            if full:
+                print("size budget reached")
+                break
+
+    print(f"{n_written} / {len(df) * len(variants)} variants, {writer.n_bytes / 2 ** 30:.2f} GiB")
+    print(f"Replace {args.transform} with StoredVariants (bank_dir: {args.output}) as the first of transforms.train, "
+          "the transforms before it would be discarded")
@@ -0,0 +1,65 @@
+"""
+Wall time of a soft label inference loop writing with `SoftLabelNpyWriter`
+synchronously against `AsyncSoftLabelWriter`, with a simulated per file
+latency of the storage (e.g. network filesystems) and a simulated forward
+pass per recording.
+
+    python benchmarks/async_writer.py --n_files 200 --latency 0.01 --compute 0.01
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.storage import AsyncSoftLabelWriter, SoftLabelNpyWriter  # noqa
+
+
+class SlowNpyWriter(SoftLabelNpyWriter):
+    def __init__(self, root: Path, latency: float):
+        super().__init__(root)
+        self.latency = latency
+
+    def append(self, wav_name: str, soft_label: np.ndarray):
+        time.sleep(self.latency)
+        super().append(wav_name, soft_label)
+
+
+def inference_loop(writer, n_files: int, n_segments: int, compute: float):
+    rng = np.random.RandomState(1213)
+    t0 = time.time()
+    for i in range(n_files):
+        # stand-in for the forward pass of a recording (sleeping releases
+        # the GIL as torch operators do)
+        time.sleep(compute)
+        writer.append(f"XC{i}.wav", rng.rand(n_segments, 264).astype(np.float32))
+    writer.close()
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_files", default=200, type=int)
+    parser.add_argument("--n_segments", default=1000, type=int)
+    parser.add_argument("--latency", default=0.01, type=float)
+    parser.add_argument("--compute", default=0.01, type=float)
+    parser.add_argument("--n_threads", nargs="+", default=[1, 4], type=int)
+    parser.add_argument("--max_queue", default=16, type=int)
+    args = parser.parse_args()
+
+    print(f"files: {args.n_files}, segments: {args.n_segments}, "
+          f"storage latency: {args.latency} s, compute: {args.compute} s per file")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        elapsed = inference_loop(SlowNpyWriter(Path(tmpdir), args.latency),
+                                 args.n_files, args.n_segments, args.compute)
+        print(f"synchronous         : {elapsed:.2f} s")
+        for n_threads in args.n_threads:
+            writer = AsyncSoftLabelWriter(lambda i: SlowNpyWriter(Path(tmpdir), args.latency),
+                                          n_threads, args.max_queue)
+            elapsed = inference_loop(writer, args.n_files, args.n_segments, args.compute)
+            print(f"async, {n_threads} thread(s)  : {elapsed:.2f} s ({writer.summary()})")
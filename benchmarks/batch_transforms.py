@@ -0,0 +1,75 @@
+"""
+Time of the waveform augmentations of the configs (NoiseInjection,
+RandomVolume, CosineVolume, Normalize) applied per sample with numpy, as
+in the DataLoader workers, against the batched transforms applied to the
+(batch_size, n_samples) float32 tensor in the training loop, with the
+distribution of the RMS of the outputs of both.
+
+    python benchmarks/batch_transforms.py --batch_size 32 --seconds 20
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import src.transforms as transforms  # noqa
+
+
+TRANSFORMS = [
+    {"name": "NoiseInjection", "params": {"max_noise_level": 0.04, "noise_bank": False}},
+    {"name": "RandomVolume", "params": {"limit": 4}},
+    {"name": "CosineVolume", "params": {"limit": 4}},
+    {"name": "Normalize"}
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--seconds", default=20, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    parser.add_argument("--n_batches", default=5, type=int)
+    args = parser.parse_args()
+
+    np.random.seed(1213)
+    torch.manual_seed(1213)
+    config = {
+        "transforms": {"train": TRANSFORMS},
+        # noise_bank is a parameter of the per sample transform only
+        "batch_transforms": {"train": [
+            {"name": conf["name"], "params": {k: v for k, v in conf.get("params", {}).items() if k != "noise_bank"}}
+            for conf in TRANSFORMS
+        ]}
+    }
+    per_sample = transforms.get_waveform_transforms(config, "train")
+    batched = transforms.get_batch_transforms(config, "train")
+
+    batch = 0.1 * np.random.randn(args.batch_size, args.sr * args.seconds).astype(np.float32)
+    rms = {"per sample": [], "batched": []}
+
+    t0 = time.time()
+    for _ in range(args.n_batches):
+        outputs = np.stack([per_sample(y) for y in batch]).astype(np.float32)
+        rms["per sample"].append(np.sqrt((outputs ** 2).mean(axis=1)))
+    per_sample_time = (time.time() - t0) / args.n_batches
+
+    x = torch.from_numpy(batch)
+    t0 = time.time()
+    for _ in range(args.n_batches):
+        with torch.no_grad():
+            outputs = batched(x)
+        rms["batched"].append(np.sqrt((outputs.numpy() ** 2).mean(axis=1)))
+    batched_time = (time.time() - t0) / args.n_batches
+
+    print(f"batch: {args.batch_size} x {args.seconds} s, torch threads: {torch.get_num_threads()}")
+    for name, values in rms.items():
+        values = np.concatenate(values)
+        print(f"{name:10s}: output rms mean {values.mean():.4f}, std {values.std():.4f}")
+    print(f"per sample: {1000 * per_sample_time:.0f} ms per batch")
+    print(f"batched   : {1000 * batched_time:.0f} ms per batch ({per_sample_time / batched_time:.1f}x faster)")
@@ -0,0 +1,94 @@
+"""
+Throughput of `src.inference.ModelEnsemble` against the former ensembling
+of `sed_extended.py` (models called one after the other, one host copy and
+`np.mean` per model) for an increasing number of models. Half of the models
+are of a second architecture, as in a ResNestSED + EfficientNetSED ensemble
+sharing the same 3-channel input.
+
+    python benchmarks/ensemble_throughput.py --n_models 1 2 4 8 --n_threads 4
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.inference import ModelEnsemble  # noqa
+
+
+class TinySed2d(nn.Module):
+    # stand-in for the image SED models: a conv stack over (freq, frames),
+    # pooled over freq, and a (batch_size, n_segments, n_classes) output
+    def __init__(self, width=32, kernel_size=3, n_classes=264):
+        super().__init__()
+        padding = kernel_size // 2
+        self.encoder = nn.Sequential(
+            nn.Conv2d(3, width, kernel_size, stride=2, padding=padding), nn.ReLU(),
+            nn.Conv2d(width, width, kernel_size, stride=2, padding=padding), nn.ReLU(),
+            nn.Conv2d(width, width, kernel_size, stride=2, padding=padding), nn.ReLU(),
+            nn.Conv2d(width, width, kernel_size, stride=2, padding=padding), nn.ReLU())
+        self.fc = nn.Linear(width, n_classes)
+
+    def forward(self, x):
+        x = self.encoder(x).mean(dim=2).transpose(1, 2)
+        return {"segmentwise_output": torch.sigmoid(self.fc(x))}
+
+
+def get_models(n_models: int):
+    torch.manual_seed(1213)
+    return [
+        TinySed2d(32, 3).eval() if i % 2 == 0 else TinySed2d(48, 5).eval()
+        for i in range(n_models)
+    ]
+
+
+def legacy_ensemble(models: list, x: torch.Tensor):
+    predictions = []
+    for model in models:
+        with torch.no_grad():
+            predictions.append(model(x)["segmentwise_output"].detach().cpu().numpy())
+    return np.mean(predictions, axis=0)
+
+
+def current_ensemble(ensemble: ModelEnsemble, x: torch.Tensor):
+    with torch.no_grad():
+        return ensemble(x)["segmentwise_output"].cpu().numpy()
+
+
+def throughput(fn, x: torch.Tensor, n_batches: int):
+    fn(x)
+    t0 = time.time()
+    for _ in range(n_batches):
+        output = fn(x)
+    return n_batches * len(x) / (time.time() - t0), output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_models", nargs="+", default=[1, 2, 4, 8], type=int)
+    parser.add_argument("--n_threads", default=4, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--n_batches", default=5, type=int)
+    args = parser.parse_args()
+
+    x = torch.rand(args.batch_size, 3, 128, 512)
+    print(f"torch threads: {torch.get_num_threads()}, batch: {tuple(x.shape)}")
+    print("models | legacy clips/s | ensemble clips/s | "
+          f"ensemble x{args.n_threads} threads clips/s | max abs diff")
+    for n_models in args.n_models:
+        models = get_models(n_models)
+        legacy, expected = throughput(lambda x: legacy_ensemble(models, x), x, args.n_batches)
+        sequential, actual = throughput(
+            lambda x: current_ensemble(ModelEnsemble(models), x), x, args.n_batches)
+        threaded_ensemble = ModelEnsemble(models, n_threads=args.n_threads)
+        threaded, threaded_actual = throughput(
+            lambda x: current_ensemble(threaded_ensemble, x), x, args.n_batches)
+        max_diff = max(np.abs(actual - expected).max(), np.abs(threaded_actual - expected).max())
+        print(f"{n_models:6d} | {legacy:14.1f} | {sequential:16.1f} | "
+              f"{threaded:27.1f} | {max_diff:.1e}")
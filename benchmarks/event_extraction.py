@@ -0,0 +1,105 @@
+"""
+Micro-benchmark of `src.inference.find_events` against the former per clip,
+per class, per frame loop of `sed.py` on random framewise outputs.
+
+    python benchmarks/event_extraction.py --n_clips 2000 --n_targets 2
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.inference import find_events  # noqa
+
+
+def legacy_find_events(thresholded: np.ndarray, target_indices: np.ndarray):
+    # the loop of `sed.py`. The former loop raised IndexError after the last
+    # run of a clip, so it stops once every detected frame is consumed here
+    events = []
+    global_time = 0.0
+    for short_clip in thresholded:
+        for target_idx in target_indices:
+            if short_clip[:, target_idx].mean() == 0:
+                pass
+            else:
+                detected = np.argwhere(short_clip[:, target_idx]).reshape(-1)
+                head_idx = 0
+                tail_idx = 0
+                while True:
+                    if (tail_idx + 1 == len(detected)) or (
+                            detected[tail_idx + 1] - detected[tail_idx] != 1):
+                        onset = 0.01 * detected[head_idx] + global_time
+                        offset = 0.01 * detected[tail_idx] + global_time
+                        events.append({
+                            "ebird_code": target_idx,
+                            "onset": onset,
+                            "offset": offset
+                        })
+                        head_idx = tail_idx + 1
+                        tail_idx = tail_idx + 1
+                        if head_idx >= len(detected):
+                            break
+                    else:
+                        tail_idx = tail_idx + 1
+        global_time += 5.0
+    return pd.DataFrame(events)
+
+
+def vectorized_find_events(thresholded: np.ndarray, target_indices: np.ndarray):
+    clip_ids, class_ids, onsets, offsets = find_events(thresholded, target_indices)
+    return pd.DataFrame({
+        "ebird_code": class_ids,
+        "onset": 0.01 * onsets + 5.0 * clip_ids,
+        "offset": 0.01 * offsets + 5.0 * clip_ids
+    })
+
+
+def make_outputs(n_clips: int, n_frames: int, n_classes: int, seed=1213):
+    # smooth random curves, so that there are runs of various lengths
+    rng = np.random.RandomState(seed)
+    noise = rng.randn(n_clips, n_frames + 31, n_classes).astype(np.float32)
+    kernel = np.ones(32, dtype=np.float32) / 32
+    smoothed = np.apply_along_axis(lambda x: np.convolve(x, kernel, mode="valid"), 1, noise)
+    return 1 / (1 + np.exp(-4 * smoothed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_clips", default=2000, type=int)
+    parser.add_argument("--n_frames", default=500, type=int)
+    parser.add_argument("--n_classes", default=264, type=int)
+    parser.add_argument("--n_targets", default=2, type=int)
+    parser.add_argument("--threshold", default=0.7, type=float)
+    args = parser.parse_args()
+
+    framewise_output = make_outputs(args.n_clips, args.n_frames, args.n_classes)
+    target_indices = np.sort(
+        np.random.RandomState(0).choice(args.n_classes, args.n_targets, replace=False))
+
+    thresholded = framewise_output >= args.threshold
+    t0 = time.time()
+    expected = legacy_find_events(thresholded, target_indices)
+    legacy_time = time.time() - t0
+
+    t0 = time.time()
+    actual = vectorized_find_events(thresholded, target_indices)
+    current_time = time.time() - t0
+
+    # the loop emits events class by class within a clip, as does find_events
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+    print(f"clips: {args.n_clips}, target classes: {args.n_targets}, events: {len(actual)}")
+    print(f"legacy : {legacy_time:.3f} s")
+    print(f"current: {current_time:.3f} s ({legacy_time / current_time:.1f}x faster)")
+
+    for min_duration, merge_gap in [(0.1, 0.0), (0.0, 0.05), (0.1, 0.05)]:
+        events = find_events(
+            thresholded, target_indices,
+            min_frames=int(round(min_duration / 0.01)),
+            max_gap_frames=int(round(merge_gap / 0.01)))
+        print(f"min_duration={min_duration}, merge_gap={merge_gap}: {len(events[0])} events")
@@ -0,0 +1,76 @@
+"""
+Size and load + group-by time of the events of `sed.py` written as a csv
+against a partitioned event store (`globals.event_store`, one part per
+fold), for random events.
+
+    python benchmarks/event_store.py --n_events 1000000 --n_parts 5
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.dataset import BIRD_CODE  # noqa
+from src.storage import EventStoreWriter, get_event_matrix, read_events  # noqa
+
+
+def make_events(n_events: int, n_files: int, seed=1213):
+    rng = np.random.RandomState(seed)
+    species = np.array(list(BIRD_CODE.keys()))
+    onset = rng.uniform(0, 60, n_events).astype(np.float32)
+    return pd.DataFrame({
+        "filename": np.char.add("XC", rng.randint(0, n_files, n_events).astype(str)),
+        "ebird_code": species[rng.randint(0, len(species), n_events)],
+        "onset": onset,
+        "offset": onset + rng.uniform(0.01, 3, n_events).astype(np.float32)
+    })
+
+
+def directory_size(path: Path):
+    return sum(f.stat().st_size for f in Path(path).glob("*")) if Path(path).is_dir() else Path(path).stat().st_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_events", default=1000000, type=int)
+    parser.add_argument("--n_files", default=20000, type=int)
+    parser.add_argument("--n_parts", default=5, type=int)
+    args = parser.parse_args()
+
+    events = make_events(args.n_events, args.n_files)
+    species = list(BIRD_CODE.keys())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csv_path = Path(tmpdir) / "events.csv"
+        store_path = Path(tmpdir) / "events"
+        events.to_csv(csv_path, index=False)
+        for i, part in enumerate(np.array_split(np.arange(len(events)), args.n_parts)):
+            with EventStoreWriter(store_path, f"fold{i}") as writer:
+                writer.append(events.iloc[part])
+
+        t0 = time.time()
+        from_csv = pd.read_csv(csv_path)
+        csv_load = time.time() - t0
+        t0 = time.time()
+        csv_matrix = get_event_matrix(from_csv, species)
+        csv_group = time.time() - t0
+
+        t0 = time.time()
+        from_store = read_events(store_path)
+        store_load = time.time() - t0
+        t0 = time.time()
+        store_matrix = get_event_matrix(from_store, species)
+        store_group = time.time() - t0
+
+        assert (csv_matrix.sort_index().values == store_matrix.sort_index().values).all()
+        print(f"events: {args.n_events}, files: {args.n_files}, parts: {args.n_parts}")
+        print(f"csv  : {directory_size(csv_path) / 2 ** 20:6.1f} MiB, load {csv_load:.3f} s, "
+              f"file x species matrix {csv_group:.3f} s")
+        print(f"store: {directory_size(store_path) / 2 ** 20:6.1f} MiB, load {store_load:.3f} s, "
+              f"file x species matrix {store_group:.3f} s")
@@ -0,0 +1,140 @@
+"""
+Parity and CPU throughput of `src.features.MelPcenExtractor` against the
+per-sample librosa path of `MultiChannelDataset` / `LabelCorrectionDataset`.
+Fails when the images differ by more than `--max_diff` / 255 (uint8 rounding
+of the resize, both paths output multiples of 1/255) or when the extractor
+is less than `--min_speedup` times as fast as librosa. The extractor runs on
+`--threads` torch threads (1 by default, the CPU share of one DataLoader
+worker running the librosa path).
+
+    python benchmarks/feature_extraction.py --batch_size 16 --period 20 --n_batches 3
+"""
+import argparse
+import sys
+import time
+
+import cv2
+import librosa
+import numpy as np
+import torch
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.features import MelPcenExtractor, normalize_melspec  # noqa
+
+
+MELSPECTROGRAM_PARAMETERS = {
+    "n_mels": 128,
+    "fmin": 20,
+    "fmax": 16000
+}
+PCEN_PARAMETERS = {
+    "gain": 0.98,
+    "bias": 2,
+    "power": 0.5,
+    "time_constant": 0.4,
+    "eps": 0.000001
+}
+
+
+def librosa_image(y: np.ndarray, sr: int, img_size=224):
+    # same as `MultiChannelDataset._get_image` followed by the resize in
+    # `__getitem__`. `pad_mode` is given explicitly since the default of
+    # librosa changed from "reflect" to "constant" in 0.10
+    melspec = librosa.feature.melspectrogram(
+        y=y, sr=sr, pad_mode="reflect", **MELSPECTROGRAM_PARAMETERS)
+    pcen = librosa.pcen(melspec, sr=sr, **PCEN_PARAMETERS)
+    clean_mel = librosa.power_to_db(melspec ** 1.5)
+    melspec = librosa.power_to_db(melspec)
+
+    image = np.stack([
+        normalize_melspec(melspec),
+        normalize_melspec(pcen),
+        normalize_melspec(clean_mel)
+    ], axis=-1)
+    height, width, _ = image.shape
+    image = cv2.resize(image, (int(width * img_size / height), img_size))
+    image = np.moveaxis(image, 2, 0)
+    return (image / 255.0).astype(np.float32)
+
+
+def make_waveforms(batch_size: int, n_samples: int, sr: int, seed=1213):
+    # chirps over pink-ish noise, so that all three channels have structure
+    rng = np.random.RandomState(seed)
+    t = np.arange(n_samples) / sr
+    waveforms = []
+    for _ in range(batch_size):
+        f0, f1 = rng.uniform(1000, 8000, size=2)
+        chirp = np.sin(2 * np.pi * (f0 * t + (f1 - f0) * t ** 2 / (2 * t[-1])))
+        gate = (np.sin(2 * np.pi * rng.uniform(0.2, 2.0) * t) > 0).astype(np.float64)
+        noise = np.cumsum(rng.randn(n_samples)) * 1e-3
+        noise -= noise.mean()
+        y = 0.3 * chirp * gate + 0.05 * rng.randn(n_samples) + noise
+        waveforms.append(y.astype(np.float32))
+    return np.stack(waveforms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--period", default=20, type=int)
+    parser.add_argument("--n_batches", default=3, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--threads", default=1, type=int)
+    parser.add_argument("--chunk_size", default=None, type=int,
+                        help="samples per chunk of the extractor, by default 1 on CPU and the batch on GPU")
+    parser.add_argument("--max_diff", default=2, type=int, help="max abs diff of a pixel, in 1/255 steps")
+    parser.add_argument("--min_within", default=0.999, type=float,
+                        help="min fraction of pixels of each channel within 1/255")
+    parser.add_argument("--min_speedup", default=1.0, type=float)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    waveforms = make_waveforms(args.batch_size, args.sr * args.period, args.sr)
+    device = torch.device(args.device)
+    extractor = MelPcenExtractor(
+        sr=args.sr,
+        melspectrogram_parameters=MELSPECTROGRAM_PARAMETERS,
+        pcen_parameters=PCEN_PARAMETERS,
+        img_size=args.img_size,
+        chunk_size=args.chunk_size).to(device)
+
+    expected = np.stack([librosa_image(y, args.sr, args.img_size) for y in waveforms])
+    with torch.no_grad():
+        actual = extractor(torch.from_numpy(waveforms).to(device)).cpu().numpy()
+
+    assert actual.shape == expected.shape, (actual.shape, expected.shape)
+    diff = np.abs(actual - expected)
+    print(f"image shape: {actual.shape[1:]}")
+    print("parity:")
+    print(f"  max abs diff : {diff.max() * 255:.2f} / 255")
+    print(f"  mean abs diff: {diff.mean() * 255:.4f} / 255")
+    for i, name in enumerate(["melspec", "pcen", "clean_mel"]):
+        within = (diff[:, i] <= 1.0 / 255 + 1e-6).mean()
+        print(f"  {name:<9} pixels within 1/255: {within * 100:.2f}%")
+        assert within >= args.min_within, f"{name}: {within * 100:.2f}% of the pixels within 1/255"
+    assert diff.max() <= args.max_diff / 255 + 1e-6, f"max abs diff {diff.max() * 255:.2f} / 255"
+
+    n_items = args.batch_size * args.n_batches
+    t0 = time.time()
+    for _ in range(args.n_batches):
+        for y in waveforms:
+            librosa_image(y, args.sr, args.img_size)
+    librosa_time = time.time() - t0
+
+    t0 = time.time()
+    with torch.no_grad():
+        for _ in range(args.n_batches):
+            extractor(torch.from_numpy(waveforms).to(device)).cpu()
+    extractor_time = time.time() - t0
+
+    print(f"throughput ({torch.get_num_threads()} torch threads, {args.period}s crops):")
+    print(f"  librosa per sample: {n_items / librosa_time:.2f} items/s")
+    print(f"  MelPcenExtractor  : {n_items / extractor_time:.2f} items/s "
+          f"({librosa_time / extractor_time:.1f}x)")
+    assert librosa_time / extractor_time >= args.min_speedup, \
+        f"MelPcenExtractor is {librosa_time / extractor_time:.2f}x librosa, expected >= {args.min_speedup}x"
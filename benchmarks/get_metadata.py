@@ -0,0 +1,110 @@
+"""
+Micro-benchmark of `src.configuration.get_metadata` against the former
+row-by-row implementation on a synthetic metadata table.
+
+    python benchmarks/get_metadata.py --n_rows 100000 --n_skip 1000 --n_additional 5000
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import src.configuration as C  # noqa
+import src.dataset as datasets  # noqa
+
+
+def legacy_get_metadata(config: dict):
+    data_config = config["data"]
+    with open(data_config["train_skip"]) as f:
+        skip_rows = f.readlines()
+
+    train = pd.read_csv(data_config["train_df_path"])
+
+    for row in skip_rows:
+        row = row.replace("\n", "")
+        ebird_code = row.split("/")[1]
+        filename = row.split("/")[2]
+        train = train[~((train["ebird_code"] == ebird_code) &
+                        (train["filename"] == filename))]
+        train = train.reset_index(drop=True)
+
+    if data_config.get("additional_labels") is not None:
+        with open(data_config["additional_labels"]) as f:
+            additional_labels = json.load(f)
+
+        INV_NAME2CODE = {v: k for k, v in datasets.NAME2CODE.items()}
+        for filename in additional_labels:
+            labels = additional_labels[filename]
+            labels = [INV_NAME2CODE[name] for name in labels]
+            row_idx = train.query(f"resampled_filename == '{filename}'").index.values[0]
+            train.loc[row_idx, "secondary_labels"] = str(labels)
+    return train
+
+
+def make_inputs(root: Path, n_rows: int, n_skip: int, n_additional: int, seed=1213):
+    rng = np.random.RandomState(seed)
+    codes = np.array(list(datasets.BIRD_CODE.keys()))
+    filenames = np.array([f"XC{i:07d}.mp3" for i in range(n_rows)])
+    train = pd.DataFrame({
+        "ebird_code": codes[rng.randint(len(codes), size=n_rows)],
+        "filename": filenames,
+        "resampled_filename": [name.replace(".mp3", ".wav") for name in filenames],
+        "secondary_labels": "[]",
+        "country": "United States"
+    })
+    train.to_csv(root / "train.csv", index=False)
+
+    skipped = rng.choice(n_rows, size=n_skip, replace=False)
+    with open(root / "skipped.txt", "w") as f:
+        for i in skipped:
+            f.write(f"train_audio/{train.ebird_code[i]}/{train.filename[i]}\n")
+
+    remaining = np.setdiff1d(np.arange(n_rows), skipped)
+    labelled = rng.choice(remaining, size=n_additional, replace=False)
+    additional_labels = {
+        train.resampled_filename[i]: codes[rng.randint(len(codes), size=rng.randint(1, 3))].tolist()
+        for i in labelled
+    }
+    with open(root / "additional_labels.json", "w") as f:
+        json.dump(additional_labels, f)
+
+    return {
+        "data": {
+            "train_skip": str(root / "skipped.txt"),
+            "train_df_path": str(root / "train.csv"),
+            "train_audio_path": str(root / "train_audio_resampled"),
+            "additional_labels": str(root / "additional_labels.json")
+        }
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", default=100000, type=int)
+    parser.add_argument("--n_skip", default=1000, type=int)
+    parser.add_argument("--n_additional", default=5000, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = make_inputs(Path(tmpdir), args.n_rows, args.n_skip, args.n_additional)
+
+        t0 = time.time()
+        expected = legacy_get_metadata(config)
+        legacy_time = time.time() - t0
+
+        t0 = time.time()
+        actual, _ = C.get_metadata(config)
+        current_time = time.time() - t0
+
+    pd.testing.assert_frame_equal(actual, expected)
+    print(f"rows: {args.n_rows}, skipped: {args.n_skip}, additional labels: {args.n_additional}")
+    print(f"legacy : {legacy_time:.2f} s")
+    print(f"current: {current_time:.2f} s ({legacy_time / current_time:.1f}x faster)")
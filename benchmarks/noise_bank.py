@@ -0,0 +1,50 @@
+"""
+Per call cost of NoiseInjection, GaussianNoise and PinkNoise drawing fresh
+noise for each clip against windows of the per-worker noise bank, with the
+std, peak and spectral slope (0 for white, -1 for pink) of the added noise.
+
+    python benchmarks/noise_bank.py --seconds 30 --n_calls 20
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.transforms import GaussianNoise, NoiseInjection, PinkNoise  # noqa
+
+
+def spectral_slope(noises: list, n_fft=65536):
+    power = np.mean([np.abs(np.fft.rfft(noise[:n_fft])) ** 2 for noise in noises], axis=0)
+    frequencies = np.fft.rfftfreq(n_fft)
+    return np.polyfit(np.log(frequencies[10:]), np.log(power[10:] + 1e-30), 1)[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", default=30, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    parser.add_argument("--n_calls", default=20, type=int)
+    args = parser.parse_args()
+
+    np.random.seed(1213)
+    y = (0.1 * np.random.randn(args.seconds * args.sr)).astype(np.float32)
+    print(f"{args.seconds} s clips at {args.sr} Hz")
+    for cls, params in [(NoiseInjection, {"max_noise_level": 0.04}), (GaussianNoise, {}), (PinkNoise, {})]:
+        times = {}
+        for noise_bank in [False, True]:
+            transform = cls(always_apply=True, noise_bank=noise_bank, **params)
+            # the bank is generated by the first call of each worker
+            transform(y)
+            t0 = time.time()
+            noises = [transform(y) - y for _ in range(args.n_calls)]
+            times[noise_bank] = (time.time() - t0) / args.n_calls
+            print(f"{cls.__name__:14s} noise_bank={str(noise_bank):5s}: {1000 * times[noise_bank]:5.1f} ms, "
+                  f"std {np.mean([noise.std() for noise in noises]):.4f}, "
+                  f"peak {np.mean([np.abs(noise).max() for noise in noises]):.4f}, "
+                  f"slope {spectral_slope(noises):.2f}")
+        print(f"{cls.__name__:14s} {times[False] / times[True]:.1f}x faster")
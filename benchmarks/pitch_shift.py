@@ -0,0 +1,68 @@
+"""
+Per sample cost of `PitchShift` with the phase vocoder (librosa) and the
+polyphase resampling mode on `--seconds` of 32 kHz audio, for every
+semitone shift the transform can draw with `max_range`, and the pitch
+reached by each mode on a pure tone.
+
+    python benchmarks/pitch_shift.py --seconds 30 --max_range 3
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import librosa  # noqa
+
+from src.transforms import resample_pitch_shift  # noqa
+
+
+def dominant_frequency(y: np.ndarray, sr: int):
+    spectrum = np.abs(np.fft.rfft(y * np.hanning(len(y))))
+    return np.fft.rfftfreq(len(y), 1 / sr)[spectrum.argmax()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", default=30.0, type=float)
+    parser.add_argument("--max_range", default=3, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    parser.add_argument("--tone", default=2000.0, type=float)
+    args = parser.parse_args()
+
+    t = np.arange(int(args.seconds * args.sr)) / args.sr
+    y = (0.5 * np.sin(2 * np.pi * args.tone * t) + 0.01 * np.random.RandomState(1213).randn(len(t)))
+    y = y.astype(np.float32)
+
+    # the two code paths of PitchShift.apply for a given draw
+    modes = {
+        "phase_vocoder": lambda y, n_steps: librosa.effects.pitch_shift(y, sr=args.sr, n_steps=n_steps),
+        "resample": resample_pitch_shift
+    }
+
+    # the shifts drawn by PitchShift: randint(-max_range, max_range)
+    steps = list(range(-args.max_range, args.max_range))
+    print(f"{args.seconds} s at {args.sr} Hz, {args.tone:.0f} Hz tone")
+    print("n_steps | expected Hz | " + " | ".join(f"{mode:>13s} Hz, ms" for mode in modes))
+    totals = {mode: 0.0 for mode in modes}
+    for shift in modes.values():
+        # warm up (librosa compiles its resampler / vocoder on first use)
+        shift(y[:args.sr], 1)
+    for n_steps in steps:
+        row = f"{n_steps:7d} | {args.tone * 2 ** (n_steps / 12):11.1f}"
+        for mode, shift in modes.items():
+            t0 = time.time()
+            augmented = shift(y, n_steps)
+            elapsed = time.time() - t0
+            totals[mode] += elapsed
+            assert len(augmented) == len(y)
+            row += f" | {dominant_frequency(augmented[:args.sr], args.sr):13.1f}, {1000 * elapsed:6.0f}"
+        print(row)
+    vocoder = totals["phase_vocoder"] / len(steps)
+    resample = totals["resample"] / len(steps)
+    print(f"mean per sample: phase_vocoder {1000 * vocoder:.0f} ms, resample {1000 * resample:.0f} ms "
+          f"({vocoder / resample:.1f}x faster)")
@@ -0,0 +1,99 @@
+"""
+Time of a SED inference pass over synthetic recordings without cache, with
+a cold `PredictionCache` (outputs written) and with a warm one (a rerun
+which only changes post-processing), and size of the cache.
+
+    python benchmarks/prediction_cache.py --n_files 50
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import torch
+import torch.nn as nn
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import src.dataset as datasets  # noqa
+
+from src.inference import collate_chunks, predict_files, predict_files_cached  # noqa
+from src.storage import PredictionCache, get_prediction_key  # noqa
+
+
+class TinySed(nn.Module):
+    # stand-in for PANNs: a framing conv and a stack of small convolutions
+    # with a (batch_size, n_frames, n_classes) framewise output
+    def __init__(self, n_classes=264, n_layers=8):
+        super().__init__()
+        layers = [nn.Conv1d(1, 64, kernel_size=1024, stride=320), nn.ReLU()]
+        for _ in range(n_layers):
+            layers += [nn.Conv1d(64, 64, kernel_size=3, padding=1), nn.ReLU()]
+        self.encoder = nn.Sequential(*layers)
+        self.fc = nn.Linear(64, n_classes)
+
+    def forward(self, x):
+        x = self.encoder(x.unsqueeze(1)).transpose(1, 2)
+        return {"framewise_output": torch.sigmoid(self.fc(x))}
+
+
+def get_loader(dataset, indices):
+    subset = torch.utils.data.Subset(dataset, indices)
+    return torch.utils.data.DataLoader(subset, batch_size=1, collate_fn=collate_chunks)
+
+
+def run(files):
+    t0 = time.time()
+    outputs = {file["wav_name"]: output["framewise_output"] for file, output in files}
+    return time.time() - t0, outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_files", default=50, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(1213)
+    model = TinySed().eval()
+    device = torch.device("cpu")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = Path(tmpdir) / "audio"
+        (datadir / "aldfly").mkdir(parents=True)
+        rng = np.random.RandomState(1213)
+        rows = []
+        for i in range(args.n_files):
+            wav_name = f"XC{i}.wav"
+            seconds = rng.randint(5, 60)
+            sf.write(datadir / "aldfly" / wav_name, 0.1 * rng.randn(args.sr * seconds), args.sr)
+            rows.append({"ebird_code": "aldfly", "resampled_filename": wav_name, "secondary_labels": "[]"})
+        dataset = datasets.PANNsSedDataset(pd.DataFrame(rows), datadir)
+
+        no_cache_time, expected = run(predict_files(
+            get_loader(dataset, list(range(len(dataset)))), model, device, 32, ["framewise_output"]))
+
+        # the key of a checkpoint file would be `cache.hash_file(weights)`
+        checkpoint_hash = "tiny-sed"
+        times = []
+        for _ in range(2):
+            t0 = time.time()
+            cache = PredictionCache(Path(tmpdir) / "cache")
+            keys = [
+                get_prediction_key(cache.hash_audio(datadir, code, name), checkpoint_hash, "config")
+                for code, name in zip(dataset.ebird_codes, dataset.wav_names)
+            ]
+            _, actual = run(predict_files_cached(
+                dataset, lambda indices: get_loader(dataset, indices), model, device, cache, keys,
+                32, ["framewise_output"]))
+            times.append(time.time() - t0)
+
+        max_diff = max(np.abs(actual[key] - expected[key]).max() for key in expected)
+        print(f"files: {args.n_files}, cache size: {cache.n_bytes / 2 ** 20:.1f} MiB")
+        print(f"no cache  : {no_cache_time:.2f} s")
+        print(f"cold cache: {times[0]:.2f} s")
+        print(f"warm cache: {times[1]:.2f} s (max abs diff {max_diff:.1e}, float16 rounding)")
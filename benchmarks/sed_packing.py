@@ -0,0 +1,118 @@
+"""
+Throughput of `src.inference.predict_files`, which packs the chunks of
+several recordings into fixed size model batches, against the former
+per recording batching of `sed.py` / `sed_soft.py` with a batch_size=1
+loader. Recordings are mostly short (1-3 chunks), as in the train set.
+
+    python benchmarks/sed_packing.py --n_files 200 --batch_size 32
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.inference import collate_chunks, predict_files  # noqa
+
+
+class ChunkDataset(data.Dataset):
+    def __init__(self, n_files: int, n_samples: int, seed=1213):
+        rng = np.random.RandomState(seed)
+        self.n_chunks = np.minimum(rng.geometric(0.5, size=n_files), 12)
+        self.n_samples = n_samples
+
+    def __len__(self):
+        return len(self.n_chunks)
+
+    def __getitem__(self, idx: int):
+        rng = np.random.RandomState(idx)
+        return {
+            "waveform": rng.randn(self.n_chunks[idx], self.n_samples).astype(np.float32),
+            "wav_name": f"XC{idx}.wav"
+        }
+
+
+class TinySed(nn.Module):
+    # stand-in for the SED models: a framing conv (like an STFT front end)
+    # followed by a stack of small convolutions and a
+    # (batch_size, n_segments, n_classes) output
+    def __init__(self, n_classes=264, n_layers=8):
+        super().__init__()
+        layers = [nn.Conv1d(1, 64, kernel_size=1024, stride=320), nn.ReLU()]
+        for _ in range(n_layers):
+            layers += [nn.Conv1d(64, 64, kernel_size=3, padding=1), nn.BatchNorm1d(64), nn.ReLU()]
+        self.encoder = nn.Sequential(*layers)
+        self.fc = nn.Linear(64, n_classes)
+
+    def forward(self, x):
+        x = self.encoder(x.unsqueeze(1)).transpose(1, 2)
+        return {"segmentwise_output": torch.sigmoid(self.fc(x))}
+
+
+class CountingModel(nn.Module):
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+        self.n_calls = 0
+
+    def forward(self, x):
+        self.n_calls += 1
+        return self.model(x)
+
+
+def legacy_predict_files(loader, model, device, batch_size=32):
+    for batch in loader:
+        tensor = batch["waveform"].squeeze(0)
+        outputs = []
+        for start in range(0, len(tensor), batch_size):
+            with torch.no_grad():
+                prediction = model(tensor[start:start + batch_size].to(device))
+            outputs.append(prediction["segmentwise_output"].detach().cpu().numpy())
+        yield batch["wav_name"][0], np.concatenate(outputs, axis=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_files", default=200, type=int)
+    parser.add_argument("--n_samples", default=32000 * 5, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(1213)
+    device = torch.device("cpu")
+    model = CountingModel(TinySed().eval())
+    dataset = ChunkDataset(args.n_files, args.n_samples)
+    n_clips = int(dataset.n_chunks.sum())
+
+    t0 = time.time()
+    expected = dict(legacy_predict_files(
+        data.DataLoader(dataset, batch_size=1), model, device, args.batch_size))
+    legacy_time = time.time() - t0
+    legacy_calls = model.n_calls
+    model.n_calls = 0
+
+    t0 = time.time()
+    actual = {
+        file["wav_name"]: outputs["segmentwise_output"]
+        for file, outputs in predict_files(
+            data.DataLoader(dataset, batch_size=1, collate_fn=collate_chunks),
+            model, device, batch_size=args.batch_size)
+    }
+    current_time = time.time() - t0
+
+    assert list(actual.keys()) == list(expected.keys())
+    max_diff = max(np.abs(actual[key] - expected[key]).max() for key in expected)
+    print(f"files: {args.n_files}, clips: {n_clips}, batch_size: {args.batch_size}")
+    print(f"max abs diff of outputs: {max_diff:.2e}")
+    print(f"per recording batches: {n_clips / legacy_time:.1f} clips/s, "
+          f"{legacy_calls} forward passes ({n_clips / legacy_calls:.1f} clips each)")
+    print(f"packed batches       : {n_clips / current_time:.1f} clips/s, "
+          f"{model.n_calls} forward passes ({n_clips / model.n_calls:.1f} clips each)")
+    print(f"torch threads: {torch.get_num_threads()}")
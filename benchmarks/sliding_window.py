@@ -0,0 +1,110 @@
+"""
+Accuracy gained per extra FLOP of overlapping SED inference windows.
+
+Synthetic recordings with tonal calls of known position are windowed with
+`src.features.frame_windows` every `hop` seconds, a stand-in detector is
+run on each window and the segment outputs are merged with
+`src.inference.aggregate_segmentwise_outputs`. The detector scores a
+segment from its band energy but, like the SED models on calls cut by the
+window boundary, loses confidence towards the edges of the window.
+Model FLOPs are proportional to the number of windows, so the cost of a
+hop is reported relative to non-overlapping windows (hop == period).
+
+    python benchmarks/sliding_window.py --hops 5 2.5 1.25 --mode mean
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.features import frame_windows  # noqa
+from src.inference import aggregate_segmentwise_outputs  # noqa
+
+
+def make_recording(duration: float, sr: int, sec_per_segment: float, rng: np.random.RandomState):
+    n_samples = int(duration * sr)
+    y = 0.05 * rng.randn(n_samples).astype(np.float32)
+    truth = np.zeros(int(np.ceil(duration / sec_per_segment)), dtype=bool)
+    t = np.arange(n_samples) / sr
+    for _ in range(rng.poisson(duration / 4)):
+        onset = rng.uniform(0, duration - 0.5)
+        offset = min(duration, onset + rng.uniform(0.2, 1.5))
+        call = (t >= onset) & (t < offset)
+        y[call] += 0.1 * np.sin(2 * np.pi * 0.2 * sr * t[call])
+        truth[int(onset / sec_per_segment):int(np.ceil(offset / sec_per_segment))] = True
+    return y, truth
+
+
+def detector(windows: np.ndarray, n_segments: int, edge: float):
+    # (n_windows, n_segments) scores from the segment energy above the noise
+    # floor, damped within `edge` (fraction of the window) of both ends
+    segments = windows.reshape(len(windows), n_segments, -1)
+    energy = (segments ** 2).mean(axis=-1)
+    scores = 1 / (1 + np.exp(-(energy / 0.0025 - 2.0)))
+    position = (np.arange(n_segments) + 0.5) / n_segments
+    taper = np.clip(np.minimum(position, 1 - position) / edge, 0.0, 1.0)
+    return (scores * taper)[:, :, None]
+
+
+def f1_score(predicted: np.ndarray, truth: np.ndarray):
+    tp = (predicted & truth).sum()
+    fp = (predicted & ~truth).sum()
+    fn = (~predicted & truth).sum()
+    return 2 * tp / max(2 * tp + fp + fn, 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_files", default=50, type=int)
+    parser.add_argument("--duration", default=60.0, type=float)
+    parser.add_argument("--period", default=5.0, type=float)
+    parser.add_argument("--hops", nargs="+", default=[5.0, 2.5, 1.25], type=float)
+    parser.add_argument("--mode", default="mean", choices=["mean", "max"])
+    parser.add_argument("--n_segments", default=50, type=int)
+    parser.add_argument("--edge", default=0.2, type=float)
+    parser.add_argument("--threshold", default=0.5, type=float)
+    parser.add_argument("--sr", default=8000, type=int)
+    args = parser.parse_args()
+
+    sec_per_segment = args.period / args.n_segments
+    window_length = int(args.period * args.sr)
+    rng = np.random.RandomState(1213)
+    recordings = [
+        make_recording(rng.uniform(args.period, args.duration), args.sr, sec_per_segment, rng)
+        for _ in range(args.n_files)
+    ]
+
+    print(f"files: {args.n_files}, period: {args.period} s, aggregation: {args.mode}")
+    print("  hop | windows | rel. FLOPs |     F1 | F1 gain per extra FLOP | aggregation time")
+    base_windows = None
+    base_f1 = None
+    for hop in args.hops:
+        predicted = []
+        truths = []
+        n_windows = 0
+        aggregation_time = 0.0
+        for y, truth in recordings:
+            windows = frame_windows(y, window_length, int(hop * args.sr))
+            outputs = detector(windows, args.n_segments, args.edge)
+            n_windows += len(windows)
+            t0 = time.time()
+            soft_labels = aggregate_segmentwise_outputs(
+                outputs, len(y) / args.sr, args.period, hop, args.mode)
+            aggregation_time += time.time() - t0
+            predicted.append(soft_labels[:len(truth), 0] >= args.threshold)
+            truths.append(truth[:len(soft_labels)])
+        f1 = f1_score(np.concatenate(predicted), np.concatenate(truths))
+
+        if base_windows is None:
+            base_windows = n_windows
+            base_f1 = f1
+        relative_flops = n_windows / base_windows
+        extra = relative_flops - 1
+        gain = f"{(f1 - base_f1) / extra:+.4f}" if extra > 0 else "-"
+        print(f"{hop:5.2f} | {n_windows:7d} | {relative_flops:10.2f} | {f1:.4f} | "
+              f"{gain:>22s} | {1000 * aggregation_time:.1f} ms")
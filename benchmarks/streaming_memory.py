@@ -0,0 +1,66 @@
+"""
+Peak memory of the SED inference inputs of one recording, materialized by
+`__getitem__` vs produced chunk by chunk by `iter_chunks` (the path of
+`predict_stream`), for synthetic recordings of increasing length.
+
+    python benchmarks/streaming_memory.py --minutes 5 20 60
+"""
+import argparse
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import src.dataset as datasets  # noqa
+
+
+def peak_mib(fn):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def consume(iterator):
+    for _ in iterator:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", nargs="+", default=[5, 20, 60], type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = Path(tmpdir)
+        (datadir / "aldfly").mkdir()
+        rows = []
+        for minutes in args.minutes:
+            wav_name = f"XC{minutes}.wav"
+            n_samples = args.sr * 60 * minutes
+            with sf.SoundFile(datadir / "aldfly" / wav_name, "w", args.sr, 1, "PCM_16") as f:
+                rng = np.random.RandomState(minutes)
+                for start in range(0, n_samples, args.sr * 60):
+                    f.write(0.1 * rng.randn(min(args.sr * 60, n_samples - start)))
+            rows.append({
+                "ebird_code": "aldfly",
+                "resampled_filename": wav_name,
+                "secondary_labels": "[]"
+            })
+        df = pd.DataFrame(rows)
+        dataset = datasets.PANNsSedDataset(df, datadir)
+
+        print("minutes | __getitem__ peak | iter_chunks peak")
+        for idx, minutes in enumerate(args.minutes):
+            materialized = peak_mib(lambda: dataset[idx])
+            streamed = peak_mib(lambda: consume(dataset.iter_chunks(idx)))
+            print(f"{minutes:7d} | {materialized:12.1f} MiB | {streamed:12.1f} MiB")
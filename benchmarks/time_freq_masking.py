@@ -0,0 +1,74 @@
+"""
+Time of `TimeFreqMasking` applied to each channel image of each sample
+against `BatchTimeFreqMasking` on the collated (batch_size, n_channels,
+n_freqs, n_frames) tensor, with and without `inplace`, and the fraction of
+masked bins of each (the fixed `drop_stripes` masks time stripes, not
+single columns).
+
+    python benchmarks/time_freq_masking.py --batch_size 32 --width 1200
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.transforms import BatchTimeFreqMasking, TimeFreqMasking  # noqa
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--img_size", default=224, type=int)
+    parser.add_argument("--width", default=1200, type=int)
+    parser.add_argument("--n_batches", default=10, type=int)
+    args = parser.parse_args()
+
+    params = {"time_drop_width": 64, "time_stripes_num": 2, "freq_drop_width": 16, "freq_stripes_num": 2, "p": 0.5}
+    per_channel = TimeFreqMasking(**params)
+    batched = {
+        "batched": BatchTimeFreqMasking(**params),
+        "batched, inplace": BatchTimeFreqMasking(**params, inplace=True)
+    }
+
+    np.random.seed(1213)
+    torch.manual_seed(1213)
+    images = np.random.rand(args.batch_size, 3, args.img_size, args.width).astype(np.float32)
+    # masked bins are set to the min of their channel image
+    lowest_value = images.reshape(args.batch_size, 3, -1).min(axis=2)[..., None, None]
+
+    masked = {"per channel": [], "batched": [], "batched, inplace": []}
+    times = {}
+    t0 = time.time()
+    for _ in range(args.n_batches):
+        # the draw of `p` of albumentations is done here, its constructor
+        # signature differs between versions
+        outputs = np.stack([
+            np.stack([
+                per_channel.apply(channel) if np.random.rand() < params["p"] else channel
+                for channel in image
+            ]) for image in images
+        ])
+        masked["per channel"].append((outputs == lowest_value).mean())
+    times["per channel"] = (time.time() - t0) / args.n_batches
+
+    for name, transform in batched.items():
+        elapsed = 0.0
+        for _ in range(args.n_batches):
+            # a fresh collated batch, as in the training loop
+            x = torch.from_numpy(images.copy())
+            t0 = time.time()
+            outputs = transform(x)
+            elapsed += time.time() - t0
+            masked[name].append((outputs.numpy() == lowest_value).mean())
+        times[name] = elapsed / args.n_batches
+
+    print(f"batch: {args.batch_size} x 3 x {args.img_size} x {args.width}, params: {params}")
+    for name, values in masked.items():
+        print(f"{name:16s}: {100 * np.mean(values):.2f} % of the bins masked, {1000 * times[name]:.1f} ms per batch "
+              f"({times['per channel'] / times[name]:.1f}x)")
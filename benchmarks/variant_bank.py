@@ -0,0 +1,69 @@
+"""
+Per sample cost of `PitchShift` computed online on a `--period` second crop
+against `StoredVariants` reading the crop from a bank of the variants of
+synthetic `--seconds` long recordings, and the size of the bank.
+
+    python benchmarks/variant_bank.py --n_files 10 --seconds 60 --period 30
+"""
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.storage import VariantBankWriter  # noqa
+from src.transforms import PitchShift, StoredVariants  # noqa
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_files", default=10, type=int)
+    parser.add_argument("--seconds", default=60, type=int)
+    parser.add_argument("--period", default=30, type=int)
+    parser.add_argument("--max_range", default=3, type=int)
+    parser.add_argument("--n_samples", default=20, type=int)
+    parser.add_argument("--sr", default=32000, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(1213)
+    recordings = {f"XC{i}.wav": (0.1 * rng.randn(args.sr * args.seconds)).astype(np.float32)
+                  for i in range(args.n_files)}
+    trns_conf = {"name": "PitchShift", "params": {"max_range": args.max_range}}
+    online = PitchShift(always_apply=True, **trns_conf["params"])
+    # warm up (librosa compiles its resampler / vocoder on first use)
+    online(recordings["XC0.wav"][:args.sr])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        t0 = time.time()
+        with VariantBankWriter(Path(tmpdir), trns_conf, online.get_variants()) as writer:
+            for wav_name, y in recordings.items():
+                for variant in online.get_variants():
+                    writer.append("aldfly", wav_name, variant, online.apply_variant(y, variant), len(y))
+        build_time = time.time() - t0
+        stored = StoredVariants(always_apply=True, bank_dir=tmpdir)
+
+        crop_length = args.sr * args.period
+        crops = []
+        for _ in range(args.n_samples):
+            wav_name = f"XC{rng.randint(args.n_files)}.wav"
+            offset = rng.randint(args.sr * args.seconds - crop_length)
+            crops.append((wav_name, offset))
+
+        times = {}
+        for name, transform in [("online", online), ("stored", stored)]:
+            t0 = time.time()
+            for wav_name, offset in crops:
+                y = recordings[wav_name][offset:offset + crop_length]
+                transform(y, ebird_code="aldfly", wav_name=wav_name, offset=offset)
+            times[name] = (time.time() - t0) / args.n_samples
+
+        print(f"files: {args.n_files} x {args.seconds} s, variants: {online.get_variants()}")
+        print(f"bank: {writer.n_bytes / 2 ** 20:.1f} MiB, built in {build_time:.1f} s")
+        print(f"online PitchShift: {1000 * times['online']:.1f} ms per {args.period} s crop")
+        print(f"StoredVariants   : {1000 * times['stored']:.1f} ms per {args.period} s crop "
+              f"({times['online'] / times['stored']:.0f}x faster)")
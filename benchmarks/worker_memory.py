@@ -0,0 +1,164 @@
+"""
+Per-worker memory of DataLoader workers across epochs, for the legacy
+DataFrame based metadata access (`df.loc[idx, :]` + `eval`) and for the
+current numpy based datasets.
+
+    python benchmarks/worker_memory.py --n_rows 100000 --num_workers 8 --epochs 5
+
+RSS counts every resident page including the ones shared with the parent,
+USS (Private_Clean + Private_Dirty) counts only the pages the worker owns,
+i.e. the ones copied on write.
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import torch.utils.data as data
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import src.dataset as datasets  # noqa
+from src.storage import PackedAudioStore, get_shard_name, read_audio  # noqa
+
+
+def get_memory_usage():
+    usage = {}
+    if Path("/proc/self/smaps_rollup").exists():
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    usage[fields[0][:-1]] = int(fields[1]) * 1024
+        rss = usage["Rss"]
+        uss = usage.get("Private_Clean", 0) + usage.get("Private_Dirty", 0)
+    else:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS"):
+                    rss = int(line.split()[1]) * 1024
+        uss = -1
+    return rss, uss
+
+
+class LegacyDataset(data.Dataset):
+    def __init__(self, df: pd.DataFrame, datadir, period=1):
+        self.df = df
+        self.datadir = datadir
+        self.period = period
+
+    def __len__(self):
+        return len(self.df)
+
+    def __getitem__(self, idx: int):
+        sample = self.df.loc[idx, :]
+        wav_name = sample["resampled_filename"]
+        ebird_code = sample["ebird_code"]
+        secondary_labels = eval(sample["secondary_labels"])
+        y, sr = read_audio(self.datadir, ebird_code, wav_name)
+
+        new_y = np.zeros(sr * self.period, dtype=np.float32)
+        new_y[:len(y)] = y
+
+        labels = np.zeros(len(datasets.BIRD_CODE), dtype=int)
+        labels[datasets.BIRD_CODE[ebird_code]] = 1
+        for second_label in secondary_labels:
+            if datasets.NAME2CODE.get(second_label) is not None:
+                second_code = datasets.NAME2CODE[second_label]
+                labels[datasets.BIRD_CODE[second_code]] = 1
+        return {
+            "waveform": new_y,
+            "targets": labels
+        }
+
+
+class MemoryProbe(data.Dataset):
+    def __init__(self, dataset: data.Dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int):
+        sample = self.dataset[idx]
+        rss, uss = get_memory_usage()
+        sample["pid"] = os.getpid()
+        sample["rss"] = rss
+        sample["uss"] = uss
+        return sample
+
+
+def make_metadata(n_rows: int, seed=1213):
+    rng = np.random.RandomState(seed)
+    codes = np.array(list(datasets.BIRD_CODE.keys()))
+    names = np.array(list(datasets.NAME2CODE.keys()))
+    df = pd.DataFrame({
+        "ebird_code": codes[rng.randint(len(codes), size=n_rows)],
+        "resampled_filename": [f"XC{i:07d}.wav" for i in range(n_rows)],
+        "secondary_labels": [
+            str(names[rng.randint(len(names), size=rng.randint(3))].tolist())
+            for _ in range(n_rows)
+        ]
+    })
+    # train.csv has ~35 mostly textual columns
+    for i in range(30):
+        df[f"text_{i}"] = [f"some metadata text {i} {j}" for j in range(n_rows)]
+    return df
+
+
+def make_store(df: pd.DataFrame, root: Path, sr=1000, length=500):
+    index = df[["ebird_code", "resampled_filename"]].copy()
+    index["length"] = length
+    index["sr"] = sr
+    index["shard"] = 0
+    index["offset"] = np.arange(len(df)) * length
+    shard = np.lib.format.open_memmap(
+        root / get_shard_name(0), mode="w+", dtype=np.int16, shape=(len(df) * length, ))
+    shard[:] = 1
+    shard.flush()
+    index.to_csv(root / "index.csv", index=False)
+    return PackedAudioStore(root)
+
+
+def run(dataset: data.Dataset, args):
+    gc.freeze()
+    loader_params = dict(batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    if args.persistent_workers:
+        loader_params["persistent_workers"] = True
+    loader = data.DataLoader(MemoryProbe(dataset), **loader_params)
+
+    for epoch in range(args.epochs):
+        usage = {}
+        for batch in loader:
+            for pid, rss, uss in zip(batch["pid"].tolist(), batch["rss"].tolist(), batch["uss"].tolist()):
+                usage[pid] = (rss, uss)
+        rss = np.array([v[0] for v in usage.values()]) / 2 ** 20
+        uss = np.array([v[1] for v in usage.values()]) / 2 ** 20
+        print(f"  epoch {epoch}: RSS {rss.mean():.1f} MiB (max {rss.max():.1f}), "
+              f"USS {uss.mean():.1f} MiB (max {uss.max():.1f}) over {len(usage)} workers")
+    gc.unfreeze()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", default=100000, type=int)
+    parser.add_argument("--num_workers", default=4, type=int)
+    parser.add_argument("--batch_size", default=256, type=int)
+    parser.add_argument("--epochs", default=3, type=int)
+    parser.add_argument("--persistent_workers", action="store_true")
+    args = parser.parse_args()
+
+    df = make_metadata(args.n_rows)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = make_store(df, Path(tmpdir))
+
+        print("legacy (DataFrame + eval)")
+        run(LegacyDataset(df, store, period=1), args)
+
+        print("PANNsMultiLabelDataset (numpy metadata)")
+        run(datasets.PANNsMultiLabelDataset(df, store, period=1), args)
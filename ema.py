@@ -15,6 +15,8 @@ from pathlib import Path
 from fastprogress import progress_bar
 from sklearn.metrics import average_precision_score, f1_score
 
+from src.transforms import get_batch_spectrogram_transforms, get_batch_transforms
+
 
 class AveragedModel(nn.Module):
     def __init__(self, model, device=None, avg_fn=None):
@@ -44,7 +46,29 @@ class AveragedModel(nn.Module):
             self.n_averaged += 1
 
 
-def update_bn(loader, model, device=None, input_key=""):
+def get_input(batch: dict, device, input_key="image", feature_extractor=None, batch_transforms=None,
+              batch_spectrogram_transforms=None):
+    # batch transforms work on the (batch_size, n_samples) waveforms, either
+    # the input itself (PANNs) or the input of the feature extractor, and
+    # batch spectrogram transforms on the images, either the input itself
+    # or the output of the feature extractor
+    with torch.no_grad():
+        if feature_extractor is not None:
+            x = batch["waveform"].to(device)
+            if batch_transforms is not None:
+                x = batch_transforms(x)
+            x = feature_extractor(x)
+        else:
+            x = batch[input_key].to(device)
+            if batch_transforms is not None:
+                x = batch_transforms(x)
+        if batch_spectrogram_transforms is not None:
+            x = batch_spectrogram_transforms(x)
+    return x
+
+
+def update_bn(loader, model, device=None, input_key="", feature_extractor=None, batch_transforms=None,
+              batch_spectrogram_transforms=None):
     r"""Updates BatchNorm running_mean, running_var buffers in the model.
     It performs one pass over data in `loader` to estimate the activation
     statistics for BatchNorm layers in the model.
@@ -86,8 +110,9 @@ def update_bn(loader, model, device=None, input_key=""):
         if isinstance(input, (list, tuple)):
             input = input[0]
         if isinstance(input, dict):
-            input = input[input_key]
-        if device is not None:
+            input = get_input(input, device, input_key, feature_extractor, batch_transforms,
+                              batch_spectrogram_transforms)
+        elif device is not None:
             input = input.to(device)
 
         model(input)
@@ -106,7 +131,10 @@ def train_one_epoch(model,
                     device,
                     n=10,
                     input_key="image",
-                    input_target_key="targets"):
+                    input_target_key="targets",
+                    feature_extractor=None,
+                    batch_transforms=None,
+                    batch_spectrogram_transforms=None):
     avg_loss = 0.0
     model.train()
     preds = []
@@ -114,7 +142,8 @@ def train_one_epoch(model,
     cnt = n
     for step, batch in enumerate(progress_bar(dataloader)):
         cnt -= 1
-        x = batch[input_key].to(device)
+        x = get_input(batch, device, input_key, feature_extractor, batch_transforms,
+                      batch_spectrogram_transforms)
         y = batch[input_target_key].to(device).float()
 
         outputs = model(x)
@@ -134,7 +163,9 @@ def train_one_epoch(model,
         preds.append(clipwise_output)
         targs.append(target)
 
-    update_bn(dataloader, ema_model, device=device, input_key=input_key)
+    update_bn(dataloader, ema_model, device=device, input_key=input_key,
+              feature_extractor=feature_extractor, batch_transforms=batch_transforms,
+              batch_spectrogram_transforms=batch_spectrogram_transforms)
 
     scheduler.step()
 
@@ -148,14 +179,18 @@ def eval_one_epoch(model,
                    criterion,
                    device,
                    input_key="image",
-                   input_target_key="targets"):
+                   input_target_key="targets",
+                   feature_extractor=None,
+                   batch_transforms=None,
+                   batch_spectrogram_transforms=None):
     avg_loss = 0.0
     model.eval()
     preds = []
     targs = []
     for step, batch in enumerate(progress_bar(dataloader)):
         with torch.no_grad():
-            x = batch[input_key].to(device)
+            x = get_input(batch, device, input_key, feature_extractor, batch_transforms,
+                          batch_spectrogram_transforms)
             y = batch[input_target_key].to(device).float()
 
             outputs = model(x)
@@ -224,7 +259,10 @@ def train(model,
           main_metric="sample_f1",
           epochs=75,
           input_key="image",
-          input_target_key="targets"):
+          input_target_key="targets",
+          feature_extractor=None,
+          batch_transforms={},
+          batch_spectrogram_transforms={}):
     train_metrics = {}
     eval_metrics = {}
     best_metric = -np.inf
@@ -247,7 +285,10 @@ def train(model,
             device=device,
             n=n,
             input_key=input_key,
-            input_target_key=input_target_key)
+            input_target_key=input_target_key,
+            feature_extractor=feature_extractor,
+            batch_transforms=batch_transforms.get("train"),
+            batch_spectrogram_transforms=batch_spectrogram_transforms.get("train"))
         mAP, classwise_f1, sample_f1 = calc_metrics(y_true, y_pred)
         train_metrics["loss"] = avg_loss
         train_metrics["mAP"] = mAP
@@ -267,7 +308,10 @@ def train(model,
             criterion=criterion,
             device=device,
             input_key=input_key,
-            input_target_key=input_target_key)
+            input_target_key=input_target_key,
+            feature_extractor=feature_extractor,
+            batch_transforms=batch_transforms.get("valid"),
+            batch_spectrogram_transforms=batch_spectrogram_transforms.get("valid"))
         mAP, classwise_f1, sample_f1 = calc_metrics(y_true, y_pred)
         eval_metrics["loss"] = avg_loss
         eval_metrics["mAP"] = mAP
@@ -282,7 +326,10 @@ def train(model,
             criterion=criterion,
             device=device,
             input_key=input_key,
-            input_target_key=input_target_key)
+            input_target_key=input_target_key,
+            feature_extractor=feature_extractor,
+            batch_transforms=batch_transforms.get("valid"),
+            batch_spectrogram_transforms=batch_spectrogram_transforms.get("valid"))
         mAP, classwise_f1, sample_f1 = calc_metrics(y_true, y_pred)
         eval_metrics["EMA_loss"] = avg_loss
         eval_metrics["EMA_mAP"] = mAP
@@ -339,6 +386,7 @@ if __name__ == "__main__":
         y = calltype_labels
     else:
         y = df["ebird_code"]
+    utils.freeze_gc()
     for i, (trn_idx, val_idx) in enumerate(
             splitter.split(df, y=y)):
         if i not in global_params["folds"]:
@@ -358,6 +406,18 @@ if __name__ == "__main__":
         criterion = C.get_criterion(config).to(device)
         optimizer = C.get_optimizer(model, config)
         scheduler = C.get_scheduler(optimizer, config)
+        feature_extractor = C.get_feature_extractor(config)
+        if feature_extractor is not None:
+            feature_extractor = feature_extractor.to(device)
+        batch_transforms = {}
+        batch_spectrogram_transforms = {}
+        for phase in ["train", "valid"]:
+            batch_transforms[phase] = get_batch_transforms(config, phase)
+            if batch_transforms[phase] is not None:
+                batch_transforms[phase] = batch_transforms[phase].to(device)
+            batch_spectrogram_transforms[phase] = get_batch_spectrogram_transforms(config, phase)
+            if batch_spectrogram_transforms[phase] is not None:
+                batch_spectrogram_transforms[phase] = batch_spectrogram_transforms[phase].to(device)
 
         ema_model = AveragedModel(
             model,
@@ -379,4 +439,7 @@ if __name__ == "__main__":
               main_metric=global_params["main_metric"],
               epochs=global_params["num_epochs"],
               input_key=global_params["input_key"],
-              input_target_key=global_params["input_target_key"])
+              input_target_key=global_params["input_target_key"],
+              feature_extractor=feature_extractor,
+              batch_transforms=batch_transforms,
+              batch_spectrogram_transforms=batch_spectrogram_transforms)
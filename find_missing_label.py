@@ -1,42 +1,17 @@
 import json
-import re
 
-import numpy as np
 import pandas as pd
 
 from pathlib import Path
 
 from fastprogress import progress_bar
 
-from src.dataset import NAME2CODE, BIRD_CODE, SCINAME2CODE
+from src.dataset import BIRD_CODE, get_label_matrix
+from src.storage import get_event_matrix, read_events
 
 
 def create_ground_truth(train: pd.DataFrame):
-    labels = np.zeros((len(train), 264), dtype=int)
-    for i, row in progress_bar(train.iterrows(), total=len(train)):
-        ebird_code = BIRD_CODE[row.ebird_code]
-        labels[i, ebird_code] = 1
-
-        secondary_labels = eval(row.secondary_labels)
-        for sl in secondary_labels:
-            if NAME2CODE.get(sl) is not None:
-                second_code = NAME2CODE[sl]
-                labels[i, BIRD_CODE[second_code]] = 1
-
-        background = row["background"]
-        if isinstance(background, str):
-            academic_names = re.findall("\((.*>)\)", background)
-            academic_names = list(
-                filter(
-                    lambda x: x is not None,
-                    map(
-                        lambda x: SCINAME2CODE.get(x),
-                        academic_names
-                    )
-                )
-            )
-            for bl in academic_names:
-                labels[i, BIRD_CODE[bl]] = 1
+    labels = get_label_matrix(train, background=True).astype(int)
     columns = list(BIRD_CODE.keys())
     index = train["filename"].map(lambda x: x.replace(".mp3", ".wav")).values
     labels_df = pd.DataFrame(labels, index=index, columns=columns)
@@ -48,9 +23,15 @@ if __name__ == "__main__":
     THRESHOLD = 0.9
 
     train = pd.read_csv(DATA_DIR / "train.csv")
-    annotation = pd.read_csv("output/sed/000_Stage1/PANNsAtt_sed.csv")
-
-    clipwise_labels = annotation.groupby("filename").max()
+    # events of sed.py, as a csv or an event store directory (globals.event_store)
+    annotation_path = Path("output/sed/000_Stage1/PANNsAtt_sed_th0.7.csv")
+    if annotation_path.with_suffix("").is_dir():
+        annotation = read_events(annotation_path.with_suffix(""))
+    else:
+        annotation = pd.read_csv(annotation_path)
+
+    # 1 for the species with at least one event in the recording
+    clipwise_labels = get_event_matrix(annotation, list(BIRD_CODE.keys()))
     gt_labels = create_ground_truth(train)
 
     indices = set(clipwise_labels.index.values.tolist())
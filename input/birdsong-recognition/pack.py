@@ -0,0 +1,91 @@
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from pathlib import Path
+from joblib import delayed, Parallel
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from src.storage import get_shard_name  # noqa
+
+
+def get_lengths(df: pd.DataFrame, audio_dir: Path):
+    lengths = []
+    srs = []
+    for _, row in df.iterrows():
+        path = audio_dir / row.ebird_code / row.resampled_filename
+        if path.exists():
+            info = sf.info(str(path))
+            lengths.append(info.frames)
+            srs.append(info.samplerate)
+        else:
+            lengths.append(-1)
+            srs.append(-1)
+    return lengths, srs
+
+
+def write_shard(index: pd.DataFrame, audio_dir: Path, out_dir: Path, shard_id: int):
+    shard_index = index[index["shard"] == shard_id]
+    total = int((shard_index["offset"] + shard_index["length"]).max())
+    shard = np.lib.format.open_memmap(
+        out_dir / get_shard_name(shard_id), mode="w+", dtype=np.int16, shape=(total, ))
+    for _, row in shard_index.iterrows():
+        y, _ = sf.read(audio_dir / row.ebird_code / row.resampled_filename, dtype="int16")
+        shard[row.offset:row.offset + row.length] = y
+    shard.flush()
+    del shard
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio_dir", default="train_audio_resampled")
+    parser.add_argument("--out_dir", default="train_audio_packed")
+    parser.add_argument("--csv", nargs="+", default=["train.csv", "train_extended.csv"])
+    parser.add_argument("--shard_size", default=2 ** 31, type=int,
+                        help="maximum number of int16 samples in a shard")
+    parser.add_argument("--n_jobs", default=12, type=int)
+    args = parser.parse_args()
+
+    audio_dir = Path(args.audio_dir)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+
+    dfs = [pd.read_csv(path) for path in args.csv if Path(path).exists()]
+    index = pd.concat(dfs, axis=0, sort=False)[["ebird_code", "resampled_filename"]]
+    index = index.drop_duplicates().reset_index(drop=True)
+
+    splits = np.array_split(np.arange(len(index)), args.n_jobs)
+    results = Parallel(
+        n_jobs=args.n_jobs,
+        verbose=10)(delayed(get_lengths)(index.iloc[split], audio_dir) for split in splits)
+    index["length"] = np.concatenate([np.asarray(lengths, dtype=np.int64) for lengths, _ in results])
+    index["sr"] = np.concatenate([np.asarray(srs, dtype=np.int64) for _, srs in results])
+
+    missing = index["length"] < 0
+    if missing.any():
+        print(f"{missing.sum()} files not found in {audio_dir}, skipped")
+    index = index[~missing].reset_index(drop=True)
+
+    shards = []
+    offsets = []
+    shard_id = 0
+    offset = 0
+    for length in index["length"].values:
+        if offset > 0 and offset + length > args.shard_size:
+            shard_id += 1
+            offset = 0
+        shards.append(shard_id)
+        offsets.append(offset)
+        offset += length
+    index["shard"] = shards
+    index["offset"] = offsets
+
+    Parallel(
+        n_jobs=args.n_jobs,
+        verbose=10)(delayed(write_shard)(index, audio_dir, out_dir, i) for i in range(shard_id + 1))
+
+    index.to_csv(out_dir / "index.csv", index=False)
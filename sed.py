@@ -11,6 +11,114 @@ from pathlib import Path
 
 from fastprogress import progress_bar
 
+from src.inference import find_events, predict_files, predict_files_cached, predict_stream, run_pinned
+from src.storage import EventStoreWriter
+
+
+# PANNsSedDataset splits recordings into 5 second clips and the framewise
+# output of PANNs has 100 frames per second
+CLIP_DURATION = 5.0
+FRAME_DURATION = 0.01
+INV_BIRD_CODE = np.array([dataset.INV_BIRD_CODE[i] for i in range(len(dataset.INV_BIRD_CODE))])
+
+
+def get_events(thresholded: np.ndarray,
+               targets: np.ndarray,
+               wav_names: np.ndarray,
+               chunk_ids: np.ndarray,
+               min_duration=0.0,
+               merge_gap=0.0):
+    """
+    Events of the target classes of each clip of a batch, where clips may
+    come from different recordings.
+    """
+    target_indices = np.flatnonzero(targets.any(axis=0))
+    clip_ids, class_ids, onsets, offsets = find_events(
+        thresholded, target_indices,
+        min_frames=int(round(min_duration / FRAME_DURATION)),
+        max_gap_frames=int(round(merge_gap / FRAME_DURATION)))
+    keep = targets[clip_ids, class_ids] == 1
+    clip_ids = clip_ids[keep]
+    class_ids = class_ids[keep]
+
+    clip_times = CLIP_DURATION * chunk_ids[clip_ids]
+    return pd.DataFrame({
+        "filename": wav_names[clip_ids],
+        "ebird_code": INV_BIRD_CODE[class_ids],
+        "onset": FRAME_DURATION * onsets[keep] + clip_times,
+        "offset": FRAME_DURATION * offsets[keep] + clip_times
+    })
+
+
+def write_events(job: dict):
+    """
+    Predict the events of `job["df"]` with the checkpoint `job["weights"]`
+    and append them to `job["save_path"]`, or to the `job["part"]` part of
+    the event store `job["save_path"]` if `globals.event_store` is set.
+    """
+    config = job["config"]
+    args = job["args"]
+    save_path = job["save_path"]
+
+    loader = C.get_sed_inference_loader(job["df"], job["datadir"], config, job["num_workers"])
+    model = models.get_model_for_inference(config, job["weights"])
+
+    if not torch.cuda.is_available():
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda")
+        model.to(device)
+    model.eval()
+
+    progress = progress_bar if job["progress"] else iter
+    if config["globals"].get("streaming", False):
+        # chunks are read and predicted lazily, memory does not depend on
+        # the length of the recordings
+        val_dataset = loader.dataset
+        batches = (
+            (outputs["framewise_output"], val_dataset.labels[file_ids],
+             val_dataset.wav_names[file_ids], chunk_ids)
+            for file_ids, chunk_ids, outputs in predict_stream(
+                val_dataset, model, device, batch_size=32, output_keys=["framewise_output"],
+                indices=progress(range(len(val_dataset)))))
+    else:
+        cache = C.get_prediction_cache(config)
+        if cache is None:
+            files = predict_files(
+                progress(loader), model, device, batch_size=32, output_keys=["framewise_output"])
+        else:
+            # only the recordings whose outputs are not cached for this
+            # checkpoint and config are predicted, so that reruns with new
+            # post-processing parameters skip the model
+            keys = C.get_prediction_keys(cache, loader.dataset, config, job["weights"], ["framewise_output"])
+            files = predict_files_cached(
+                loader.dataset,
+                lambda indices: C.get_sed_inference_loader(
+                    job["df"].iloc[indices].reset_index(drop=True), job["datadir"], config, job["num_workers"]),
+                model, device, cache, keys, batch_size=32, output_keys=["framewise_output"],
+                indices=progress(range(len(loader.dataset))))
+        batches = (
+            (outputs["framewise_output"],
+             np.repeat(file["targets"][None], len(outputs["framewise_output"]), axis=0),
+             np.full(len(outputs["framewise_output"]), file["wav_name"]),
+             np.arange(len(outputs["framewise_output"])))
+            for file, outputs in files)
+
+    event_store = config["globals"].get("event_store", False)
+    if event_store:
+        writer = EventStoreWriter(save_path, job["part"])
+    for framewise_output, targets, wav_names, chunk_ids in batches:
+        thresholded = framewise_output >= args.threshold
+        events = get_events(thresholded, targets, wav_names, chunk_ids,
+                            args.min_duration, args.merge_gap)
+        if event_store:
+            writer.append(events)
+        else:
+            events.to_csv(save_path, mode="a", header=False, index=False)
+    if event_store:
+        writer.close()
+    return save_path
+
 
 if __name__ == "__main__":
     args = utils.get_sed_parser().parse_args()
@@ -22,95 +130,67 @@ if __name__ == "__main__":
     output_dir.mkdir(exist_ok=True, parents=True)
 
     utils.set_seed(global_params["seed"])
-    device = C.get_device(global_params["device"])
 
     df, datadir = C.get_metadata(config)
     splitter = C.get_split(config)
 
+    save_filename = global_params["save_path"].replace(".csv", "")
+    save_filename += f"_th{args.threshold}" + ".csv"
+    save_path = output_dir / save_filename
+
+    # with `n_processes` > 1, folds (split into `shards_per_fold` shards of
+    # recordings) are predicted by a pool of processes pinned to disjoint
+    # cores, each writing a part which is appended to the csv in fold order.
+    # With `event_store`, events go to one part of an event store directory
+    # per fold / shard instead, which needs no merge
+    n_processes = global_params.get("n_processes", 1)
+    n_shards = global_params.get("shards_per_fold", 1) if n_processes > 1 else 1
+    event_store = global_params.get("event_store", False)
+    if event_store:
+        save_path = save_path.with_suffix("")
+
+    utils.freeze_gc()
+    jobs = []
     for i, (_, val_idx) in enumerate(splitter.split(df, y=df["ebird_code"])):
         if i not in global_params["folds"]:
             continue
 
         val_df = df.loc[val_idx, :].reset_index(drop=True)
-        loader = C.get_sed_inference_loader(val_df, datadir, config)
-        model = models.get_model_for_inference(config,
-                                               global_params["weights"][i])
-
-        if not torch.cuda.is_available():
-            device = torch.device("cpu")
-        else:
-            device = torch.device("cuda")
-            model.to(device)
-        model.eval()
-
-        estimated_event_list = []
-        for batch in progress_bar(loader):
-            waveform = batch["waveform"]
-            ebird_code = batch["ebird_code"][0]
-            wav_name = batch["wav_name"][0]
-            target = batch["targets"].detach().cpu().numpy()[0]
-            global_time = 0.0
-            if waveform.ndim == 3:
-                waveform = waveform.squeeze(0)
-
-            batch_size = 32
-            whole_size = waveform.size(0)
-            if whole_size % batch_size == 0:
-                n_iter = whole_size // batch_size
+        for k, shard_idx in enumerate(np.array_split(np.arange(len(val_df)), n_shards)):
+            if event_store or n_processes <= 1:
+                job_save_path = save_path
             else:
-                n_iter = whole_size // batch_size + 1
-
-            for index in range(n_iter):
-                iter_batch = waveform[index * batch_size:(index + 1) * batch_size]
-                if iter_batch.ndim == 1:
-                    iter_batch = iter_batch.unsqueeze(0)
-                iter_batch = iter_batch.to(device)
-                with torch.no_grad():
-                    prediction = model(iter_batch)
-                    framewise_output = prediction["framewise_output"].detach(
-                    ).cpu().numpy()
-
-                thresholded = framewise_output >= args.threshold
-                target_indices = np.argwhere(target).reshape(-1)
-                for short_clip in thresholded:
-                    for target_idx in target_indices:
-                        if short_clip[:, target_idx].mean() == 0:
-                            pass
-                        else:
-                            detected = np.argwhere(
-                                short_clip[:, target_idx]).reshape(-1)
-                            head_idx = 0
-                            tail_idx = 0
-                            while True:
-                                if (tail_idx + 1 == len(detected)) or (
-                                        detected[tail_idx + 1] -
-                                        detected[tail_idx] != 1):
-                                    onset = 0.01 * detected[head_idx] + global_time
-                                    offset = 0.01 * detected[tail_idx] + global_time
-                                    estimated_event = {
-                                        "filename": wav_name,
-                                        "ebird_code": dataset.INV_BIRD_CODE[target_idx],
-                                        "onset": onset,
-                                        "offset": offset
-                                    }
-                                    estimated_event_list.append(estimated_event)
-                                    head_idx = tail_idx + 1
-                                    tail_idx = tail_idx + 1
-                                    if head_idx > len(detected):
-                                        break
-                                else:
-                                    tail_idx = tail_idx + 1
-                    global_time += 5.0
-
-        estimated_event_df = pd.DataFrame(estimated_event_list)
-        save_filename = global_params["save_path"].replace(".csv", "")
-        save_filename += f"_th{args.threshold}" + ".csv"
-        save_path = output_dir / save_filename
-        if save_path.exists():
-            event_level_labels = pd.read_csv(save_path)
-            estimated_event_df = pd.concat(
-                [event_level_labels, estimated_event_df], axis=0,
-                sort=False).reset_index(drop=True)
-            estimated_event_df.to_csv(save_path, index=False)
-        else:
-            estimated_event_df.to_csv(save_path, index=False)
+                job_save_path = output_dir / f"{save_path.stem}.fold{i}.shard{k}.part"
+            jobs.append({
+                "config": config,
+                "args": args,
+                "df": val_df.iloc[shard_idx].reset_index(drop=True),
+                "datadir": datadir,
+                "weights": global_params["weights"][i],
+                "save_path": job_save_path,
+                "part": f"fold{i}" if n_shards == 1 else f"fold{i}_shard{k}",
+                "num_workers": 8 if n_processes <= 1 else 0,
+                "progress": n_processes <= 1
+            })
+
+    # events are appended to the csv batch by batch
+    if not event_store and not save_path.exists():
+        pd.DataFrame(columns=["filename", "ebird_code", "onset", "offset"]).to_csv(
+            save_path, index=False)
+
+    if n_processes <= 1:
+        for job in jobs:
+            write_events(job)
+    elif event_store:
+        run_pinned(write_events, jobs, n_processes)
+    else:
+        for job in jobs:
+            # parts are appended to, drop the ones of an interrupted run
+            if job["save_path"].exists():
+                job["save_path"].unlink()
+        parts = run_pinned(write_events, jobs, n_processes)
+        with open(save_path, "a") as f:
+            for part in parts:
+                if part.exists():
+                    f.write(part.read_text())
+                    part.unlink()
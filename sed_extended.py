@@ -1,17 +1,57 @@
 import json
-import math
+import os
+import socket
 
 import numpy as np
 import torch
 
 import src.configuration as C
 import src.dataset as dataset
-import src.model as models
+import src.models as models
 import src.utils as utils
 
 from pathlib import Path
 from fastprogress import progress_bar
 
+from src.inference import aggregate_segmentwise_outputs, predict_files, stream_soft_labels
+from src.jobs import claim_shards, get_shard_ids, merge_manifests
+from src.storage import AsyncSoftLabelWriter
+
+
+def get_additional_labels(target: np.ndarray, clipwise_label: np.ndarray):
+    """
+    Classes other than the label of a single labelled recording which the
+    ensemble is confident about.
+    """
+    if target.sum() == 1:
+        gt_label = set(np.argwhere(target)[0].tolist())
+        found = set(np.argwhere(clipwise_label > 0.9).reshape(-1))
+        if found - gt_label:
+            found_ = list(found - gt_label)
+            return [dataset.INV_BIRD_CODE[i] for i in found_]
+    return []
+
+
+def predict_clipwise(df, datadir, config, ensemble, device, writer):
+    """
+    Write the soft labels of the recordings of `df` to `writer` and yield
+    (file, clipwise label) of each of them.
+    """
+    loader = C.get_sed_inference_loader(df, datadir, config)
+    if config["globals"].get("streaming", False):
+        # soft labels are written as the chunks are predicted, only their
+        # running max over segments is kept for each recording
+        yield from stream_soft_labels(loader.dataset, ensemble, device, writer, batch_size=32,
+                                      indices=progress_bar(range(len(loader.dataset))))
+    else:
+        for file, outputs in predict_files(progress_bar(loader), ensemble, device,
+                                           batch_size=32, output_keys=["segmentwise_output"]):
+            concatenated_soft_labels = aggregate_segmentwise_outputs(
+                outputs["segmentwise_output"], file["duration"], file["period"], file["hop"],
+                config["dataset"].get("overlap_aggregation", "mean"))
+            writer.append(file["wav_name"], concatenated_soft_labels)
+            yield file, concatenated_soft_labels.max(axis=0)
+
 
 if __name__ == "__main__":
     args = utils.get_parser().parse_args()
@@ -24,83 +64,68 @@ if __name__ == "__main__":
 
     utils.set_seed(global_params["seed"])
 
-    device = C.get_device(global_params["device"])
-
     _, datadir = C.get_metadata(config)
     df = C.get_additional_metadata(config)
+    utils.freeze_gc()
 
-    loader = C.get_sed_inference_loader(df, datadir, config)
-    models_dict = {}
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    for i in range(len(global_params["weights"])):
-        models_dict[i] = models.get_model_for_inference(config,
-                                                        global_params["weights"][i])
-        models_dict[i].to(device)
-        models_dict[i].eval()
-
-    additional_labels_extended = {}
-    for batch in progress_bar(loader):
-        soft_labels = []
-        if "waveform" in batch.keys():
-            tensor = batch["waveform"]
-        else:
-            tensor = batch["image"]
-        wav_name = batch["wav_name"][0]
-        target = batch["targets"].detach().cpu().numpy()[0]
-        duration = batch["duration"].detach().cpu().numpy()[0]
-        period = batch["period"].detach().cpu().numpy()[0]
-        global_time = 0.0
-        if tensor.ndim == 3 and "waveform" in batch.keys():
-            tensor = tensor.squeeze(0)
-        elif tensor.ndim == 5 and "image" in batch.keys():
-            tensor = tensor.squeeze(0)
-        batch_size = 32
-        whole_size = batch.size(0)
-
-        if whole_size % batch_size == 0:
-            n_iter = whole_size // batch_size
+    # fold models (possibly of different architectures) averaged on the
+    # device, optionally run concurrently by `ensemble_threads` threads
+    ensemble = models.get_ensemble_for_inference(
+        config, n_threads=global_params.get("ensemble_threads", 1))
+    ensemble.to(device)
+    ensemble.eval()
+
+    save_path = output_dir.parent / "additional_labels_extended.json"
+    n_shards = global_params.get("n_shards")
+    if n_shards is None:
+        writer = C.get_soft_label_writer(config, output_dir, Path(args.config).stem)
+        additional_labels_extended = {}
+        for file, clipwise_label in predict_clipwise(df, datadir, config, ensemble, device, writer):
+            found = get_additional_labels(file["targets"], clipwise_label)
+            if found:
+                additional_labels_extended[file["wav_name"]] = found
+        writer.close()
+        if isinstance(writer, AsyncSoftLabelWriter):
+            print(writer.summary())
+    else:
+        # resumable job: recordings are split into `n_shards` deterministic
+        # shards. Processes (possibly on several nodes sharing output_dir)
+        # take the shards which are neither done nor locked and skip the
+        # recordings already in the manifest of the shard. The last one to
+        # finish merges the manifests into the json. `n_shards` is recorded in
+        # the job dir, a job is only resumed with the same value
+        job_dir = output_dir / "jobs" / Path(args.config).stem
+        shard_ids = get_shard_ids(df["resampled_filename"].values, n_shards)
+        for shard, manifest, lock in claim_shards(job_dir, n_shards, global_params.get("lock_timeout", 3600.0)):
+            shard_df = df[(shard_ids == shard) & ~df["resampled_filename"].isin(manifest.completed)]
+            shard_df = shard_df.reset_index(drop=True)
+            writer = C.get_soft_label_writer(
+                config, output_dir, f"{Path(args.config).stem}_shard{shard:04d}", append=True)
+            # with a background writer, recordings are only recorded in the
+            # manifest once their soft labels are on disk
+            pending = {}
+            for file, clipwise_label in predict_clipwise(shard_df, datadir, config, ensemble, device, writer):
+                pending[file["wav_name"]] = get_additional_labels(file["targets"], clipwise_label)
+                written = writer.pop_completed() if isinstance(writer, AsyncSoftLabelWriter) else [file["wav_name"]]
+                for wav_name in written:
+                    manifest.record(wav_name, pending.pop(wav_name))
+                lock.touch()
+            writer.close()
+            for wav_name, labels in pending.items():
+                manifest.record(wav_name, labels)
+            manifest.finish()
+
+        results = merge_manifests(job_dir, n_shards)
+        if results is None:
+            print(f"Some shards of {job_dir} are not done yet, the last worker merges the labels")
+            additional_labels_extended = None
         else:
-            n_iter = whole_size // batch_size + 1
-
-        for index in range(n_iter):
-            iter_batch = batch[index * batch_size:(index + 1) * batch_size]
-            if iter_batch.ndim == 1:
-                iter_batch = iter_batch.unsqueeze(0)
-            elif iter_batch.ndim == 3:
-                iter_batch = iter_batch.unsqueeze(0)
-            iter_batch = iter_batch.to(device)
-
-            predictions = []
-            with torch.no_grad():
-                for model in models_dict.values():
-                    prediction = model(iter_batch)
-                    segmentwise_output = prediction["segmentwise_output"].detach(
-                        ).cpu().numpy()
-                    predictions.append(segmentwise_output)
-
-            segmentwise_outputs = np.mean(predictions, axis=0)
-            for short_clip in segmentwise_outputs:
-                if duration - global_time < period:
-                    remain_seconds = duration - global_time
-                    sec_per_segment = period / len(short_clip)
-                    remain_index = math.ceil(remain_seconds / sec_per_segment)
-                    short_clip = short_clip[:remain_index]
-                if len(short_clip) > 0:
-                    soft_labels.append(short_clip.astype(np.float16))
-                global_time += period
-
-        concatenated_soft_labels = np.concatenate(soft_labels, axis=0)
-        filepath = output_dir / (wav_name + ".npy")
-        np.save(filepath, concatenated_soft_labels)
-
-        if target.sum() == 1:
-            clipwise_label = concatenated_soft_labels.max(axis=0)
-            gt_label = set(np.argwhere(target)[0].tolist())
-            found = set(np.argwhere(clipwise_label > 0.9).reshape(-1))
-            if found - gt_label:
-                found_ = list(found - gt_label)
-                found_ = [dataset.INV_BIRD_CODE[i] for i in found_]
-                additional_labels_extended[wav_name] = found_
-
-    with open(output_dir.parent / "additional_labels_extended.json", "w") as f:
-        json.dump(additional_labels_extended, f)
+            additional_labels_extended = {key: value for key, value in results.items() if value}
+
+    if additional_labels_extended is not None:
+        # concurrent workers may all merge, each writes its own tmp file
+        tmp_path = save_path.with_suffix(f".json.{socket.gethostname()}_{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(additional_labels_extended, f)
+        tmp_path.replace(save_path)
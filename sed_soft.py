@@ -1,5 +1,3 @@
-import math
-
 import numpy as np
 import torch
 
@@ -10,6 +8,65 @@ import src.utils as utils
 from pathlib import Path
 from fastprogress import progress_bar
 
+from src.inference import (aggregate_segmentwise_outputs, predict_files, predict_files_cached, run_pinned,
+                           stream_soft_labels)
+from src.storage import AsyncSoftLabelWriter
+
+
+def write_soft_labels(job: dict):
+    """
+    Predict the soft labels of `job["df"]` with the checkpoint
+    `job["weights"]` and write them to `job["output_dir"]`.
+    """
+    config = job["config"]
+    global_params = config["globals"]
+    output_dir = job["output_dir"]
+
+    loader = C.get_sed_inference_loader(job["df"], job["datadir"], config, job["num_workers"])
+    model = models.get_model_for_inference(config, job["weights"])
+    if not torch.cuda.is_available():
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda")
+        model.to(device)
+    model.eval()
+
+    writer = C.get_soft_label_writer(config, output_dir, job["part"])
+
+    progress = progress_bar if job["progress"] else iter
+    if global_params.get("streaming", False):
+        # chunks are read and predicted lazily and the soft labels are
+        # written as they come, memory does not depend on the length of
+        # the recordings
+        val_dataset = loader.dataset
+        for _ in stream_soft_labels(val_dataset, model, device, writer, batch_size=32,
+                                    indices=progress(range(len(val_dataset)))):
+            pass
+    else:
+        cache = C.get_prediction_cache(config)
+        if cache is None:
+            files = predict_files(progress(loader), model, device,
+                                  batch_size=32, output_keys=["segmentwise_output"])
+        else:
+            # only the recordings whose outputs are not cached for this
+            # checkpoint and config are predicted
+            keys = C.get_prediction_keys(cache, loader.dataset, config, job["weights"], ["segmentwise_output"])
+            files = predict_files_cached(
+                loader.dataset,
+                lambda indices: C.get_sed_inference_loader(
+                    job["df"].iloc[indices].reset_index(drop=True), job["datadir"], config, job["num_workers"]),
+                model, device, cache, keys, batch_size=32, output_keys=["segmentwise_output"],
+                indices=progress(range(len(loader.dataset))))
+        for file, outputs in files:
+            concatenated_soft_labels = aggregate_segmentwise_outputs(
+                outputs["segmentwise_output"], file["duration"], file["period"], file["hop"],
+                config["dataset"].get("overlap_aggregation", "mean"))
+            writer.append(file["wav_name"], concatenated_soft_labels)
+
+    writer.close()
+    if isinstance(writer, AsyncSoftLabelWriter):
+        print(f"{job['part']}: {writer.summary()}")
+
 
 if __name__ == "__main__":
     args = utils.get_parser().parse_args()
@@ -22,69 +79,39 @@ if __name__ == "__main__":
 
     utils.set_seed(global_params["seed"])
 
-    device = C.get_device(global_params["device"])
-
     df, datadir = C.get_metadata(config)
-    splitter = C.get_splitter(config)
+    splitter = C.get_split(config)
 
+    # with `n_processes` > 1, folds (split into `shards_per_fold` shards of
+    # recordings) are predicted by a pool of processes pinned to disjoint
+    # cores. Every recording has its own .npy file and every shard its own
+    # part of the store, so the outputs are the ones of a serial run
+    n_processes = global_params.get("n_processes", 1)
+    n_shards = global_params.get("shards_per_fold", 1) if n_processes > 1 else 1
+
+    utils.freeze_gc()
+    jobs = []
     for i, (_, val_idx) in enumerate(splitter.split(df, y=df["ebird_code"])):
         if i not in global_params["folds"]:
             continue
         val_df = df.loc[val_idx, :].reset_index(drop=True)
-        loader = C.get_sed_inference_loader(val_df, datadir, config)
-        model = models.get_model_for_inference(config,
-                                               global_params["weights"][i])
-        if not torch.cuda.is_available():
-            device = torch.device("cpu")
-        else:
-            device = torch.device("cuda")
-            model.to(device)
-        model.eval()
-
-        for batch in progress_bar(loader):
-            soft_labels = []
-            if "waveform" in batch.keys():
-                tensor = batch["waveform"]
-            else:
-                tensor = batch["image"]
-            wav_name = batch["wav_name"][0]
-            duration = batch["duration"].detach().cpu().numpy()[0]
-            period = batch["period"].detach().cpu().numpy()[0]
-            global_time = 0.0
-            if tensor.ndim == 3 and "waveform" in batch.keys():
-                tensor = tensor.squeeze(0)
-            elif tensor.ndim == 5 and "image" in batch.keys():
-                tensor = tensor.squeeze(0)
-            batch_size = 32
-            whole_size = tensor.size(0)
-
-            if whole_size % batch_size == 0:
-                n_iter = whole_size // batch_size
-            else:
-                n_iter = whole_size // batch_size + 1
-
-            for index in range(n_iter):
-                iter_batch = tensor[index * batch_size:(index + 1) * batch_size]
-                if iter_batch.ndim == 1:
-                    iter_batch = iter_batch.unsqueeze(0)
-                elif iter_batch.ndim == 3:
-                    iter_batch = iter_batch.unsqueeze(0)
-                iter_batch = iter_batch.to(device)
-
-                with torch.no_grad():
-                    prediction = model(iter_batch)
-                    segmentwise_output = prediction["segmentwise_output"].detach(
-                        ).cpu().numpy()
-                for short_clip in segmentwise_output:
-                    if duration - global_time < period:
-                        remain_seconds = duration - global_time
-                        sec_per_segment = period / len(short_clip)
-                        remain_index = math.ceil(remain_seconds / sec_per_segment)
-                        short_clip = short_clip[:remain_index]
-                    if len(short_clip) > 0:
-                        soft_labels.append(short_clip.astype(np.float16))
-                    global_time += period
-
-        concatenated_soft_labels = np.concatenate(soft_labels, axis=0)
-        filepath = output_dir / (wav_name + ".npy")
-        np.save(filepath, concatenated_soft_labels)
+        for k, shard_idx in enumerate(np.array_split(np.arange(len(val_df)), n_shards)):
+            part = f"{Path(args.config).stem}_fold{i}"
+            if n_shards > 1:
+                part += f"_shard{k}"
+            jobs.append({
+                "config": config,
+                "df": val_df.iloc[shard_idx].reset_index(drop=True),
+                "datadir": datadir,
+                "weights": global_params["weights"][i],
+                "output_dir": output_dir,
+                "part": part,
+                "num_workers": 8 if n_processes <= 1 else 0,
+                "progress": n_processes <= 1
+            })
+
+    if n_processes <= 1:
+        for job in jobs:
+            write_soft_labels(job)
+    else:
+        run_pinned(write_soft_labels, jobs, n_processes)
@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 from typing import List
 
@@ -200,6 +201,46 @@ class mAPCallback(Callback):
             state.epoch_metrics["train_epoch_" + self.prefix] = score
 
 
+class BatchTransformCallback(Callback):
+    """
+    Apply the batched waveform transforms of each phase
+    (`get_batch_transforms`) to `state.input[input_key]` before the
+    forward pass.
+    """
+    def __init__(self, transforms: dict, input_key: str = "waveform"):
+        super().__init__(CallbackOrder.Internal)
+
+        self.transforms = transforms
+        self.input_key = input_key
+
+    def on_batch_start(self, state: State):
+        transforms = self.transforms.get("valid" if state.is_valid_loader else "train")
+        if transforms is not None:
+            with torch.no_grad():
+                state.input[self.input_key] = transforms(state.input[self.input_key])
+
+
+class FeatureExtractorCallback(Callback):
+    """
+    Replace the raw waveforms of the batch (`dataset.params.batch_feature_extraction`)
+    with the images of the batched feature extractor (`MelPcenExtractor`)
+    before the forward pass, the catalyst counterpart of `get_input` of
+    ema.py. Callbacks of the same order run in the order they are given,
+    so batch waveform transforms go before this one and batch spectrogram
+    transforms after.
+    """
+    def __init__(self, feature_extractor, input_key: str = "image", waveform_key: str = "waveform"):
+        super().__init__(CallbackOrder.Internal)
+
+        self.feature_extractor = feature_extractor
+        self.input_key = input_key
+        self.waveform_key = waveform_key
+
+    def on_batch_start(self, state: State):
+        with torch.no_grad():
+            state.input[self.input_key] = self.feature_extractor(state.input[self.waveform_key])
+
+
 def get_callbacks(config: dict):
     required_callbacks = config.get("callbacks")
     if required_callbacks is None:
@@ -14,7 +14,11 @@ from pathlib import Path
 from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
 
 from src.criterion import ImprovedPANNsLoss, ImprovedFocalLoss  # noqa
-from src.transforms import (get_transforms, get_waveform_transforms,
+from src.features import FeatureCache, MelPcenExtractor
+from src.inference import collate_chunks
+from src.storage import (AsyncSoftLabelWriter, PackedAudioStore, PredictionCache, SoftLabelNpyWriter,
+                         SoftLabelStore, SoftLabelStoreWriter, get_hash, get_prediction_key, read_events)
+from src.transforms import (get_feature_changing_transforms, get_transforms, get_waveform_transforms,
                             get_spectrogram_transforms)
 
 
@@ -94,6 +98,7 @@ def get_loader(df: pd.DataFrame,
         melspectrogram_parameters = dataset_config["params"]["melspectrogram_parameters"]
         pcen_parameters = dataset_config["params"]["pcen_parameters"]
         period = dataset_config["params"]["period"][phase]
+        feature_cache = get_feature_cache(config, waveform_transforms)
         loader_config = config["loader"][phase]
 
         dataset = datasets.MultiChannelDataset(
@@ -104,7 +109,9 @@ def get_loader(df: pd.DataFrame,
             spectrogram_transforms=spectrogram_transforms,
             melspectrogram_parameters=melspectrogram_parameters,
             pcen_parameters=pcen_parameters,
-            period=period)
+            period=period,
+            feature_cache=feature_cache,
+            return_waveform=dataset_config["params"].get("batch_feature_extraction", False))
     elif dataset_config["name"] == "LabelCorrectionDataset":
         waveform_transforms = get_waveform_transforms(config, phase)
         spectrogram_transforms = get_spectrogram_transforms(config, phase)
@@ -113,7 +120,10 @@ def get_loader(df: pd.DataFrame,
         period = dataset_config["params"]["period"][phase]
         n_segments = dataset_config["params"]["n_segments"][phase]
         soft_label_dir = Path(dataset_config["params"]["soft_label_dir"])
+        if dataset_config["params"].get("soft_label_store", False):
+            soft_label_dir = SoftLabelStore(soft_label_dir)
         threshold = dataset_config["params"].get("threshold", 0.5)
+        feature_cache = get_feature_cache(config, waveform_transforms)
         loader_config = config["loader"][phase]
 
         dataset = datasets.LabelCorrectionDataset(
@@ -127,7 +137,9 @@ def get_loader(df: pd.DataFrame,
             pcen_parameters=pcen_parameters,
             period=period,
             n_segments=n_segments,
-            threshold=threshold)
+            threshold=threshold,
+            feature_cache=feature_cache,
+            return_waveform=dataset_config["params"].get("batch_feature_extraction", False))
     else:
         raise NotImplementedError
 
@@ -135,7 +147,103 @@ def get_loader(df: pd.DataFrame,
     return loader
 
 
-def get_sed_inference_loader(df: pd.DataFrame, datadir: Path, config: dict):
+def get_feature_cache(config: dict, waveform_transforms=None):
+    """
+    Cached features replace the whole waveform pipeline, so a cache is
+    refused for a phase with waveform transforms instead of silently
+    dropping them. Constant gains (`Normalize`, `RandomVolume`) are
+    allowed and skipped, the normalized channels do not depend on them.
+
+    With a cache, spectrogram transforms operate on the cropped uint8
+    normalized channels instead of the float image computed from the crop.
+    """
+    dataset_params = config["dataset"]["params"]
+    if dataset_params.get("feature_cache_dir") is None:
+        return None
+    changing = get_feature_changing_transforms(waveform_transforms)
+    if changing:
+        raise ValueError(f"dataset.params.feature_cache_dir cannot be used with the waveform transforms {changing} "
+                         "(`transforms` of the config), remove them for this phase or disable the cache")
+
+    return FeatureCache(
+        Path(dataset_params["feature_cache_dir"]),
+        melspectrogram_parameters=dataset_params["melspectrogram_parameters"],
+        pcen_parameters=dataset_params["pcen_parameters"],
+        sr=dataset_params.get("sr", 32000))
+
+
+def get_prediction_cache(config: dict):
+    global_params = config["globals"]
+    if global_params.get("prediction_cache_dir") is None:
+        return None
+
+    max_gb = global_params.get("prediction_cache_max_gb")
+    return PredictionCache(
+        Path(global_params["prediction_cache_dir"]),
+        max_bytes=None if max_gb is None else int(max_gb * 2 ** 30))
+
+
+# options of `dataset` applied to the raw outputs (sed_soft.py, sed_extended.py)
+POST_PROCESSING_DATASET_KEYS = ["overlap_aggregation"]
+
+
+def get_prediction_keys(cache: PredictionCache, dataset, config: dict, weights: str, output_keys: list):
+    """
+    `PredictionCache` key of each recording of a SED inference dataset for
+    the checkpoint `weights`. Everything which changes the raw outputs
+    (dataset, model, transforms) is part of the key, post-processing
+    parameters (thresholds, `POST_PROCESSING_DATASET_KEYS`) are not.
+    """
+    checkpoint_hash = cache.hash_file(Path(weights))
+    dataset_config = config.get("dataset")
+    if dataset_config is not None:
+        dataset_config = {
+            key: value for key, value in dataset_config.items() if key not in POST_PROCESSING_DATASET_KEYS
+        }
+    config_hash = get_hash(dataset_config, config["model"], config.get("transforms"), output_keys)
+    keys = []
+    for ebird_code, wav_name in zip(dataset.ebird_codes, dataset.wav_names):
+        source = datasets.get_sed_source(dataset.datadir, dataset.denoised_audio_dir, ebird_code, wav_name)
+        keys.append(get_prediction_key(cache.hash_audio(source, ebird_code, wav_name), checkpoint_hash, config_hash))
+    return keys
+
+
+def get_soft_label_writer(config: dict, output_dir: Path, part: str, append=False):
+    """
+    `SoftLabelStoreWriter` part (`globals.soft_label_store`) or
+    `SoftLabelNpyWriter`. With `globals.writer_threads` > 0 the writes are
+    done by an `AsyncSoftLabelWriter` with that many threads (one store
+    part per thread) and queues of `globals.writer_queue` arrays.
+    """
+    global_params = config["globals"]
+    n_threads = global_params.get("writer_threads", 0)
+
+    def make_writer(thread_index: int):
+        if global_params.get("soft_label_store", False):
+            part_ = part if n_threads <= 1 else f"{part}_w{thread_index}"
+            return SoftLabelStoreWriter(output_dir, part=part_, append=append)
+        return SoftLabelNpyWriter(output_dir)
+
+    if n_threads == 0:
+        return make_writer(0)
+    return AsyncSoftLabelWriter(make_writer, n_threads, global_params.get("writer_queue", 16))
+
+
+def get_feature_extractor(config: dict):
+    dataset_config = config["dataset"]
+    dataset_params = dataset_config["params"]
+    if not dataset_params.get("batch_feature_extraction", False):
+        return None
+
+    return MelPcenExtractor(
+        sr=dataset_params.get("sr", 32000),
+        melspectrogram_parameters=dataset_params["melspectrogram_parameters"],
+        pcen_parameters=dataset_params["pcen_parameters"],
+        img_size=dataset_config["img_size"],
+        chunk_size=dataset_params.get("feature_chunk_size"))
+
+
+def get_sed_inference_loader(df: pd.DataFrame, datadir: Path, config: dict, num_workers=8):
     transforms = get_transforms(config, "train")
     if config["data"].get("denoised_audio_dir") is not None:
         denoised_audio_dir = Path(config["data"]["denoised_audio_dir"])
@@ -148,36 +256,68 @@ def get_sed_inference_loader(df: pd.DataFrame, datadir: Path, config: dict):
         melspectrogram_parameters = config["dataset"]["melspectrogram_parameters"]
         pcen_parameters = config["dataset"]["pcen_parameters"]
         period = config["dataset"]["period"]
+        hop = config["dataset"].get("hop")
         dataset = datasets.ChannelsSedDataset(
             df, datadir, transforms, denoised_audio_dir,
             melspectrogram_parameters,
-            pcen_parameters, period)
+            pcen_parameters, period, hop)
     elif config["dataset"]["name"] == "NormalizedChannelsSedDataset":
         melspectrogram_parameters = config["dataset"]["melspectrogram_parameters"]
         pcen_parameters = config["dataset"]["pcen_parameters"]
         period = config["dataset"]["period"]
+        hop = config["dataset"].get("hop")
         dataset = datasets.NormalizedChannelsSedDataset(
             df, datadir, transforms, denoised_audio_dir,
             melspectrogram_parameters,
-            pcen_parameters, period)
+            pcen_parameters, period, hop)
+    # each item holds all the chunks of a recording, `predict_files` packs
+    # them into model batches across recordings
     loader = data.DataLoader(
-        dataset, batch_size=1, shuffle=False, num_workers=8)
+        dataset, batch_size=1, shuffle=False, num_workers=num_workers, collate_fn=collate_chunks)
     return loader
 
 
+def drop_skipped_rows(train: pd.DataFrame, skip_rows: list):
+    skipped = set()
+    for row in skip_rows:
+        row = row.replace("\n", "")
+        if row == "":
+            continue
+        ebird_code = row.split("/")[1]
+        filename = row.split("/")[2]
+        skipped.add((ebird_code, filename))
+
+    keys = pd.MultiIndex.from_arrays([train["ebird_code"], train["filename"]])
+    return train[~keys.isin(list(skipped))].reset_index(drop=True)
+
+
+def apply_additional_labels(train: pd.DataFrame, additional_labels: dict):
+    INV_NAME2CODE = {v: k for k, v in datasets.NAME2CODE.items()}
+    overrides = pd.DataFrame({
+        "resampled_filename": list(additional_labels.keys()),
+        "additional_labels": [
+            str([INV_NAME2CODE[name] for name in labels])
+            for labels in additional_labels.values()
+        ]
+    })
+    merged = train[["resampled_filename"]].merge(
+        overrides, on="resampled_filename", how="left")
+
+    # only the first row of a duplicated filename gets the labels
+    mask = merged["additional_labels"].notnull().values & \
+        ~train["resampled_filename"].duplicated().values
+    train = train.copy()
+    train.loc[mask, "secondary_labels"] = merged.loc[mask, "additional_labels"].values
+    return train
+
+
 def get_additional_metadata(config: dict):
     data_config = config["data"]
     train_e = pd.read_csv(data_config["train_extended_df_path"])
     if data_config.get("additional_labels_extended") is not None:
         with open(data_config["additional_labels_extended"]) as f:
             additional_labels = json.load(f)
-
-        INV_NAME2CODE = {v: k for k, v in datasets.NAME2CODE.items()}
-        for filename in additional_labels:
-            labels = additional_labels[filename]
-            labels = [INV_NAME2CODE[name] for name in labels]
-            row_idx = train_e.query(f"resampled_filename == '{filename}'").index.values[0]
-            train_e.loc[row_idx, "secondary_labels"] = str(labels)
+        train_e = apply_additional_labels(train_e, additional_labels)
 
     return train_e
 
@@ -188,26 +328,17 @@ def get_metadata(config: dict):
         skip_rows = f.readlines()
 
     train = pd.read_csv(data_config["train_df_path"])
-    audio_path = Path(data_config["train_audio_path"])
+    if data_config.get("packed_audio_path") is not None:
+        audio_path = PackedAudioStore(Path(data_config["packed_audio_path"]))
+    else:
+        audio_path = Path(data_config["train_audio_path"])
 
-    for row in skip_rows:
-        row = row.replace("\n", "")
-        ebird_code = row.split("/")[1]
-        filename = row.split("/")[2]
-        train = train[~((train["ebird_code"] == ebird_code) &
-                        (train["filename"] == filename))]
-        train = train.reset_index(drop=True)
+    train = drop_skipped_rows(train, skip_rows)
 
     if data_config.get("additional_labels") is not None:
         with open(data_config["additional_labels"]) as f:
             additional_labels = json.load(f)
-
-        INV_NAME2CODE = {v: k for k, v in datasets.NAME2CODE.items()}
-        for filename in additional_labels:
-            labels = additional_labels[filename]
-            labels = [INV_NAME2CODE[name] for name in labels]
-            row_idx = train.query(f"resampled_filename == '{filename}'").index.values[0]
-            train.loc[row_idx, "secondary_labels"] = str(labels)
+        train = apply_additional_labels(train, additional_labels)
 
     if data_config.get("north_america", False):
         train = train[train.country.isin(["United States", "Canada", "Mexico"])].reset_index(drop=True)
@@ -228,5 +359,9 @@ def get_metadata(config: dict):
 def get_event_level_labels(config: dict):
     data_config = config["data"]
 
-    event_level_labels = pd.read_csv(data_config["event_level_labels"])
+    # either a csv of sed.py or an event store directory (globals.event_store)
+    if Path(data_config["event_level_labels"]).is_dir():
+        event_level_labels = read_events(data_config["event_level_labels"])
+    else:
+        event_level_labels = pd.read_csv(data_config["event_level_labels"])
     return event_level_labels
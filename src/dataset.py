@@ -1,5 +1,6 @@
-import cv2
-import librosa
+import ast
+import re
+
 import numpy as np
 import pandas as pd
 import soundfile as sf
@@ -7,6 +8,11 @@ import torch.utils.data as data
 
 from pathlib import Path
 
+from src.features import MelPcenFeaturizer, frame_windows, resize_image, resize_images
+from src.storage import (SoftLabelStore, get_audio_info, get_info, iterate_audio,
+                         load_soft_label, read_audio)
+from src.transforms import get_feature_changing_transforms
+
 
 BIRD_CODE = {
     'aldfly': 0, 'ameavo': 1, 'amebit': 2, 'amecro': 3, 'amegfi': 4,
@@ -471,45 +477,118 @@ SCINAME2CODE = {
 PERIOD = 5
 
 
+def get_label_matrix(df: pd.DataFrame, background=False):
+    """
+    Multi-hot labels of `ebird_code` and `secondary_labels` (and species
+    found in `background` if `background=True`) for every row of `df`.
+    Each distinct `secondary_labels` string is parsed only once.
+
+    Returns
+    -------
+    labels: numpy.ndarray
+        uint8 array of shape (len(df), len(BIRD_CODE))
+    """
+    labels = np.zeros((len(df), len(BIRD_CODE)), dtype=np.uint8)
+    rows = np.arange(len(df))
+    labels[rows, df["ebird_code"].map(BIRD_CODE).values] = 1
+
+    parsed = {}
+    for i, secondary_labels in enumerate(df["secondary_labels"].values):
+        if secondary_labels not in parsed:
+            codes = [
+                BIRD_CODE[NAME2CODE[name]]
+                for name in ast.literal_eval(secondary_labels)
+                if NAME2CODE.get(name) is not None
+            ]
+            parsed[secondary_labels] = codes
+        labels[i, parsed[secondary_labels]] = 1
+
+    if background:
+        for i, background_ in enumerate(df["background"].values):
+            if isinstance(background_, str):
+                academic_names = re.findall(r"\((.*>)\)", background_)
+                for name in academic_names:
+                    if SCINAME2CODE.get(name) is not None:
+                        labels[i, BIRD_CODE[SCINAME2CODE[name]]] = 1
+    return labels
+
+
+def get_sed_source(datadir: Path, denoised_audio_dir: Path, ebird_code: str, wav_name: str):
+    if denoised_audio_dir is not None and (denoised_audio_dir / ebird_code / wav_name).exists():
+        return denoised_audio_dir
+    return datadir
+
+
+def iterate_sed_chunks(datadir: Path, ebird_code: str, wav_name: str, period: int,
+                       transforms=None, normalize=False):
+    """
+    Yield `period` second chunks of a recording (the last one zero padded)
+    together with the sampling rate, reading one chunk at a time. With
+    `normalize`, the chunks are divided by the max amplitude of the whole
+    recording, which takes an additional pass over the file.
+    """
+    _, sr = get_info(datadir, ebird_code, wav_name)
+    chunk_length = sr * period
+    max_vol = 0.0
+    if normalize:
+        for y in iterate_audio(datadir, ebird_code, wav_name, chunk_length):
+            if transforms:
+                y = transforms(y)
+            max_vol = max(max_vol, np.abs(y).max())
+
+    for y in iterate_audio(datadir, ebird_code, wav_name, chunk_length):
+        if transforms:
+            y = transforms(y)
+        if max_vol > 0:
+            y = y / max_vol
+        chunk = np.zeros(chunk_length, dtype=np.float32)
+        chunk[:len(y)] = y
+        yield chunk, sr
+
+
 class PANNsMultiLabelDataset(data.Dataset):
     def __init__(self, df: pd.DataFrame, datadir: Path, transforms=None, period=30):
-        self.df = df
+        # fixed-width numpy strings instead of the DataFrame, so that forked
+        # workers do not copy the metadata pages through refcount updates
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.transforms = transforms
         self.period = period
+        self.lengths, self.srs = get_audio_info(datadir, df)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
-        y, sr = sf.read(self.datadir / ebird_code / wav_name)
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
 
-        len_y = len(y)
-        effective_length = sr * self.period
+        len_y = self.lengths[idx]
+        effective_length = self.srs[idx] * self.period
         if len_y < effective_length:
+            y, sr = read_audio(self.datadir, ebird_code, wav_name)
             new_y = np.zeros(effective_length, dtype=y.dtype)
             start = np.random.randint(effective_length - len_y)
             new_y[start:start + len_y] = y
             y = new_y.astype(np.float32)
+            offset = -start
         elif len_y > effective_length:
             start = np.random.randint(len_y - effective_length)
-            y = y[start:start + effective_length].astype(np.float32)
+            y, sr = read_audio(self.datadir, ebird_code, wav_name,
+                               start, start + effective_length)
+            y = y.astype(np.float32)
+            offset = start
         else:
+            y, sr = read_audio(self.datadir, ebird_code, wav_name)
             y = y.astype(np.float32)
+            offset = 0
 
         if self.transforms:
-            y = self.transforms(y)
+            y = self.transforms(y, ebird_code=ebird_code, wav_name=wav_name, offset=offset)
 
-        labels = np.zeros(len(BIRD_CODE), dtype=int)
-        labels[BIRD_CODE[ebird_code]] = 1
-        for second_label in secondary_labels:
-            if NAME2CODE.get(second_label) is not None:
-                second_code = NAME2CODE[second_label]
-                labels[BIRD_CODE[second_code]] = 1
+        labels = self.labels[idx].astype(int)
 
         return {
             "waveform": y,
@@ -520,7 +599,9 @@ class PANNsMultiLabelDataset(data.Dataset):
 class PANNsSedDataset(data.Dataset):
     def __init__(self, df: pd.DataFrame, datadir: Path, transforms=None,
                  denoised_audio_dir=None):
-        self.df = df
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.transforms = transforms
         self.denoised_audio_dir = denoised_audio_dir
@@ -530,54 +611,30 @@ class PANNsSedDataset(data.Dataset):
             self.use_denoised = False
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
 
         if self.use_denoised:
             path = self.denoised_audio_dir / ebird_code / wav_name
             if path.exists():
                 y, sr = sf.read(path)
             else:
-                y, sr = sf.read(self.datadir / ebird_code / wav_name)
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
         else:
-            y, sr = sf.read(self.datadir / ebird_code / wav_name)
+            y, sr = read_audio(self.datadir, ebird_code, wav_name)
 
         duration = len(y) / sr
         if self.transforms:
             y = self.transforms(y)
 
-        audios = []
-        len_y = len(y)
-        start = 0
-        end = sr * 5
-        while len_y > start:
-            y_batch = y[start:end].astype(np.float32)
-            if len(y_batch) != (sr * 5):
-                y_batch_large = np.zeros(sr * 5, dtype=y_batch.dtype)
-                y_batch_large[:len(y_batch)] = y_batch
-                audios.append(y_batch_large)
-                break
-            start = end
-            end = end + sr * 5
-
-            audios.append(y_batch)
-        audios = np.asarray(audios).astype(np.float32)
-
-        labels = np.zeros(len(BIRD_CODE), dtype=int)
-        labels[BIRD_CODE[ebird_code]] = 1
-        for secondary_label in secondary_labels:
-            code = NAME2CODE.get(secondary_label)
-            if code is None:
-                continue
-            else:
-                labels[
-                    BIRD_CODE[code]
-                ] = 1
+        # 5 second chunks, the last one zero padded, as a view of the padded
+        # recording
+        audios = frame_windows(y, sr * 5)
+
+        labels = self.labels[idx].astype(int)
 
         return {
             "waveform": audios,
@@ -587,13 +644,40 @@ class PANNsSedDataset(data.Dataset):
             "duration": duration
         }
 
+    def get_file(self, idx: int):
+        """
+        Fields of `__getitem__` other than the waveform, without reading the audio.
+        """
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        length, sr = get_info(datadir, ebird_code, wav_name)
+        return {
+            "targets": self.labels[idx].astype(int),
+            "ebird_code": ebird_code,
+            "wav_name": wav_name,
+            "duration": length / sr
+        }
+
+    def iter_chunks(self, idx: int):
+        """
+        Chunks of `__getitem__` one by one, with a single chunk in memory.
+        """
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        for chunk, _ in iterate_sed_chunks(datadir, ebird_code, wav_name, 5, self.transforms):
+            yield chunk
+
 
 class NormalizedChannelsSedDataset(data.Dataset):
     def __init__(self, df: pd.DataFrame, datadir: Path, transforms=None,
                  denoised_audio_dir=None, melspectrogram_parameters={},
                  pcen_parameters={},
-                 period=30):
-        self.df = df
+                 period=30, hop=None):
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.transforms = transforms
         self.denoised_audio_dir = denoised_audio_dir
@@ -603,93 +687,44 @@ class NormalizedChannelsSedDataset(data.Dataset):
             self.use_denoised = False
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
+        self.featurizer = MelPcenFeaturizer(melspectrogram_parameters, pcen_parameters)
         self.period = period
+        # windows start every `hop` seconds, they overlap when hop < period
+        self.hop = period if hop is None else hop
+        if self.hop > period:
+            raise ValueError(f"hop ({self.hop}) must not exceed period ({period}), audio between windows is skipped")
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
 
         if self.use_denoised:
             path = self.denoised_audio_dir / ebird_code / wav_name
             if path.exists():
                 y, sr = sf.read(path)
             else:
-                y, sr = sf.read(self.datadir / ebird_code / wav_name)
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
         else:
-            y, sr = sf.read(self.datadir / ebird_code / wav_name)
+            y, sr = read_audio(self.datadir, ebird_code, wav_name)
 
         duration = len(y) / sr
         if self.transforms:
             y = self.transforms(y)
 
-        images = []
-        len_y = len(y)
         if len(y) > 0:
             max_vol = np.abs(y).max()
             if max_vol > 0:
-                y = np.asfortranarray(y * 1 / max_vol)
-        start = 0
-        end = sr * self.period
-        while len_y > start:
-            y_batch = y[start:end].astype(np.float32)
-            if len(y_batch) != (sr * self.period):
-                y_batch_large = np.zeros(sr * self.period, dtype=y_batch.dtype)
-                y_batch_large[:len(y_batch)] = y_batch
-
-                melspec = librosa.feature.melspectrogram(
-                    y_batch_large, sr=sr, **self.melspectrogram_parameters)
-                pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-                clean_mel = librosa.power_to_db(melspec ** 1.5)
-                melspec = librosa.power_to_db(melspec)
-
-                norm_melspec = normalize_melspec(melspec)
-                norm_pcen = normalize_melspec(pcen)
-                norm_clean_mel = normalize_melspec(clean_mel)
-                image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
-
-                height, width, _ = image.shape
-                image = cv2.resize(image, (int(width * 224 / height), 224))
-                image = np.moveaxis(image, 2, 0)
-                image = (image / 255.0).astype(np.float32)
-
-                images.append(image)
-                break
-            start = end
-            end = end + sr * self.period
-
-            melspec = librosa.feature.melspectrogram(
-                y_batch, sr=sr, **self.melspectrogram_parameters)
-            pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-            clean_mel = librosa.power_to_db(melspec ** 1.5)
-            melspec = librosa.power_to_db(melspec)
-
-            norm_melspec = normalize_melspec(melspec)
-            norm_pcen = normalize_melspec(pcen)
-            norm_clean_mel = normalize_melspec(clean_mel)
-            image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
-            height, width, _ = image.shape
-            image = cv2.resize(image, (int(width * 224 / height), 224))
-            image = np.moveaxis(image, 2, 0)
-            image = (image / 255.0).astype(np.float32)
-
-            images.append(image)
-        images = np.asarray(images).astype(np.float32)
-
-        labels = np.zeros(len(BIRD_CODE), dtype=int)
-        labels[BIRD_CODE[ebird_code]] = 1
-        for secondary_label in secondary_labels:
-            code = NAME2CODE.get(secondary_label)
-            if code is None:
-                continue
-            else:
-                labels[
-                    BIRD_CODE[code]
-                ] = 1
+                y = y / max_vol
+        # features are computed once over the whole recording and split into
+        # `period` second chunks every `hop` seconds, the last one zero padded
+        images = self.featurizer.chunks(
+            np.asarray(y, dtype=np.float32), sr, sr * self.period, int(sr * self.hop))
+        images = resize_images(images, 224)
+
+        labels = self.labels[idx].astype(int)
 
         return {
             "image": images,
@@ -697,16 +732,50 @@ class NormalizedChannelsSedDataset(data.Dataset):
             "ebird_code": ebird_code,
             "wav_name": wav_name,
             "duration": duration,
-            "period": self.period
+            "period": self.period,
+            "hop": self.hop
         }
 
+    def get_file(self, idx: int):
+        """
+        Fields of `__getitem__` other than the image, without reading the audio.
+        """
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        length, sr = get_info(datadir, ebird_code, wav_name)
+        return {
+            "targets": self.labels[idx].astype(int),
+            "ebird_code": ebird_code,
+            "wav_name": wav_name,
+            "duration": length / sr,
+            "period": self.period,
+            "hop": self.hop
+        }
+
+    def iter_chunks(self, idx: int):
+        """
+        Images of `__getitem__` one by one, computed chunk by chunk.
+        Only non-overlapping chunks (hop == period) are supported.
+        """
+        if self.hop != self.period:
+            raise ValueError("iter_chunks does not support overlapping chunks, set hop to period")
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        for chunk, sr in iterate_sed_chunks(datadir, ebird_code, wav_name, self.period,
+                                            self.transforms, normalize=True):
+            yield resize_image(self.featurizer(chunk, sr), 224)
+
 
 class ChannelsSedDataset(data.Dataset):
     def __init__(self, df: pd.DataFrame, datadir: Path, transforms=None,
                  denoised_audio_dir=None, melspectrogram_parameters={},
                  pcen_parameters={},
-                 period=30):
-        self.df = df
+                 period=30, hop=None):
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.transforms = transforms
         self.denoised_audio_dir = denoised_audio_dir
@@ -716,89 +785,40 @@ class ChannelsSedDataset(data.Dataset):
             self.use_denoised = False
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
+        self.featurizer = MelPcenFeaturizer(melspectrogram_parameters, pcen_parameters)
         self.period = period
+        # windows start every `hop` seconds, they overlap when hop < period
+        self.hop = period if hop is None else hop
+        if self.hop > period:
+            raise ValueError(f"hop ({self.hop}) must not exceed period ({period}), audio between windows is skipped")
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
 
         if self.use_denoised:
             path = self.denoised_audio_dir / ebird_code / wav_name
             if path.exists():
                 y, sr = sf.read(path)
             else:
-                y, sr = sf.read(self.datadir / ebird_code / wav_name)
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
         else:
-            y, sr = sf.read(self.datadir / ebird_code / wav_name)
+            y, sr = read_audio(self.datadir, ebird_code, wav_name)
 
         duration = len(y) / sr
         if self.transforms:
             y = self.transforms(y)
 
-        images = []
-        len_y = len(y)
-        start = 0
-        end = sr * self.period
-        while len_y > start:
-            y_batch = y[start:end].astype(np.float32)
-            if len(y_batch) != (sr * self.period):
-                y_batch_large = np.zeros(sr * self.period, dtype=y_batch.dtype)
-                y_batch_large[:len(y_batch)] = y_batch
-
-                melspec = librosa.feature.melspectrogram(
-                    y_batch_large, sr=sr, **self.melspectrogram_parameters)
-                pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-                clean_mel = librosa.power_to_db(melspec ** 1.5)
-                melspec = librosa.power_to_db(melspec)
-
-                norm_melspec = normalize_melspec(melspec)
-                norm_pcen = normalize_melspec(pcen)
-                norm_clean_mel = normalize_melspec(clean_mel)
-                image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
-
-                height, width, _ = image.shape
-                image = cv2.resize(image, (int(width * 224 / height), 224))
-                image = np.moveaxis(image, 2, 0)
-                image = (image / 255.0).astype(np.float32)
-
-                images.append(image)
-                break
-            start = end
-            end = end + sr * self.period
-
-            melspec = librosa.feature.melspectrogram(
-                y_batch, sr=sr, **self.melspectrogram_parameters)
-            pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-            clean_mel = librosa.power_to_db(melspec ** 1.5)
-            melspec = librosa.power_to_db(melspec)
-
-            norm_melspec = normalize_melspec(melspec)
-            norm_pcen = normalize_melspec(pcen)
-            norm_clean_mel = normalize_melspec(clean_mel)
-            image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
-            height, width, _ = image.shape
-            image = cv2.resize(image, (int(width * 224 / height), 224))
-            image = np.moveaxis(image, 2, 0)
-            image = (image / 255.0).astype(np.float32)
-
-            images.append(image)
-        images = np.asarray(images).astype(np.float32)
-
-        labels = np.zeros(len(BIRD_CODE), dtype=int)
-        labels[BIRD_CODE[ebird_code]] = 1
-        for secondary_label in secondary_labels:
-            code = NAME2CODE.get(secondary_label)
-            if code is None:
-                continue
-            else:
-                labels[
-                    BIRD_CODE[code]
-                ] = 1
+        # features are computed once over the whole recording and split into
+        # `period` second chunks every `hop` seconds, the last one zero padded
+        images = self.featurizer.chunks(
+            np.asarray(y, dtype=np.float32), sr, sr * self.period, int(sr * self.hop))
+        images = resize_images(images, 224)
+
+        labels = self.labels[idx].astype(int)
 
         return {
             "image": images,
@@ -806,9 +826,41 @@ class ChannelsSedDataset(data.Dataset):
             "ebird_code": ebird_code,
             "wav_name": wav_name,
             "duration": duration,
-            "period": self.period
+            "period": self.period,
+            "hop": self.hop
+        }
+
+    def get_file(self, idx: int):
+        """
+        Fields of `__getitem__` other than the image, without reading the audio.
+        """
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        length, sr = get_info(datadir, ebird_code, wav_name)
+        return {
+            "targets": self.labels[idx].astype(int),
+            "ebird_code": ebird_code,
+            "wav_name": wav_name,
+            "duration": length / sr,
+            "period": self.period,
+            "hop": self.hop
         }
 
+    def iter_chunks(self, idx: int):
+        """
+        Images of `__getitem__` one by one, computed chunk by chunk.
+        Only non-overlapping chunks (hop == period) are supported.
+        """
+        if self.hop != self.period:
+            raise ValueError("iter_chunks does not support overlapping chunks, set hop to period")
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+        datadir = get_sed_source(self.datadir, self.denoised_audio_dir, ebird_code, wav_name)
+        for chunk, sr in iterate_sed_chunks(datadir, ebird_code, wav_name, self.period,
+                                            self.transforms):
+            yield resize_image(self.featurizer(chunk, sr), 224)
+
 
 class MultiChannelDataset(data.Dataset):
     def __init__(self,
@@ -819,77 +871,114 @@ class MultiChannelDataset(data.Dataset):
                  spectrogram_transforms=None,
                  melspectrogram_parameters={},
                  pcen_parameters={},
-                 period=30):
-        self.df = df
+                 period=30,
+                 feature_cache=None,
+                 return_waveform=False):
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.img_size = img_size
         self.waveform_transforms = waveform_transforms
         self.spectrogram_transforms = spectrogram_transforms
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
+        self.featurizer = MelPcenFeaturizer(melspectrogram_parameters, pcen_parameters)
         self.period = period
+        self.feature_cache = feature_cache
+        self.return_waveform = return_waveform
+        if return_waveform and feature_cache is not None:
+            raise ValueError("return_waveform cannot be used together with feature_cache")
+        if get_feature_changing_transforms(waveform_transforms) and feature_cache is not None:
+            raise ValueError("waveform transforms cannot be applied to cached features, "
+                             "remove them or disable feature_cache")
+        if feature_cache is None:
+            self.lengths, self.srs = get_audio_info(datadir, df)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
-
-        y, sr = sf.read(self.datadir / ebird_code / wav_name)
-
-        len_y = len(y)
-        effective_length = sr * self.period
-        if len_y < effective_length:
-            new_y = np.zeros(effective_length, dtype=y.dtype)
-            start = np.random.randint(effective_length - len_y)
-            new_y[start:start + len_y] = y
-            y = new_y.astype(np.float32)
-        elif len_y > effective_length:
-            start = np.random.randint(len_y - effective_length)
-            y = y[start:start + effective_length].astype(np.float32)
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+
+        if self.feature_cache is not None:
+            cached_image = self.feature_cache.load(ebird_code, wav_name)
+            if cached_image is None:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                cached_image = self.feature_cache.save(ebird_code, wav_name, y, sr)
+
+            len_y = self.feature_cache.num_samples(cached_image)
+            effective_length = self.feature_cache.sr * self.period
+            if len_y < effective_length:
+                start = -np.random.randint(effective_length - len_y)
+            elif len_y > effective_length:
+                start = np.random.randint(len_y - effective_length)
+            else:
+                start = 0
+            image = self._crop_cached_image(cached_image, start, effective_length)
         else:
-            y = y.astype(np.float32)
-
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y)
-
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
-
-        if self.spectrogram_transforms:
-            melspec = self.spectrogram_transforms(image=melspec)["image"]
-            pcen = self.spectrogram_transforms(image=pcen)["image"]
-            clean_mel = self.spectrogram_transforms(image=clean_mel)["image"]
+            len_y = self.lengths[idx]
+            effective_length = self.srs[idx] * self.period
+            if len_y < effective_length:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                new_y = np.zeros(effective_length, dtype=y.dtype)
+                start = np.random.randint(effective_length - len_y)
+                new_y[start:start + len_y] = y
+                y = new_y.astype(np.float32)
+                offset = -start
+            elif len_y > effective_length:
+                start = np.random.randint(len_y - effective_length)
+                y, sr = read_audio(self.datadir, ebird_code, wav_name,
+                                   start, start + effective_length)
+                y = y.astype(np.float32)
+                offset = start
+            else:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                y = y.astype(np.float32)
+                offset = 0
+            source = {"ebird_code": ebird_code, "wav_name": wav_name, "offset": offset}
+            if not self.return_waveform:
+                image = self._get_image(y, sr, **source)
+
+        if self.return_waveform:
+            # the image is computed for the whole batch by `MelPcenExtractor`,
+            # spectrogram transforms are not applied in this case
+            inputs = {"waveform": self._get_waveform(y, **source)}
         else:
-            pass
-
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
-
-        height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+            inputs = {"image": resize_image(image, self.img_size)}
 
-        labels = np.zeros(len(BIRD_CODE), dtype=int)
-        labels[BIRD_CODE[ebird_code]] = 1
-        for second_label in secondary_labels:
-            if NAME2CODE.get(second_label) is not None:
-                second_code = NAME2CODE[second_label]
-                labels[BIRD_CODE[second_code]] = 1
+        labels = self.labels[idx].astype(int)
 
         return {
-            "image": image,
+            **inputs,
             "targets": labels
         }
 
+    def _get_waveform(self, y: np.ndarray, **params):
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y, **params)
+        return y.astype(np.float32)
+
+    def _get_image(self, y: np.ndarray, sr: int, **params):
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y, **params)
+
+        return self.featurizer(y, sr, self.spectrogram_transforms)
+
+    def _crop_cached_image(self, image: np.ndarray, start: int, length: int):
+        # spectrogram transforms see the normalized uint8 channels of the crop
+        # instead of the dB / PCEN values, so e.g. `TimeFreqMasking` fills
+        # with the min of the normalized crop (usually 0) instead of the min
+        # of the spectrogram
+        image = self.feature_cache.crop(image, start, length)
+        if self.spectrogram_transforms:
+            image = np.stack([
+                self.spectrogram_transforms(image=image[..., i])["image"]
+                for i in range(image.shape[-1])
+            ], axis=-1)
+        return image
+
 
 class LabelCorrectionDataset(data.Dataset):
     def __init__(self,
@@ -903,8 +992,12 @@ class LabelCorrectionDataset(data.Dataset):
                  pcen_parameters={},
                  period=30,
                  n_segments=103,
-                 threshold=0.5):
-        self.df = df
+                 threshold=0.5,
+                 feature_cache=None,
+                 return_waveform=False):
+        self.wav_names = df["resampled_filename"].values.astype(str)
+        self.ebird_codes = df["ebird_code"].values.astype(str)
+        self.labels = get_label_matrix(df)
         self.datadir = datadir
         self.soft_label_dir = soft_label_dir
         self.img_size = img_size
@@ -912,70 +1005,95 @@ class LabelCorrectionDataset(data.Dataset):
         self.spectrogram_transforms = spectrogram_transforms
         self.melspectrogram_parameters = melspectrogram_parameters
         self.pcen_parameters = pcen_parameters
+        self.featurizer = MelPcenFeaturizer(melspectrogram_parameters, pcen_parameters)
         self.period = period
         self.n_segments = n_segments
         self.threshold = threshold
+        self.feature_cache = feature_cache
+        self.return_waveform = return_waveform
+        if return_waveform and feature_cache is not None:
+            raise ValueError("return_waveform cannot be used together with feature_cache")
+        if get_feature_changing_transforms(waveform_transforms) and feature_cache is not None:
+            raise ValueError("waveform transforms cannot be applied to cached features, "
+                             "remove them or disable feature_cache")
+        if feature_cache is None:
+            self.lengths, self.srs = get_audio_info(datadir, df)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.wav_names)
 
     def __getitem__(self, idx: int):
-        sample = self.df.loc[idx, :]
-        wav_name = sample["resampled_filename"]
-        ebird_code = sample["ebird_code"]
-        secondary_labels = eval(sample["secondary_labels"])
-
-        y, sr = sf.read(self.datadir / ebird_code / wav_name)
-        soft_label = np.load(self.soft_label_dir / (wav_name + ".npy"))
+        wav_name = self.wav_names[idx]
+        ebird_code = self.ebird_codes[idx]
+
+        if self.feature_cache is not None:
+            cached_image = self.feature_cache.load(ebird_code, wav_name)
+            if cached_image is None:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                cached_image = self.feature_cache.save(ebird_code, wav_name, y, sr)
+            sr = self.feature_cache.sr
+            len_y = self.feature_cache.num_samples(cached_image)
+        else:
+            sr = self.srs[idx]
+            len_y = self.lengths[idx]
 
         sec_per_segment = self.period / self.n_segments
         sec_per_timestep = 1 / sr
         step_per_segment = int(sec_per_segment / sec_per_timestep)
 
-        len_y = len(y)
         effective_length = sr * self.period
         if len_y < effective_length:
-            new_y = np.zeros(effective_length, dtype=y.dtype)
             max_offset = effective_length - len_y
 
             offset_id = np.random.randint(0, (max_offset // step_per_segment) + 1)
             start = offset_id * step_per_segment
-
-            new_y[start:start + len_y] = y
-            y = new_y.astype(np.float32)
         elif len_y > effective_length:
             max_offset = len_y - effective_length
 
             offset_id = np.random.randint(0, (max_offset // step_per_segment) + 1)
             start = offset_id * step_per_segment
-            y = y[start:start + effective_length].astype(np.float32)
         else:
-            y = y.astype(np.float32)
-
-        if self.waveform_transforms:
-            y = self.waveform_transforms(y)
-
-        melspec = librosa.feature.melspectrogram(y, sr=sr, **self.melspectrogram_parameters)
-        pcen = librosa.pcen(melspec, sr=sr, **self.pcen_parameters)
-        clean_mel = librosa.power_to_db(melspec ** 1.5)
-        melspec = librosa.power_to_db(melspec)
+            offset_id = 0
+            start = 0
 
-        if self.spectrogram_transforms:
-            melspec = self.spectrogram_transforms(image=melspec)["image"]
-            pcen = self.spectrogram_transforms(image=pcen)["image"]
-            clean_mel = self.spectrogram_transforms(image=clean_mel)["image"]
+        # only the segments which overlap with the crop are read
+        if len_y < effective_length:
+            soft_label = load_soft_label(
+                self.soft_label_dir, wav_name, 0, self.n_segments - offset_id)
         else:
-            pass
-
-        norm_melspec = normalize_melspec(melspec)
-        norm_pcen = normalize_melspec(pcen)
-        norm_clean_mel = normalize_melspec(clean_mel)
-        image = np.stack([norm_melspec, norm_pcen, norm_clean_mel], axis=-1)
+            soft_label = load_soft_label(
+                self.soft_label_dir, wav_name, offset_id, offset_id + self.n_segments)
 
-        height, width, _ = image.shape
-        image = cv2.resize(image, (int(width * self.img_size / height), self.img_size))
-        image = np.moveaxis(image, 2, 0)
-        image = (image / 255.0).astype(np.float32)
+        if self.feature_cache is not None:
+            if len_y < effective_length:
+                start = -start
+            image = self._crop_cached_image(cached_image, start, effective_length)
+        else:
+            if len_y < effective_length:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                new_y = np.zeros(effective_length, dtype=y.dtype)
+                new_y[start:start + len_y] = y
+                y = new_y.astype(np.float32)
+                offset = -start
+            elif len_y > effective_length:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name,
+                                   start, start + effective_length)
+                y = y.astype(np.float32)
+                offset = start
+            else:
+                y, sr = read_audio(self.datadir, ebird_code, wav_name)
+                y = y.astype(np.float32)
+                offset = 0
+            source = {"ebird_code": ebird_code, "wav_name": wav_name, "offset": offset}
+            if not self.return_waveform:
+                image = self._get_image(y, sr, **source)
+
+        if self.return_waveform:
+            # the image is computed for the whole batch by `MelPcenExtractor`,
+            # spectrogram transforms are not applied in this case
+            inputs = {"waveform": self._get_waveform(y, **source)}
+        else:
+            inputs = {"image": resize_image(image, self.img_size)}
 
         labels = np.zeros([self.n_segments, len(BIRD_CODE)], dtype=np.float32)
 
@@ -986,7 +1104,7 @@ class LabelCorrectionDataset(data.Dataset):
             else:
                 labels[offset_id:offset_id + len(soft_label), :] = soft_label
         elif len_y > effective_length:
-            use_labels = soft_label[offset_id:offset_id + len(labels)]
+            use_labels = soft_label[:len(labels)]
             if len(use_labels) < len(labels):
                 labels[:len(use_labels)] = use_labels
             else:
@@ -999,43 +1117,48 @@ class LabelCorrectionDataset(data.Dataset):
 
         labels = labels.astype(np.float32)
 
-        weak_labels = np.zeros(len(BIRD_CODE), dtype=int)
-        weak_labels[BIRD_CODE[ebird_code]] = 1
-        for second_label in secondary_labels:
-            if NAME2CODE.get(second_label) is not None:
-                second_code = NAME2CODE[second_label]
-                weak_labels[BIRD_CODE[second_code]] = 1
-        weak_labels_soft = labels.max(axis=0)
+        weak_labels = self.labels[idx].astype(int)
+        if isinstance(self.soft_label_dir, SoftLabelStore) and len_y <= effective_length and \
+                self.soft_label_dir.get_length(wav_name) + offset_id <= self.n_segments:
+            # the whole recording is inside the crop
+            weak_labels_soft = self.soft_label_dir.get_clipwise(wav_name).astype(np.float32)
+        else:
+            weak_labels_soft = labels.max(axis=0)
         weak_labels_bin = (weak_labels_soft >= self.threshold).astype(int)
 
         weak_labels = np.logical_and(weak_labels, weak_labels_bin).astype(int)
         weak_sum_target = labels.sum(axis=0)
 
         return {
-            "image": image,
+            **inputs,
             "targets": weak_labels,
             "weak_targets": weak_labels,
             "weak_sum_targets": weak_sum_target
         }
 
+    def _get_waveform(self, y: np.ndarray, **params):
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y, **params)
+        return y.astype(np.float32)
 
-def normalize_melspec(X: np.ndarray):
-    eps = 1e-6
-    mean = X.mean()
-    X = X - mean
-    std = X.std()
-    Xstd = X / (std + eps)
-    norm_min, norm_max = Xstd.min(), Xstd.max()
-    if (norm_max - norm_min) > eps:
-        V = Xstd
-        V[V < norm_min] = norm_min
-        V[V > norm_max] = norm_max
-        V = 255 * (V - norm_min) / (norm_max - norm_min)
-        V = V.astype(np.uint8)
-    else:
-        # Just zero
-        V = np.zeros_like(Xstd, dtype=np.uint8)
-    return V
+    def _get_image(self, y: np.ndarray, sr: int, **params):
+        if self.waveform_transforms:
+            y = self.waveform_transforms(y, **params)
+
+        return self.featurizer(y, sr, self.spectrogram_transforms)
+
+    def _crop_cached_image(self, image: np.ndarray, start: int, length: int):
+        # spectrogram transforms see the normalized uint8 channels of the crop
+        # instead of the dB / PCEN values, so e.g. `TimeFreqMasking` fills
+        # with the min of the normalized crop (usually 0) instead of the min
+        # of the spectrogram
+        image = self.feature_cache.crop(image, start, length)
+        if self.spectrogram_transforms:
+            image = np.stack([
+                self.spectrogram_transforms(image=image[..., i])["image"]
+                for i in range(image.shape[-1])
+            ], axis=-1)
+        return image
 
 
 def mono_to_color(X: np.ndarray,
@@ -0,0 +1,649 @@
+import hashlib
+import json
+import os
+
+import cv2
+import librosa
+import numpy as np
+import scipy.fft
+import scipy.signal
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from pathlib import Path
+
+
+def normalize_melspec(X: np.ndarray):
+    eps = 1e-6
+    mean = X.mean()
+    X = X - mean
+    std = X.std()
+    Xstd = X / (std + eps)
+    norm_min, norm_max = Xstd.min(), Xstd.max()
+    if (norm_max - norm_min) > eps:
+        V = Xstd
+        V[V < norm_min] = norm_min
+        V[V > norm_max] = norm_max
+        V = 255 * (V - norm_min) / (norm_max - norm_min)
+        V = V.astype(np.uint8)
+    else:
+        # Just zero
+        V = np.zeros_like(Xstd, dtype=np.uint8)
+    return V
+
+
+def batch_normalize_melspec(X: np.ndarray):
+    """
+    `normalize_melspec` applied to each X[i] of a (batch_size, height, width) array.
+    """
+    eps = 1e-6
+    axis = tuple(range(1, X.ndim))
+    X = X - X.mean(axis=axis, keepdims=True)
+    Xstd = X / (X.std(axis=axis, keepdims=True) + eps)
+    norm_min = Xstd.min(axis=axis, keepdims=True)
+    norm_range = Xstd.max(axis=axis, keepdims=True) - norm_min
+    valid = norm_range > eps
+    V = 255 * (Xstd - norm_min) / np.where(valid, norm_range, 1)
+    V = V.astype(np.uint8)
+    V[~valid.reshape(-1)] = 0
+    return V
+
+
+def resize_image(image: np.ndarray, img_size=224):
+    """
+    Resize (n_mels, n_frames, 3) uint8 image to the model input of shape
+    (3, img_size, width) in [0, 1].
+    """
+    height, width, _ = image.shape
+    image = cv2.resize(image, (int(width * img_size / height), img_size))
+    image = np.moveaxis(image, 2, 0)
+    return (image / 255.0).astype(np.float32)
+
+
+def resize_images(images: np.ndarray, img_size=224):
+    """
+    `resize_image` for a (batch_size, n_mels, n_frames, 3) uint8 array. The
+    images are stacked along the channel axis, so that a single `cv2.resize`
+    call resizes up to 170 of them.
+
+    Returns
+    -------
+    resized: numpy.ndarray
+        float32 array of shape (batch_size, 3, img_size, width)
+    """
+    batch_size, height, width, n_channels = images.shape
+    new_width = int(width * img_size / height)
+    resized = np.zeros((batch_size, n_channels, img_size, new_width), dtype=np.float32)
+    # OpenCV supports at most 512 channels
+    step = 512 // n_channels
+    for start in range(0, batch_size, step):
+        batch = images[start:start + step]
+        stacked = np.ascontiguousarray(np.moveaxis(batch, 0, 2)).reshape(height, width, -1)
+        stacked = cv2.resize(stacked, (new_width, img_size))
+        stacked = stacked.reshape(img_size, new_width, len(batch), n_channels)
+        resized[start:start + len(batch)] = stacked.transpose(2, 3, 0, 1) / 255.0
+    return resized
+
+
+STFT_PARAMETERS = ["n_fft", "hop_length", "win_length", "window", "center", "pad_mode", "power"]
+PCEN_PARAMETERS = ["hop_length", "gain", "bias", "power", "time_constant", "eps", "b"]
+# `librosa.feature.melspectrogram` and `librosa.pcen` both default to a hop of
+# 512 samples, and the datasets call `librosa.pcen` without `hop_length`
+DEFAULT_HOP_LENGTH = 512
+
+
+def get_n_windows(length: int, window_length: int, hop_length: int):
+    """
+    Number of `window_length` windows starting every `hop_length` samples
+    needed to cover `length` samples.
+    """
+    if length == 0:
+        return 0
+    return 1 + max(0, int(np.ceil((length - window_length) / hop_length)))
+
+
+def frame_windows(y: np.ndarray, window_length: int, hop_length=None):
+    """
+    Windows of `window_length` samples of `y` starting every `hop_length`
+    samples (`window_length` by default), the last one zero padded.
+
+    Only the zero padded copy of `y` is allocated, the windows are a
+    read-only strided view of it, so overlapping windows cost no memory.
+
+    Returns
+    -------
+    windows: numpy.ndarray
+        array of shape (n_windows, window_length)
+    """
+    if hop_length is None:
+        hop_length = window_length
+    n_windows = get_n_windows(len(y), window_length, hop_length)
+    padded = np.zeros(max(0, (n_windows - 1) * hop_length + window_length), dtype=np.float32)
+    padded[:len(y)] = y
+    return np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(n_windows, window_length),
+        strides=(padded.strides[0] * hop_length, padded.strides[0]),
+        writeable=False)
+
+
+def split_melspectrogram_parameters(melspectrogram_parameters: dict):
+    """
+    Split the keyword arguments of `librosa.feature.melspectrogram` into the
+    STFT ones (with the defaults of `librosa.feature.melspectrogram` filled)
+    and those of `librosa.filters.mel`.
+    """
+    stft_parameters = {
+        "n_fft": 2048,
+        "win_length": None,
+        "hop_length": None,
+        "window": "hann",
+        "center": True,
+        "pad_mode": "reflect",
+        "power": 2.0
+    }
+    mel_parameters = {}
+    for key, value in melspectrogram_parameters.items():
+        if key in STFT_PARAMETERS:
+            stft_parameters[key] = value
+        else:
+            mel_parameters[key] = value
+    if stft_parameters["win_length"] is None:
+        stft_parameters["win_length"] = stft_parameters["n_fft"]
+    if stft_parameters["hop_length"] is None:
+        stft_parameters["hop_length"] = DEFAULT_HOP_LENGTH
+    return stft_parameters, mel_parameters
+
+
+def get_pcen_coefficient(sr: int, hop_length: int, time_constant=0.4, b=None):
+    # same smoothing coefficient as `librosa.pcen`
+    if b is not None:
+        return b
+    t_frames = time_constant * sr / float(hop_length)
+    return (np.sqrt(1 + 4 * t_frames ** 2) - 1) / (2 * t_frames ** 2)
+
+
+class MelPcenFeaturizer:
+    """
+    Computes the 3 channel image (log-melspectrogram, PCEN,
+    `power_to_db(melspec ** 1.5)`), each channel normalized to uint8 with
+    `normalize_melspec`, as the datasets compute it with
+    `librosa.feature.melspectrogram(y, sr, **melspectrogram_parameters)`,
+    `librosa.pcen(melspec, sr, **pcen_parameters)` and `librosa.power_to_db`.
+    Like there, the smoothing of PCEN uses the `hop_length` of
+    `pcen_parameters` (512 by default), not the one of the melspectrogram.
+
+    The FFT window and the mel basis (per sampling rate) are built once, the
+    framing and power spectrum buffers are reused between calls of the same
+    length and everything is computed in float32. An instance is not meant
+    to be shared between threads; each DataLoader worker has its own copy.
+    """
+    def __init__(self, melspectrogram_parameters={}, pcen_parameters={}):
+        stft_parameters, self.mel_parameters = split_melspectrogram_parameters(
+            melspectrogram_parameters)
+        self.n_fft = stft_parameters["n_fft"]
+        self.hop_length = stft_parameters["hop_length"]
+        self.center = stft_parameters["center"]
+        self.pad_mode = stft_parameters["pad_mode"]
+        self.power = stft_parameters["power"]
+        window = librosa.filters.get_window(
+            stft_parameters["window"], stft_parameters["win_length"], fftbins=True)
+        self.window = librosa.util.pad_center(window, size=self.n_fft).astype(np.float32)
+
+        self.pcen_parameters = pcen_parameters
+        self.pcen_hop_length = pcen_parameters.get("hop_length", DEFAULT_HOP_LENGTH)
+        # anything but the default `librosa.pcen` options is left to librosa
+        self.use_librosa_pcen = bool(set(pcen_parameters) - set(PCEN_PARAMETERS)) or \
+            pcen_parameters.get("power", 0.5) == 0 or pcen_parameters.get("bias", 2.0) == 0
+
+        self.max_block_frames = 2048
+        self.mel_bases = {}
+        self.buffers = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buffers"] = {}
+        return state
+
+    def _get_buffer(self, name: str, shape: tuple):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.float32)
+            self.buffers[name] = buffer
+        return buffer
+
+    def get_mel_basis(self, sr: int):
+        if sr not in self.mel_bases:
+            self.mel_bases[sr] = librosa.filters.mel(
+                sr=sr, n_fft=self.n_fft, **self.mel_parameters).astype(np.float32)
+        return self.mel_bases[sr]
+
+    def _pad(self, y: np.ndarray):
+        if not self.center:
+            return y
+        pad = self.n_fft // 2
+        padded = self._get_buffer("padded", (len(y) + 2 * pad, ))
+        padded[pad:pad + len(y)] = y
+        if self.pad_mode == "reflect" and len(y) > pad:
+            padded[:pad] = y[pad:0:-1]
+            padded[pad + len(y):] = y[-2:-pad - 2:-1]
+        elif self.pad_mode == "constant":
+            padded[:pad] = 0.0
+            padded[pad + len(y):] = 0.0
+        else:
+            padded[:] = np.pad(y, pad, mode=self.pad_mode)
+        return padded
+
+    def melspectrogram(self, y: np.ndarray, sr: int):
+        y = self._pad(np.ascontiguousarray(y, dtype=np.float32))
+        n_frames = 1 + (len(y) - self.n_fft) // self.hop_length
+        frames = np.lib.stride_tricks.as_strided(
+            y, shape=(n_frames, self.n_fft), strides=(y.strides[0] * self.hop_length, y.strides[0]))
+        mel_basis = self.get_mel_basis(sr)
+        melspec = np.empty((mel_basis.shape[0], n_frames), dtype=np.float32)
+
+        # whole recordings are processed in blocks of frames to bound the buffers
+        block_size = min(n_frames, self.max_block_frames)
+        windowed = self._get_buffer("windowed", (block_size, self.n_fft))
+        power = self._get_buffer("power", (block_size, self.n_fft // 2 + 1))
+        for start in range(0, n_frames, block_size):
+            n = min(block_size, n_frames - start)
+            np.multiply(frames[start:start + n], self.window, out=windowed[:n])
+            spec = scipy.fft.rfft(windowed[:n], axis=1)
+            np.abs(spec, out=power[:n])
+            if self.power != 1:
+                np.power(power[:n], self.power, out=power[:n])
+            np.dot(mel_basis, power[:n].T, out=melspec[:, start:start + n])
+        return melspec
+
+    def pcen(self, S: np.ndarray, sr: int):
+        if self.use_librosa_pcen:
+            return librosa.pcen(S, sr=sr, **self.pcen_parameters)
+
+        gain = self.pcen_parameters.get("gain", 0.98)
+        bias = self.pcen_parameters.get("bias", 2.0)
+        power = self.pcen_parameters.get("power", 0.5)
+        eps = self.pcen_parameters.get("eps", 1e-6)
+        b = get_pcen_coefficient(
+            sr, self.pcen_hop_length,
+            self.pcen_parameters.get("time_constant", 0.4), self.pcen_parameters.get("b"))
+
+        filter_b = np.array([b], dtype=np.float32)
+        filter_a = np.array([1, b - 1], dtype=np.float32)
+        zi = np.empty(S.shape[:-1] + (1, ), dtype=np.float32)
+        zi[:] = scipy.signal.lfilter_zi(filter_b, filter_a)
+        out, _ = scipy.signal.lfilter(filter_b, filter_a, S, zi=zi, axis=-1)
+
+        # smooth = exp(-gain * (log(eps) + log1p(M / eps)))
+        out /= eps
+        np.log1p(out, out=out)
+        out += np.log(eps)
+        out *= -gain
+        np.exp(out, out=out)
+        # bias ** power * expm1(power * log1p(S * smooth / bias))
+        out *= S
+        out /= bias
+        np.log1p(out, out=out)
+        out *= power
+        np.expm1(out, out=out)
+        out *= bias ** power
+        return out
+
+    @staticmethod
+    def power_to_db(S: np.ndarray, amin=1e-10, top_db=80.0):
+        # `librosa.power_to_db` with ref=1.0, overwriting `S`. For
+        # (n_chunks, n_mels, n_frames) input `top_db` is applied per chunk
+        np.maximum(S, amin, out=S)
+        np.log10(S, out=S)
+        S *= 10.0
+        np.maximum(S, S.max(axis=(-2, -1), keepdims=True) - top_db, out=S)
+        return S
+
+    def __call__(self, y: np.ndarray, sr: int, spectrogram_transforms=None):
+        """
+        Returns
+        -------
+        image: numpy.ndarray
+            uint8 image of shape (n_mels, n_frames, 3)
+        """
+        melspec = self.melspectrogram(y, sr)
+        pcen = self.pcen(melspec, sr)
+        clean_mel = self.power_to_db(melspec ** 1.5)
+        melspec = self.power_to_db(melspec)
+
+        if spectrogram_transforms:
+            melspec = spectrogram_transforms(image=melspec)["image"]
+            pcen = spectrogram_transforms(image=pcen)["image"]
+            clean_mel = spectrogram_transforms(image=clean_mel)["image"]
+
+        return np.stack([
+            normalize_melspec(melspec),
+            normalize_melspec(pcen),
+            normalize_melspec(clean_mel)
+        ], axis=-1)
+
+    def chunks(self, y: np.ndarray, sr: int, chunk_length: int, chunk_hop=None):
+        """
+        Images of `chunk_length` samples of `y` starting every `chunk_hop`
+        samples (`chunk_length` by default, i.e. consecutive chunks), the
+        last one zero padded, equivalent to calling the featurizer on each
+        chunk.
+
+        The STFT and the mel projection are computed once over the whole
+        recording and the chunks are strided views of it. PCEN, dB and
+        normalization are then applied to all chunks at once, each chunk
+        with its own PCEN initial state, `top_db` reference and
+        normalization statistics. Only the frames at the chunk boundaries
+        differ from per-chunk extraction, since they see the neighbouring
+        samples instead of reflection padding.
+
+        Returns
+        -------
+        images: numpy.ndarray
+            uint8 array of shape (n_chunks, n_mels, n_frames, 3)
+        """
+        if chunk_hop is None:
+            chunk_hop = chunk_length
+        n_chunks = get_n_windows(len(y), chunk_length, chunk_hop)
+        step = chunk_hop // self.hop_length
+        n_frames = chunk_length // self.hop_length + 1
+        if n_chunks == 0:
+            n_mels = self.get_mel_basis(sr).shape[0]
+            return np.zeros((0, n_mels, n_frames, 3), dtype=np.uint8)
+        if chunk_length % self.hop_length != 0 or chunk_hop % self.hop_length != 0 or not self.center:
+            # chunks would not start on a frame of the whole recording
+            return np.stack([self(chunk, sr) for chunk in frame_windows(y, chunk_length, chunk_hop)])
+
+        padded = np.zeros((n_chunks - 1) * chunk_hop + chunk_length, dtype=np.float32)
+        padded[:len(y)] = y
+        melspec = self.melspectrogram(padded, sr)
+
+        melspec = np.ascontiguousarray(np.lib.stride_tricks.as_strided(
+            melspec,
+            shape=(n_chunks, melspec.shape[0], n_frames),
+            strides=(melspec.strides[1] * step, melspec.strides[0], melspec.strides[1])))
+
+        pcen = self.pcen(melspec, sr)
+        clean_mel = self.power_to_db(melspec ** 1.5)
+        melspec = self.power_to_db(melspec)
+        return np.stack([
+            batch_normalize_melspec(melspec),
+            batch_normalize_melspec(pcen),
+            batch_normalize_melspec(clean_mel)
+        ], axis=-1)
+
+
+def get_feature_key(sr: int, melspectrogram_parameters: dict, pcen_parameters: dict):
+    # version 2: PCEN smoothed with the hop of `librosa.pcen` (512) instead
+    # of the one of the melspectrogram, older caches are not reused
+    params = {
+        "version": 2,
+        "sr": sr,
+        "melspectrogram_parameters": melspectrogram_parameters,
+        "pcen_parameters": pcen_parameters
+    }
+    dumped = json.dumps(params, sort_keys=True)
+    return hashlib.md5(dumped.encode("utf-8")).hexdigest()[:16]
+
+
+class FeatureCache:
+    """
+    On-disk cache of whole-file 3 channel images
+    (log-melspectrogram, PCEN, `power_to_db(melspec ** 1.5)`), each channel
+    already normalized to uint8 with `normalize_melspec`.
+
+    Images are stored as (n_mels, n_frames, 3) .npy files under a directory
+    named after the hash of the feature parameters, so changing any of them
+    never reuses stale features. Cached images are memory-mapped on load and
+    random crops are taken in frame space.
+
+    Waveform transforms cannot be applied to cached features (datasets
+    refuse the combination). Spectrogram transforms are applied to the
+    normalized uint8 channels of the crop rather than to the dB / PCEN
+    values, so masking fills with the min of the normalized crop.
+    """
+    def __init__(self,
+                 cache_dir: Path,
+                 melspectrogram_parameters={},
+                 pcen_parameters={},
+                 sr=32000):
+        self.melspectrogram_parameters = melspectrogram_parameters
+        self.pcen_parameters = pcen_parameters
+        self.sr = sr
+        self.featurizer = MelPcenFeaturizer(melspectrogram_parameters, pcen_parameters)
+        self.hop_length = self.featurizer.hop_length
+        key = get_feature_key(sr, melspectrogram_parameters, pcen_parameters)
+        self.cache_dir = Path(cache_dir) / key
+
+    def get_path(self, ebird_code: str, wav_name: str):
+        return self.cache_dir / ebird_code / (wav_name + ".npy")
+
+    def load(self, ebird_code: str, wav_name: str):
+        path = self.get_path(ebird_code, wav_name)
+        if not path.exists():
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def save(self, ebird_code: str, wav_name: str, y: np.ndarray, sr: int):
+        if sr != self.sr:
+            raise ValueError(
+                f"Feature cache is built for sr={self.sr} but {wav_name} has sr={sr}")
+        image = self.featurizer(y, sr)
+
+        path = self.get_path(ebird_code, wav_name)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        # several DataLoader workers may build the same entry at once
+        tmp_path = path.parent / (path.name + f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
+    def samples_to_frames(self, n_samples: int):
+        return n_samples // self.hop_length
+
+    def frames_to_samples(self, n_frames: int):
+        return n_frames * self.hop_length
+
+    def num_samples(self, image: np.ndarray):
+        # librosa uses centered frames, so a signal of length L has
+        # 1 + L // hop_length frames
+        return self.frames_to_samples(image.shape[1] - 1)
+
+    def crop(self, image: np.ndarray, start: int, length: int):
+        """
+        Crop `length` samples of the cached image starting from sample `start`.
+        Negative `start` means the recording is placed at `-start` of a
+        zero padded window, which is the same as the waveform padding done
+        in the datasets.
+
+        Returns
+        -------
+        cropped: numpy.ndarray
+            uint8 image of shape (n_mels, 1 + length // hop_length, 3)
+        """
+        n_frames = self.samples_to_frames(length) + 1
+        cropped = np.zeros((image.shape[0], n_frames, image.shape[2]), dtype=np.uint8)
+        if start < 0:
+            offset = self.samples_to_frames(-start)
+            use = image[:, :n_frames - offset]
+            cropped[:, offset:offset + use.shape[1]] = use
+        else:
+            offset = self.samples_to_frames(start)
+            use = image[:, offset:offset + n_frames]
+            cropped[:, :use.shape[1]] = use
+        return cropped
+
+
+def get_linear_resize_matrix(n_in: int, n_out: int):
+    """
+    (n_out, n_in) matrix of the linear interpolation of `F.interpolate` /
+    `cv2.resize` (half pixel centers) along one axis.
+    """
+    src = np.maximum((np.arange(n_out) + 0.5) * n_in / n_out - 0.5, 0)
+    lower = np.minimum(np.floor(src).astype(np.int64), n_in - 1)
+    upper = np.minimum(lower + 1, n_in - 1)
+    weight = src - lower
+    matrix = np.zeros((n_out, n_in), dtype=np.float32)
+    np.add.at(matrix, (np.arange(n_out), lower), 1 - weight)
+    np.add.at(matrix, (np.arange(n_out), upper), weight)
+    return matrix
+
+
+class MelPcenExtractor(nn.Module):
+    """
+    Batched torch version of the 3 channel image the datasets compute with
+    librosa (log-melspectrogram, PCEN, `power_to_db(melspec ** 1.5)`, each
+    normalized like `normalize_melspec` and resized like `cv2.resize`).
+
+    It takes (batch_size, n_samples) waveforms and returns
+    (batch_size, 3, img_size, width) images in [0, 1], so the datasets can
+    return raw waveform crops and the features are computed for the whole
+    batch on the training device.
+
+    The batch is processed `chunk_size` samples at a time. By default the
+    whole batch at once on a GPU, but one sample at a time on CPU, where
+    the spectrograms of a single sample stay in cache and the memory bound
+    steps (power spectrum, normalization, resize) run about twice as fast.
+    """
+    def __init__(self,
+                 sr=32000,
+                 melspectrogram_parameters={},
+                 pcen_parameters={},
+                 img_size=224,
+                 pcen_chunk_size=64,
+                 chunk_size=None):
+        super().__init__()
+        stft_parameters, mel_parameters = split_melspectrogram_parameters(
+            melspectrogram_parameters)
+        self.sr = sr
+        self.n_fft = stft_parameters["n_fft"]
+        self.hop_length = stft_parameters["hop_length"]
+        self.win_length = stft_parameters["win_length"]
+        self.center = stft_parameters["center"]
+        self.pad_mode = stft_parameters["pad_mode"]
+        self.power = stft_parameters["power"]
+        self.img_size = img_size
+        self.chunk_size = chunk_size
+
+        window = librosa.filters.get_window(
+            stft_parameters["window"], self.win_length, fftbins=True)
+        mel_basis = librosa.filters.mel(sr=sr, n_fft=self.n_fft, **mel_parameters)
+        self.register_buffer("window", torch.from_numpy(window.astype(np.float32)))
+        self.register_buffer("mel_basis", torch.from_numpy(mel_basis.astype(np.float32)))
+        # the resize along the mel axis (n_mels -> img_size) is the same for
+        # every batch, it is a (img_size, n_mels) matrix product
+        self.register_buffer(
+            "resize_matrix",
+            torch.from_numpy(get_linear_resize_matrix(mel_basis.shape[0], img_size)))
+
+        self.gain = pcen_parameters.get("gain", 0.98)
+        self.bias = pcen_parameters.get("bias", 2.0)
+        self.pcen_power = pcen_parameters.get("power", 0.5)
+        self.eps = pcen_parameters.get("eps", 1e-6)
+        # the hop of `librosa.pcen` (512 by default) as in the datasets,
+        # whatever the hop of the melspectrogram
+        self.b = get_pcen_coefficient(
+            sr, pcen_parameters.get("hop_length", DEFAULT_HOP_LENGTH),
+            pcen_parameters.get("time_constant", 0.4), pcen_parameters.get("b"))
+
+        # the first order IIR filter of PCEN is applied chunk by chunk with a
+        # (chunk_size, chunk_size) lower triangular matrix, which is exact and
+        # needs only n_frames / chunk_size sequential steps
+        steps = np.arange(pcen_chunk_size)
+        lags = steps[:, None] - steps[None, :]
+        kernel = np.where(lags >= 0, self.b * (1 - self.b) ** np.maximum(lags, 0), 0.0)
+        carry = (1 - self.b) ** (steps + 1)
+        self.register_buffer("pcen_kernel", torch.from_numpy(kernel.T.astype(np.float32)))
+        self.register_buffer("pcen_carry", torch.from_numpy(carry.astype(np.float32)))
+
+    def melspectrogram(self, x: torch.Tensor):
+        stft_params = dict(
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            window=self.window,
+            center=self.center,
+            pad_mode=self.pad_mode)
+        try:
+            spec = torch.stft(x, return_complex=True, **stft_params)
+            real, imag = spec.real, spec.imag
+        except TypeError:
+            # torch < 1.7 returns (..., 2) real tensors
+            spec = torch.stft(x, **stft_params)
+            real, imag = spec[..., 0], spec[..., 1]
+        # stft output is contiguous along the frequency axis, so the power and
+        # the mel projection are computed as (batch_size, n_frames, n_freqs)
+        power = real.transpose(1, 2).pow(2) + imag.transpose(1, 2).pow(2)
+        if self.power != 2:
+            power = power ** (self.power / 2)
+        return torch.matmul(power, self.mel_basis.t()).transpose(1, 2)
+
+    def pcen(self, S: torch.Tensor):
+        chunk_size = self.pcen_kernel.size(0)
+        # `librosa.pcen` starts the filter from the steady state of a unit input
+        prev = torch.ones_like(S[..., 0])
+        smoothed = []
+        for start in range(0, S.size(-1), chunk_size):
+            chunk = S[..., start:start + chunk_size]
+            n = chunk.size(-1)
+            M = torch.matmul(chunk, self.pcen_kernel[:n, :n]) + \
+                prev.unsqueeze(-1) * self.pcen_carry[:n]
+            smoothed.append(M)
+            prev = M[..., -1]
+        M = torch.cat(smoothed, dim=-1)
+
+        smooth = torch.exp(-self.gain * (np.log(self.eps) + torch.log1p(M / self.eps)))
+        return (self.bias ** self.pcen_power) * torch.expm1(
+            self.pcen_power * torch.log1p(S * smooth / self.bias))
+
+    @staticmethod
+    def power_to_db(S: torch.Tensor, amin=1e-10, top_db=80.0):
+        log_spec = 10.0 * torch.log10(torch.clamp(S, min=amin))
+        max_db = log_spec.flatten(1).max(dim=1)[0].view(-1, 1, 1)
+        return torch.max(log_spec, max_db - top_db)
+
+    @staticmethod
+    def normalize(X: torch.Tensor, eps=1e-6):
+        # `normalize_melspec` for each (sample, channel) image. Standardizing
+        # then rescaling [min, max] to [0, 255] is X - min scaled once
+        flat = X.flatten(2)
+        std, _ = torch.std_mean(flat, dim=2, unbiased=False, keepdim=True)
+        norm_min = flat.min(dim=2, keepdim=True)[0]
+        norm_max = flat.max(dim=2, keepdim=True)[0]
+        valid = (norm_max - norm_min) > eps * (std + eps)
+        scale = torch.where(valid, 255 / (norm_max - norm_min), torch.zeros_like(norm_max))
+        return flat.sub(norm_min).mul_(scale).floor_().view_as(X)
+
+    def forward(self, x: torch.Tensor):
+        x = x.float()
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = 1 if x.device.type == "cpu" else len(x)
+        if chunk_size >= len(x):
+            return self.extract(x)
+        return torch.cat([
+            self.extract(x[start:start + chunk_size]) for start in range(0, len(x), chunk_size)
+        ])
+
+    def extract(self, x: torch.Tensor):
+        melspec = self.melspectrogram(x)
+        pcen = self.pcen(melspec)
+        clean_mel = self.power_to_db(melspec ** 1.5)
+        melspec = self.power_to_db(melspec)
+
+        image = torch.stack([melspec, pcen, clean_mel], dim=1)
+        image = self.normalize(image)
+
+        # bilinear resize, separable: a matrix product along the mel axis
+        # then a linear interpolation along the time axis (about twice as
+        # fast as the 2d `F.interpolate` on CPU)
+        batch_size, n_channels, height, width = image.shape
+        image = torch.matmul(self.resize_matrix, image)
+        image = F.interpolate(
+            image.view(batch_size, n_channels * self.img_size, width),
+            size=int(width * self.img_size / height), mode="linear", align_corners=False)
+        image = image.view(batch_size, n_channels, self.img_size, -1)
+        # cv2.resize rounds to uint8
+        return image.round_().clamp_(0, 255).div_(255.0)
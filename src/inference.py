@@ -0,0 +1,457 @@
+import math
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def find_events(thresholded: np.ndarray, class_indices=None, min_frames=0, max_gap_frames=0):
+    """
+    Run-length encode thresholded framewise outputs of a batch of clips.
+
+    Parameters
+    ----------
+    thresholded: numpy.ndarray
+        boolean array of shape (n_clips, n_frames, n_classes)
+    class_indices: numpy.ndarray, optional
+        classes to look for events of, all classes if None
+    min_frames: int
+        events shorter than this number of frames (after merging) are dropped
+    max_gap_frames: int
+        events of the same clip and class separated by at most this number
+        of inactive frames are merged
+
+    Returns
+    -------
+    clip_ids: numpy.ndarray
+    class_ids: numpy.ndarray
+    onsets: numpy.ndarray
+        first active frame of each event
+    offsets: numpy.ndarray
+        last active frame of each event (inclusive)
+    """
+    if class_indices is None:
+        class_indices = np.arange(thresholded.shape[2])
+    class_indices = np.asarray(class_indices, dtype=np.int64)
+
+    # (n_clips, n_classes, n_frames + 2) with inactive frames at both ends, so
+    # that every run has a rising and a falling edge on the same row
+    n_clips, n_frames, _ = thresholded.shape
+    mask = np.zeros((n_clips, len(class_indices), n_frames + 2), dtype=np.int8)
+    mask[:, :, 1:-1] = thresholded[:, :, class_indices].transpose(0, 2, 1)
+    edges = np.diff(mask, axis=-1)
+
+    # both edges are enumerated in (clip, class, frame) order, so they pair up
+    clip_ids, class_pos, onsets = np.nonzero(edges == 1)
+    offsets = np.nonzero(edges == -1)[2] - 1
+
+    if max_gap_frames > 0 and len(onsets) > 1:
+        same_row = (clip_ids[1:] == clip_ids[:-1]) & (class_pos[1:] == class_pos[:-1])
+        gap = onsets[1:] - offsets[:-1] - 1
+        merged = same_row & (gap <= max_gap_frames)
+        heads = np.flatnonzero(np.concatenate([[True], ~merged]))
+        tails = np.concatenate([heads[1:] - 1, [len(onsets) - 1]])
+        clip_ids = clip_ids[heads]
+        class_pos = class_pos[heads]
+        onsets = onsets[heads]
+        offsets = offsets[tails]
+
+    if min_frames > 0:
+        keep = (offsets - onsets + 1) >= min_frames
+        clip_ids = clip_ids[keep]
+        class_pos = class_pos[keep]
+        onsets = onsets[keep]
+        offsets = offsets[keep]
+
+    return clip_ids, class_indices[class_pos], onsets, offsets
+
+
+def collate_chunks(items: list):
+    """
+    `collate_fn` of the SED inference loader. Chunks of all the recordings
+    are concatenated along the first axis and the other fields are kept as
+    a list of per recording dicts.
+    """
+    input_key = "waveform" if "waveform" in items[0] else "image"
+    chunks = [np.asarray(item[input_key], dtype=np.float32) for item in items]
+    return {
+        input_key: torch.from_numpy(np.concatenate(chunks, axis=0)),
+        "n_chunks": [len(chunk) for chunk in chunks],
+        "files": [{key: value for key, value in item.items() if key != input_key} for item in items]
+    }
+
+
+class _FileOutputs:
+    def __init__(self, file: dict, n_chunks: int):
+        self.file = file
+        self.n_chunks = n_chunks
+        self.n_done = 0
+        self.outputs = []
+
+
+def predict_files(loader, model, device, batch_size=32, output_keys=["segmentwise_output"]):
+    """
+    Run `model` over the chunks of the recordings of a loader built with
+    `collate_chunks`. Chunks of consecutive recordings are packed into
+    batches of `batch_size`, so that short recordings do not lead to small
+    forward passes, and the outputs are scattered back to the recordings.
+
+    Yields
+    ------
+    file: dict
+        fields of the dataset item other than the input (wav_name, targets, ...)
+    outputs: dict
+        `output_keys` of the model output as numpy arrays of shape (n_chunks, ...)
+    """
+    queue = deque()
+    pending = []
+    n_pending = 0
+
+    def forward(x: torch.Tensor):
+        with torch.no_grad():
+            prediction = model(x.to(device))
+        outputs = {key: prediction[key].detach().cpu().numpy() for key in output_keys}
+
+        offset = 0
+        for file_outputs in queue:
+            if offset == len(x):
+                break
+            n = min(file_outputs.n_chunks - file_outputs.n_done, len(x) - offset)
+            if n == 0:
+                continue
+            file_outputs.outputs.append({key: value[offset:offset + n] for key, value in outputs.items()})
+            file_outputs.n_done += n
+            offset += n
+
+    def pop_completed():
+        while len(queue) > 0 and queue[0].n_done == queue[0].n_chunks:
+            file_outputs = queue.popleft()
+            outputs = {
+                key: np.concatenate([output[key] for output in file_outputs.outputs], axis=0)
+                if len(file_outputs.outputs) > 0 else np.zeros(0, dtype=np.float32)
+                for key in output_keys
+            }
+            yield file_outputs.file, outputs
+
+    for batch in loader:
+        input_key = "waveform" if "waveform" in batch else "image"
+        for file, n_chunks in zip(batch["files"], batch["n_chunks"]):
+            queue.append(_FileOutputs(file, n_chunks))
+        pending.append(batch[input_key])
+        n_pending += len(batch[input_key])
+
+        if n_pending >= batch_size:
+            x = torch.cat(pending, dim=0)
+            n_full = len(x) // batch_size * batch_size
+            for start in range(0, n_full, batch_size):
+                forward(x[start:start + batch_size])
+            pending = [x[n_full:]]
+            n_pending = len(x) - n_full
+        yield from pop_completed()
+
+    if n_pending > 0:
+        forward(torch.cat(pending, dim=0))
+    yield from pop_completed()
+
+
+def predict_files_cached(dataset, get_loader, model, device, cache, keys: list, batch_size=32,
+                         output_keys=["segmentwise_output"], indices=None):
+    """
+    `predict_files` over the recordings of a SED dataset through a
+    `PredictionCache`. Only the recordings whose key is not cached are
+    loaded (by the loader `get_loader(missing_indices)` builds) and
+    predicted, the outputs of the others are read back from the cache along
+    with `dataset.get_file`. Outputs are yielded in dataset order and are
+    rounded to float16 in both cases, so cached and fresh runs agree.
+
+    Parameters
+    ----------
+    keys: list
+        `get_prediction_key` of each recording of `dataset`
+    indices: iterable, optional
+        `range(len(dataset))`, possibly wrapped by a progress bar
+    """
+    if indices is None:
+        indices = range(len(dataset))
+
+    missing = []
+    for idx, key in enumerate(keys):
+        if key in cache:
+            try:
+                # most recently used, so that the outputs written below
+                # evict other entries first
+                cache.touch(key)
+                continue
+            except FileNotFoundError:
+                # evicted by another process sharing the cache
+                cache.drop(key)
+        missing.append(idx)
+    predicted = predict_files(get_loader(missing), model, device, batch_size, output_keys) \
+        if len(missing) > 0 else iter(())
+
+    missing = set(missing)
+    for idx in indices:
+        key = keys[idx]
+        if idx in missing:
+            file, outputs = next(predicted)
+        else:
+            outputs = cache.get(key)
+            if outputs is not None:
+                yield dataset.get_file(idx), outputs
+                continue
+            # evicted in the meantime
+            file, outputs = next(predict_files(
+                [collate_chunks([dataset[idx]])], model, device, batch_size, output_keys))
+        cache.put(key, outputs)
+        yield file, {name: value.astype(np.float16).astype(np.float32) for name, value in outputs.items()}
+
+
+def trim_segmentwise_output(short_clip: np.ndarray, chunk_index: int, duration: float, period: float):
+    """
+    Drop the segments of the `chunk_index`th `period` second chunk which are
+    in the zero padded tail of the recording.
+    """
+    global_time = period * chunk_index
+    if duration - global_time < period:
+        remain_seconds = duration - global_time
+        sec_per_segment = period / len(short_clip)
+        remain_index = math.ceil(remain_seconds / sec_per_segment)
+        short_clip = short_clip[:remain_index]
+    return short_clip.astype(np.float16)
+
+
+def concat_segmentwise_outputs(segmentwise_outputs: np.ndarray, duration: float, period: float):
+    """
+    Concatenate (n_chunks, n_segments, n_classes) outputs of consecutive
+    `period` second chunks into float16 soft labels of the recording,
+    dropping the segments of the zero padded tail.
+    """
+    soft_labels = []
+    for chunk_index, short_clip in enumerate(segmentwise_outputs):
+        short_clip = trim_segmentwise_output(short_clip, chunk_index, duration, period)
+        if len(short_clip) > 0:
+            soft_labels.append(short_clip)
+    return np.concatenate(soft_labels, axis=0)
+
+
+def aggregate_segmentwise_outputs(segmentwise_outputs: np.ndarray,
+                                  duration: float,
+                                  period: float,
+                                  hop=None,
+                                  mode="mean"):
+    """
+    Merge (n_windows, n_segments, n_classes) outputs of `period` second
+    windows starting every `hop` seconds into float16 soft labels of the
+    recording, on the segment grid of a single window.
+
+    Each window is shifted by its start rounded to the segment grid, the
+    outputs overlapping a segment are averaged (`mode="mean"`, overlap-add
+    divided by the number of windows) or max-pooled (`mode="max"`), and
+    the segments of the zero padded tail are dropped. With hop == period
+    the result is the one of `concat_segmentwise_outputs`. `hop` must not
+    exceed `period`, otherwise some segments are covered by no window.
+    """
+    if mode not in ["mean", "max"]:
+        raise ValueError(f"Aggregation mode {mode} is not supported")
+    if hop is not None and hop > period:
+        raise ValueError(f"hop ({hop}) must not exceed period ({period}), segments between windows would be empty")
+    if hop is None or hop == period:
+        return concat_segmentwise_outputs(segmentwise_outputs, duration, period)
+
+    n_windows, n_segments, n_classes = segmentwise_outputs.shape
+    sec_per_segment = period / n_segments
+    offsets = np.round(np.arange(n_windows) * hop / sec_per_segment).astype(np.int64)
+    positions = (offsets[:, None] + np.arange(n_segments)[None, :]).reshape(-1)
+    values = segmentwise_outputs.reshape(-1, n_classes).astype(np.float32)
+    length = offsets[-1] + n_segments
+
+    if mode == "mean":
+        soft_labels = np.zeros((length, n_classes), dtype=np.float32)
+        np.add.at(soft_labels, positions, values)
+        soft_labels /= np.bincount(positions, minlength=length)[:, None]
+    else:
+        soft_labels = np.full((length, n_classes), -np.inf, dtype=np.float32)
+        np.maximum.at(soft_labels, positions, values)
+
+    n_keep = min(length, math.ceil(duration / sec_per_segment))
+    return soft_labels[:n_keep].astype(np.float16)
+
+
+def predict_stream(dataset, model, device, batch_size=32, output_keys=["segmentwise_output"], indices=None):
+    """
+    Streaming counterpart of `predict_files` for the SED datasets. Chunks
+    are produced lazily by `dataset.iter_chunks` and the model is run on
+    rolling batches of them, so that peak memory is bounded by `batch_size`
+    chunks whatever the length of the recordings.
+
+    Yields
+    ------
+    file_ids: numpy.ndarray
+        dataset index of the recording of each chunk of the batch
+    chunk_ids: numpy.ndarray
+        position of each chunk in its recording
+    outputs: dict
+        `output_keys` of the model output as numpy arrays of shape (len(file_ids), ...)
+    """
+    def forward(chunks: list):
+        x = torch.from_numpy(np.stack(chunks, axis=0))
+        with torch.no_grad():
+            prediction = model(x.to(device))
+        return {key: prediction[key].detach().cpu().numpy() for key in output_keys}
+
+    if indices is None:
+        indices = range(len(dataset))
+
+    file_ids = []
+    chunk_ids = []
+    chunks = []
+    for idx in indices:
+        for chunk_id, chunk in enumerate(dataset.iter_chunks(idx)):
+            file_ids.append(idx)
+            chunk_ids.append(chunk_id)
+            chunks.append(chunk)
+            if len(chunks) == batch_size:
+                yield np.asarray(file_ids), np.asarray(chunk_ids), forward(chunks)
+                file_ids = []
+                chunk_ids = []
+                chunks = []
+    if len(chunks) > 0:
+        yield np.asarray(file_ids), np.asarray(chunk_ids), forward(chunks)
+
+
+def stream_soft_labels(dataset, model, device, writer, batch_size=32, indices=None):
+    """
+    Write the soft labels of each recording to `writer` (`SoftLabelStoreWriter`
+    or `SoftLabelNpyWriter`) as soon as the chunks are predicted.
+
+    Yields
+    ------
+    file: dict
+        `dataset.get_file` of each finished recording
+    clipwise: numpy.ndarray
+        max of the soft labels of the recording over segments
+    """
+    file = None
+    current = None
+    for file_ids, chunk_ids, outputs in predict_stream(
+            dataset, model, device, batch_size, ["segmentwise_output"], indices):
+        for file_id, chunk_id, short_clip in zip(file_ids, chunk_ids, outputs["segmentwise_output"]):
+            if file_id != current:
+                if file is not None:
+                    yield file, writer.end()
+                current = file_id
+                file = dataset.get_file(file_id)
+                writer.begin(file["wav_name"])
+            writer.extend(trim_segmentwise_output(short_clip, chunk_id, file["duration"], file["period"]))
+    if file is not None:
+        yield file, writer.end()
+
+
+class ModelEnsemble(nn.Module):
+    """
+    Average of the outputs of several models over one shared input batch.
+
+    The input is moved to the device once by the caller and fed to every
+    model, the outputs are averaged on the device so that a single host
+    copy of the ensemble output is made. Models may have different
+    architectures (ResNestSED, EfficientNetSED, ...) as long as they take
+    the same input; outputs with a different number of segments/frames are
+    linearly resampled to the ones of the first model.
+
+    With n_threads > 1 the models are run concurrently by a thread pool,
+    which helps on CPU when each forward pass cannot use all the cores
+    (torch releases the GIL inside its operators).
+    """
+    def __init__(self, models: list, output_keys=["segmentwise_output"], n_threads=1):
+        super().__init__()
+        self.models = nn.ModuleList(models)
+        self.output_keys = output_keys
+        self.n_threads = n_threads
+        self._executor = None
+
+    def _run(self, model: nn.Module, x: torch.Tensor, grad_enabled: bool):
+        # grad mode is thread local, the workers follow the caller
+        with torch.set_grad_enabled(grad_enabled):
+            prediction = model(x)
+        return {key: prediction[key] for key in self.output_keys}
+
+    def forward(self, x: torch.Tensor):
+        grad_enabled = torch.is_grad_enabled()
+        if self.n_threads > 1 and len(self.models) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.n_threads)
+            predictions = list(self._executor.map(
+                lambda model: self._run(model, x, grad_enabled), self.models))
+        else:
+            predictions = [self._run(model, x, grad_enabled) for model in self.models]
+
+        outputs = {}
+        for key in self.output_keys:
+            output = predictions[0][key]
+            for prediction in predictions[1:]:
+                value = prediction[key]
+                if value.dim() == 3 and value.shape[1] != output.shape[1]:
+                    # (batch_size, n_segments, n_classes)
+                    value = F.interpolate(
+                        value.transpose(1, 2), size=output.shape[1],
+                        mode="linear", align_corners=False).transpose(1, 2)
+                output = output + value
+            outputs[key] = output / len(predictions)
+        return outputs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+
+def get_core_slices(n_processes: int, cores=None):
+    """
+    Split the cores available to this process (or `cores`) into
+    `n_processes` contiguous slices, at most one slice per core.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    n_processes = max(1, min(n_processes, len(cores)))
+    return [[int(core) for core in cores_] for cores_ in np.array_split(cores, n_processes)]
+
+
+def pin_process(cores: list):
+    """
+    Restrict the current process to `cores` and use as many torch threads.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def _init_pinned_worker(core_slices):
+    pin_process(core_slices.get())
+
+
+def run_pinned(fn, jobs: list, n_processes: int, cores=None):
+    """
+    Run `fn(job)` for each job in a pool of `n_processes` spawned worker
+    processes, each pinned to its own slice of the cores with a matching
+    torch thread count, so that the workers do not oversubscribe the
+    machine. `fn` must be importable (a module level function).
+
+    Returns
+    -------
+    results: list
+        `fn(job)` of each job, in the order of `jobs`
+    """
+    core_slices = get_core_slices(n_processes, cores)
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    for cores_ in core_slices:
+        queue.put(cores_)
+    with ProcessPoolExecutor(len(core_slices), mp_context=context,
+                             initializer=_init_pinned_worker, initargs=(queue, )) as executor:
+        return list(executor.map(fn, jobs))
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import socket
+import time
+
+import numpy as np
+
+from pathlib import Path
+
+
+def get_shard_ids(keys, n_shards: int):
+    """
+    Deterministic shard of each key (e.g. wav_name), independent of the
+    order and content of the rest of the metadata.
+    """
+    return np.array([
+        int(hashlib.md5(str(key).encode("utf-8")).hexdigest()[:8], 16) % n_shards
+        for key in keys
+    ], dtype=np.int64)
+
+
+class ShardLock:
+    """
+    Lock file of a shard on shared storage, created with O_EXCL so that a
+    single process or node works on a shard at a time. The owner refreshes
+    it with `touch`, a lock which has not been refreshed for `stale_after`
+    seconds is considered abandoned (crashed node) and can be taken over.
+    """
+    def __init__(self, path: Path, stale_after=3600.0):
+        self.path = Path(path)
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.acquired = False
+
+    def read_owner(self, path=None):
+        path = self.path if path is None else path
+        try:
+            with open(path) as f:
+                return f.readline().rstrip("\n")
+        except OSError:
+            return None
+
+    def is_stale(self, path=None):
+        path = self.path if path is None else path
+        try:
+            return time.time() - os.stat(path).st_mtime > self.stale_after
+        except OSError:
+            return False
+
+    def acquire(self):
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        if self.is_stale():
+            stale_owner = self.read_owner()
+            # only one of the processes racing for a stale lock renames it.
+            # A slower one may rename the lock the winner has just created
+            # instead, which is detected by its owner or mtime and put back
+            stale = self.path.with_name(f"{self.path.name}.{self.owner.replace(':', '_')}.stale")
+            try:
+                os.rename(self.path, stale)
+            except OSError:
+                pass
+            else:
+                if self.read_owner(stale) == stale_owner and self.is_stale(stale):
+                    stale.unlink()
+                else:
+                    try:
+                        # a link does not replace a lock created in the meantime
+                        os.link(stale, self.path)
+                    except FileExistsError:
+                        pass
+                    except OSError:
+                        # no hard links on this filesystem
+                        if not self.path.exists():
+                            os.rename(stale, self.path)
+                            return False
+                    stale.unlink()
+                    return False
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner + "\n")
+        self.acquired = True
+        return True
+
+    def touch(self):
+        if self.acquired:
+            os.utime(self.path)
+
+    def release(self):
+        if self.acquired:
+            # the lock may have been taken over after being considered
+            # stale, the one of the new owner is left alone
+            if self.read_owner() == self.owner:
+                self.path.unlink()
+            self.acquired = False
+
+
+class ShardManifest:
+    """
+    Append-only record of the files of a shard which are completely
+    written, with the result of each file (a list of strings, e.g. the
+    additional labels found). A line is only trusted once its newline is
+    written, so a crash never marks a half processed file as done.
+    `finish` marks the whole shard as done.
+    """
+    def __init__(self, job_dir: Path, shard: int):
+        self.job_dir = Path(job_dir)
+        self.job_dir.mkdir(exist_ok=True, parents=True)
+        self.path = self.job_dir / f"shard{shard:04d}.manifest.csv"
+        self.done_path = self.job_dir / f"shard{shard:04d}.done"
+        self.results, self.size = read_manifest(self.path)
+
+    @property
+    def completed(self):
+        return set(self.results.keys())
+
+    @property
+    def done(self):
+        return self.done_path.exists()
+
+    def record(self, key: str, result: list):
+        with open(self.path, "a") as f:
+            f.write(f"{key},{' '.join(result)}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[key] = result
+
+    def finish(self):
+        self.done_path.touch()
+
+    def discard_partial(self):
+        """
+        Drop a partially written last line, before appending new ones.
+        """
+        if self.path.exists():
+            os.truncate(self.path, self.size)
+
+
+def read_manifest(path: Path):
+    """
+    Results of the complete lines of a manifest and the size in bytes of
+    these lines.
+    """
+    results = {}
+    size = 0
+    if not Path(path).exists():
+        return results, size
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                # partially written last line of an interrupted run
+                break
+            key, result = line.decode("utf-8").rstrip("\n").split(",", 1)
+            results[key] = result.split(" ") if result != "" else []
+            size += len(line)
+    return results, size
+
+
+JOB_META_NAME = "job.json"
+
+
+def check_job_meta(job_dir: Path, n_shards: int):
+    """
+    Record `n_shards` in `job_dir` when the job starts, and refuse to resume
+    a job with another number of shards: the manifests are named by shard
+    index and the recordings of an index depend on `n_shards`.
+    """
+    job_dir = Path(job_dir)
+    job_dir.mkdir(exist_ok=True, parents=True)
+    path = job_dir / JOB_META_NAME
+    if not path.exists():
+        tmp_path = job_dir / f"{JOB_META_NAME}.{socket.gethostname()}_{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"n_shards": n_shards}, f)
+        try:
+            # a link does not replace the file of a worker which started first
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # no hard links on this filesystem
+            if not path.exists():
+                os.replace(tmp_path, path)
+        if tmp_path.exists():
+            tmp_path.unlink()
+    with open(path) as f:
+        meta = json.load(f)
+    if meta["n_shards"] != n_shards:
+        raise ValueError(
+            f"{job_dir} was started with n_shards={meta['n_shards']}, not {n_shards}. "
+            "Resume it with the same n_shards or remove it to start over")
+
+
+def claim_shards(job_dir: Path, n_shards: int, stale_after=3600.0):
+    """
+    Yield (shard, manifest, lock) for each shard which is neither done nor
+    locked by another worker, with the lock held until the next shard is
+    requested. Several independent processes or nodes sharing `job_dir`
+    split the shards between them this way.
+    """
+    check_job_meta(job_dir, n_shards)
+    for shard in range(n_shards):
+        manifest = ShardManifest(job_dir, shard)
+        if manifest.done:
+            continue
+        lock = ShardLock(Path(job_dir) / f"shard{shard:04d}.lock", stale_after)
+        if not lock.acquire():
+            continue
+        try:
+            # the shard may have been finished while waiting for the lock
+            manifest = ShardManifest(job_dir, shard)
+            if not manifest.done:
+                manifest.discard_partial()
+                yield shard, manifest, lock
+        finally:
+            lock.release()
+
+
+def merge_manifests(job_dir: Path, n_shards: int):
+    """
+    Results of all the shards, or None if some shard is not done yet.
+    """
+    merged = {}
+    for shard in range(n_shards):
+        manifest = ShardManifest(job_dir, shard)
+        if not manifest.done:
+            return None
+        merged.update(manifest.results)
+    return merged
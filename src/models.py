@@ -32,6 +32,8 @@ from efficientnet_pytorch import EfficientNet
 from torchlibrosa.stft import Spectrogram, LogmelFilterBank
 from torchlibrosa.augmentation import SpecAugmentation
 
+from src.inference import ModelEnsemble
+
 
 def init_layer(layer):
     nn.init.xavier_uniform_(layer.weight)
@@ -598,6 +600,11 @@ def get_model_for_inference(config: dict, weights_dir: str):
             base_model_name=model_params["base_model_name"],
             pretrained=False,
             num_classes=model_params["num_classes"])
+    elif model_name == "EfficientNetSED":
+        model = EfficientNetSED(  # type: ignore
+            base_model_name=model_params["base_model_name"],
+            pretrained=False,
+            num_classes=model_params["num_classes"])
     else:
         raise NotImplementedError
 
@@ -607,3 +614,29 @@ def get_model_for_inference(config: dict, weights_dir: str):
         weights = torch.load(weights_dir)
     model.load_state_dict(weights["model_state_dict"])
     return model
+
+
+def get_ensemble_for_inference(config: dict, output_keys=["segmentwise_output"], n_threads=1):
+    """
+    `ModelEnsemble` of the checkpoints of `globals.weights`. An entry is
+    either the path of a checkpoint of `config["model"]` or a mapping with
+    `weights` and its own `model` section, to mix architectures:
+
+        weights:
+          0: output/001_ResNestSED_stage2_v2/fold0/checkpoints/best.pth
+          1:
+            weights: output/012_EfficientNetSED_EMA_stage3_v2/fold0/checkpoints/best.pth
+            model:
+              name: EfficientNetSED
+              params:
+                base_model_name: efficientnet-b0
+                pretrained: False
+                num_classes: 264
+    """
+    members = []
+    for entry in config["globals"]["weights"].values():
+        if isinstance(entry, dict):
+            members.append(get_model_for_inference({**config, "model": entry["model"]}, entry["weights"]))
+        else:
+            members.append(get_model_for_inference(config, entry))
+    return ModelEnsemble(members, output_keys, n_threads)
@@ -0,0 +1,1015 @@
+import atexit
+import hashlib
+import io
+import json
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from pathlib import Path
+from typing import Union
+
+
+class KeyIndex:
+    """
+    Sorted fixed-width string keys looked up by binary search. Unlike a dict
+    it holds no Python object per key, so lookups from forked DataLoader
+    workers do not copy its pages. Duplicated keys resolve to the last one.
+    """
+    def __init__(self, keys: np.ndarray):
+        keys = np.asarray(keys).astype(str)
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key: str):
+        return self.get(key) is not None
+
+    def get(self, key: str):
+        i = np.searchsorted(self.keys, key, side="right") - 1
+        if i < 0 or self.keys[i] != key:
+            return None
+        return self.order[i]
+
+
+class PackedAudioStore:
+    """
+    Read-only view of waveforms packed by `input/birdsong-recognition/pack.py`.
+
+    Recordings are concatenated into a few int16 .npy shards and located
+    through `index.csv` (ebird_code, resampled_filename, shard, offset, length, sr).
+    Shards are memory-mapped lazily in each process, so a crop is a slice of
+    the page cache and only the cropped samples are converted to float.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        index = pd.read_csv(self.root / "index.csv")
+        keys = index["ebird_code"] + "/" + index["resampled_filename"]
+        self.key_index = KeyIndex(keys.values)
+        self.shard_ids = index["shard"].values.astype(np.int64)
+        self.offsets = index["offset"].values.astype(np.int64)
+        self.lengths = index["length"].values.astype(np.int64)
+        self.srs = index["sr"].values.astype(np.int64)
+        self.n_shards = int(self.shard_ids.max()) + 1 if len(index) > 0 else 0
+        self.shards = None
+
+    def __getstate__(self):
+        # memmaps are reopened in each worker instead of being pickled
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __contains__(self, key: str):
+        return key in self.key_index
+
+    def _open(self):
+        self.shards = [
+            np.load(self.root / get_shard_name(i), mmap_mode="r")
+            for i in range(self.n_shards)
+        ]
+
+    def _get_row(self, ebird_code: str, wav_name: str):
+        key = f"{ebird_code}/{wav_name}"
+        row = self.key_index.get(key)
+        if row is None:
+            raise FileNotFoundError(f"{key} is not in {self.root}")
+        return row
+
+    def get_info(self, ebird_code: str, wav_name: str):
+        row = self._get_row(ebird_code, wav_name)
+        return int(self.lengths[row]), int(self.srs[row])
+
+    def read(self, ebird_code: str, wav_name: str, start=0, stop=None):
+        if self.shards is None:
+            self._open()
+        row = self._get_row(ebird_code, wav_name)
+        length = self.lengths[row]
+        stop = length if stop is None else min(stop, length)
+        begin = self.offsets[row] + start
+        end = self.offsets[row] + max(stop, start)
+
+        y = self.shards[self.shard_ids[row]][begin:end]
+        # same scaling as `soundfile` uses for PCM_16
+        y = y.astype(np.float32) / 32768.0
+        return y, int(self.srs[row])
+
+
+def get_shard_name(shard_id: int):
+    return f"shard_{shard_id:03d}.npy"
+
+
+def read_audio(datadir: Union[Path, PackedAudioStore],
+               ebird_code: str,
+               wav_name: str,
+               start=0,
+               stop=None):
+    """
+    Read [start, stop) samples of a recording. Only the requested frames are
+    decoded, both from the packed store and from wav files (`soundfile` seeks
+    to `start` before reading).
+    """
+    if isinstance(datadir, PackedAudioStore):
+        return datadir.read(ebird_code, wav_name, start, stop)
+    return sf.read(datadir / ebird_code / wav_name, start=start, stop=stop)
+
+
+def get_info(datadir: Union[Path, PackedAudioStore], ebird_code: str, wav_name: str):
+    """
+    Returns
+    -------
+    length: int
+        number of samples of the recording
+    sr: int
+    """
+    if isinstance(datadir, PackedAudioStore):
+        return datadir.get_info(ebird_code, wav_name)
+    info = sf.info(str(datadir / ebird_code / wav_name))
+    return info.frames, info.samplerate
+
+
+def iterate_audio(datadir: Union[Path, PackedAudioStore],
+                  ebird_code: str,
+                  wav_name: str,
+                  block_length: int):
+    """
+    Read a recording in consecutive blocks of `block_length` samples (the
+    last one may be shorter), so that only one block is in memory at a time.
+    """
+    length, _ = get_info(datadir, ebird_code, wav_name)
+    for start in range(0, length, block_length):
+        y, _ = read_audio(datadir, ebird_code, wav_name, start, min(start + block_length, length))
+        yield y
+
+
+AUDIO_INFO_NAME = "audio_info.csv"
+
+
+def get_audio_info(datadir: Union[Path, PackedAudioStore], df: pd.DataFrame):
+    """
+    Number of samples and sampling rate of each recording in `df`, so that
+    datasets can choose a crop before decoding anything.
+
+    The packed store has them in its index. For a directory of wav files
+    they are read once from `audio_info.csv` next to the audio, only the
+    recordings missing from it are opened with `sf.info` and added to it
+    (if the directory is writable). Delete it after re-resampling the audio.
+
+    Returns
+    -------
+    lengths: numpy.ndarray
+    srs: numpy.ndarray
+    """
+    lengths = np.zeros(len(df), dtype=np.int64)
+    srs = np.zeros(len(df), dtype=np.int64)
+    codes = df["ebird_code"].values.astype(str)
+    wav_names = df["resampled_filename"].values.astype(str)
+    if isinstance(datadir, PackedAudioStore):
+        for i, (ebird_code, wav_name) in enumerate(zip(codes, wav_names)):
+            lengths[i], srs[i] = datadir.get_info(ebird_code, wav_name)
+        return lengths, srs
+
+    info_path = Path(datadir) / AUDIO_INFO_NAME
+    columns = ["ebird_code", "resampled_filename", "length", "sr"]
+    if info_path.exists():
+        info = pd.read_csv(info_path, dtype={"ebird_code": str, "resampled_filename": str})
+    else:
+        info = pd.DataFrame(columns=columns)
+    info = info.drop_duplicates(["ebird_code", "resampled_filename"], keep="last")
+    requested = pd.DataFrame({"ebird_code": codes, "resampled_filename": wav_names})
+    merged = requested.merge(info, how="left", on=["ebird_code", "resampled_filename"])
+
+    found = merged["length"].notna().values
+    lengths[found] = merged["length"].values[found].astype(np.int64)
+    srs[found] = merged["sr"].values[found].astype(np.int64)
+    missing = []
+    for i in np.flatnonzero(~found):
+        lengths[i], srs[i] = get_info(datadir, codes[i], wav_names[i])
+        missing.append([codes[i], wav_names[i], lengths[i], srs[i]])
+
+    if len(missing) > 0:
+        info = pd.concat([info, pd.DataFrame(missing, columns=columns)], ignore_index=True)
+        info = info.drop_duplicates(["ebird_code", "resampled_filename"], keep="last")
+        tmp_path = info_path.with_name(f"{AUDIO_INFO_NAME}.{os.getpid()}.tmp")
+        try:
+            info.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, info_path)
+        except OSError:
+            # read-only dataset, the lengths are read again next time
+            pass
+    return lengths, srs
+
+
+VARIANT_INDEX_COLUMNS = ["ebird_code", "resampled_filename", "variant", "offset", "length",
+                         "source_length", "gain"]
+
+
+class VariantBankWriter:
+    """
+    Writes augmented variants of recordings (e.g. each pitch shift) for
+    `VariantBank`: int16 samples appended to `values.bin`, each variant
+    scaled by its own peak so that augmentations overshooting [-1, 1] are
+    not clipped, `index.csv` with one row per variant and `meta.json` with
+    the transform and the list of variants.
+
+    `append` returns False, without writing, once the variant would take
+    the bank over `max_bytes`.
+    """
+    def __init__(self, root: Path, transform: dict, variants: list, max_bytes=None):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        with open(self.root / "meta.json", "w") as f:
+            json.dump({"transform": transform, "variants": variants}, f)
+        self.values = open(self.root / "values.bin", "wb")
+        self.rows = []
+        self.n_bytes = 0
+
+    def append(self, ebird_code: str, wav_name: str, variant, y: np.ndarray, source_length: int):
+        n_bytes = 2 * len(y)
+        if self.max_bytes is not None and self.n_bytes + n_bytes > self.max_bytes:
+            return False
+        peak = float(np.abs(y).max()) if len(y) > 0 else 0.0
+        gain = peak / 32767 if peak > 0 else 1 / 32768
+        self.values.write(np.round(y / gain).astype(np.int16).tobytes())
+        self.rows.append([ebird_code, wav_name, str(variant), self.n_bytes // 2, len(y), source_length, gain])
+        self.n_bytes += n_bytes
+        return True
+
+    def close(self):
+        if self.values.closed:
+            return
+        self.values.close()
+        index = pd.DataFrame(self.rows, columns=VARIANT_INDEX_COLUMNS)
+        index.to_csv(self.root / "index.csv.tmp", index=False)
+        os.replace(self.root / "index.csv.tmp", self.root / "index.csv")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VariantBank:
+    """
+    Read-only view of the variants written by `VariantBankWriter`.
+    `values.bin` is memory-mapped lazily in each process and a crop only
+    converts the cropped samples to float.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        with open(self.root / "meta.json") as f:
+            meta = json.load(f)
+        self.transform = meta["transform"]
+        self.variants = meta["variants"]
+        index = pd.read_csv(self.root / "index.csv", dtype={"variant": str})
+        keys = index["ebird_code"] + "/" + index["resampled_filename"] + "/" + index["variant"]
+        self.key_index = KeyIndex(keys.values)
+        self.offsets = index["offset"].values.astype(np.int64)
+        self.lengths = index["length"].values.astype(np.int64)
+        self.source_lengths = index["source_length"].values.astype(np.int64)
+        self.gains = index["gain"].values.astype(np.float32)
+        self.values = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["values"] = None
+        return state
+
+    def __len__(self):
+        return len(self.key_index)
+
+    def _get_row(self, ebird_code: str, wav_name: str, variant):
+        return self.key_index.get(f"{ebird_code}/{wav_name}/{variant}")
+
+    def contains(self, ebird_code: str, wav_name: str, variant):
+        return self._get_row(ebird_code, wav_name, variant) is not None
+
+    def crop(self, ebird_code: str, wav_name: str, variant, offset: int, length: int):
+        """
+        The part of the variant corresponding to `length` samples of the
+        recording starting at `offset` (zero padded outside of the
+        recording). Both are scaled by the ratio of the lengths of the
+        variant and of the recording, so that the crop of a time stretched
+        variant has the length the transform would give to the crop.
+        """
+        row = self._get_row(ebird_code, wav_name, variant)
+        if row is None:
+            raise KeyError(f"{ebird_code}/{wav_name}/{variant} is not in {self.root}")
+        if self.values is None:
+            self.values = np.memmap(self.root / "values.bin", dtype=np.int16, mode="r")
+        scale = self.lengths[row] / max(self.source_lengths[row], 1)
+        begin = int(round(offset * scale))
+        n_samples = int(round(length * scale))
+        y = np.zeros(n_samples, dtype=np.float32)
+        start = max(begin, 0)
+        stop = min(begin + n_samples, self.lengths[row])
+        if stop > start:
+            values = self.values[self.offsets[row] + start:self.offsets[row] + stop]
+            y[start - begin:stop - begin] = values.astype(np.float32) * self.gains[row]
+        return y
+
+
+def get_part_extent(index_path: Path):
+    """
+    Rows of values and clipwise labels covered by the complete lines of
+    the index of a `SoftLabelStore` part, and the size in bytes of these
+    lines.
+    """
+    offset = 0
+    clip_offset = 0
+    size = 0
+    with open(index_path, "rb") as f:
+        for i, line in enumerate(f):
+            if not line.endswith(b"\n"):
+                break
+            if i > 0:
+                _, start, length, clip_start = line.decode("utf-8").rstrip("\n").rsplit(",", 3)
+                offset = int(start) + int(length)
+                clip_offset = int(clip_start) + 1
+            size += len(line)
+    return offset, clip_offset, size
+
+
+class SoftLabelStoreWriter:
+    """
+    Appends (n_segments, n_classes) soft labels of recordings to a part of a
+    `SoftLabelStore`. A part consists of
+
+    * `{part}.values.f16`: all segments as contiguous float16 rows
+    * `{part}.clipwise.f16`: per recording max over segments
+    * `{part}.index.csv`: wav_name, offset, length, clip_offset
+
+    The index line is written last, so an interrupted run never exposes
+    partially written rows. With `append=True` such rows are dropped and the
+    part is resumed after its last indexed recording.
+    """
+    def __init__(self, root: Path, part: str, n_classes=264, append=False):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.part = part
+        self.n_classes = n_classes
+
+        mode = "ab" if append else "wb"
+        index_path = self.root / f"{part}.index.csv"
+        write_header = not (append and index_path.exists())
+        if not write_header:
+            offset, clip_offset, index_size = get_part_extent(index_path)
+            os.truncate(index_path, index_size)
+            for name, n_rows in [("values", offset), ("clipwise", clip_offset)]:
+                path = self.root / f"{part}.{name}.f16"
+                if path.exists():
+                    os.truncate(path, 2 * n_classes * n_rows)
+        self.values_f = open(self.root / f"{part}.values.f16", mode)
+        self.clipwise_f = open(self.root / f"{part}.clipwise.f16", mode)
+        self.index_f = open(index_path, mode.replace("b", ""))
+        if write_header:
+            self.index_f.write("wav_name,offset,length,clip_offset\n")
+
+        self.offset = self.values_f.tell() // (2 * n_classes)
+        self.clip_offset = self.clipwise_f.tell() // (2 * n_classes)
+        self.current = None
+
+    def append(self, wav_name: str, soft_label: np.ndarray):
+        self.begin(wav_name)
+        self.extend(soft_label)
+        self.end()
+
+    def begin(self, wav_name: str):
+        """
+        Start a recording whose segments are given by `extend` calls, so
+        that long recordings never have to be held in memory as a whole.
+        """
+        if self.current is not None:
+            raise RuntimeError(f"{self.current} is not ended")
+        self.current = wav_name
+        self.length = 0
+        self.clipwise = None
+
+    def extend(self, soft_label: np.ndarray):
+        soft_label = np.ascontiguousarray(soft_label, dtype=np.float16)
+        if soft_label.ndim != 2 or soft_label.shape[1] != self.n_classes:
+            raise ValueError(f"Invalid soft label shape {soft_label.shape} for {self.current}")
+        if len(soft_label) == 0:
+            return
+        self.values_f.write(soft_label.tobytes())
+        clipwise = soft_label.max(axis=0)
+        self.clipwise = clipwise if self.clipwise is None else np.maximum(self.clipwise, clipwise)
+        self.length += len(soft_label)
+
+    def end(self):
+        if self.clipwise is None:
+            raise ValueError(f"No soft label is given for {self.current}")
+        self.clipwise_f.write(self.clipwise.tobytes())
+        self.values_f.flush()
+        self.clipwise_f.flush()
+
+        self.index_f.write(f"{self.current},{self.offset},{self.length},{self.clip_offset}\n")
+        self.index_f.flush()
+        self.offset += self.length
+        self.clip_offset += 1
+        self.current = None
+        return self.clipwise
+
+    def close(self):
+        self.values_f.close()
+        self.clipwise_f.close()
+        self.index_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SoftLabelNpyWriter:
+    """
+    Writes soft labels of each recording to `{wav_name}.npy` with the same
+    `append` / `begin`, `extend`, `end` interface as `SoftLabelStoreWriter`.
+    Segments given by `extend` are spilled to a temporary raw file and
+    copied into the .npy file by blocks at `end`.
+    """
+    def __init__(self, root: Path, n_classes=264, block_size=65536):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.n_classes = n_classes
+        self.block_size = block_size
+        self.current = None
+
+    def append(self, wav_name: str, soft_label: np.ndarray):
+        np.save(self.root / (wav_name + ".npy"), np.asarray(soft_label, dtype=np.float16))
+
+    def begin(self, wav_name: str):
+        if self.current is not None:
+            raise RuntimeError(f"{self.current} is not ended")
+        self.current = wav_name
+        self.length = 0
+        self.clipwise = None
+        self.tmp_path = self.root / (wav_name + ".tmp")
+        self.tmp_f = open(self.tmp_path, "wb")
+
+    def extend(self, soft_label: np.ndarray):
+        soft_label = np.ascontiguousarray(soft_label, dtype=np.float16)
+        if len(soft_label) == 0:
+            return
+        self.tmp_f.write(soft_label.tobytes())
+        clipwise = soft_label.max(axis=0)
+        self.clipwise = clipwise if self.clipwise is None else np.maximum(self.clipwise, clipwise)
+        self.length += len(soft_label)
+
+    def end(self):
+        self.tmp_f.close()
+        if self.clipwise is None:
+            self.tmp_path.unlink()
+            raise ValueError(f"No soft label is given for {self.current}")
+        raw = np.memmap(self.tmp_path, dtype=np.float16, mode="r", shape=(self.length, self.n_classes))
+        out = np.lib.format.open_memmap(
+            self.root / (self.current + ".npy"), mode="w+", dtype=np.float16,
+            shape=(self.length, self.n_classes))
+        for start in range(0, self.length, self.block_size):
+            out[start:start + self.block_size] = raw[start:start + self.block_size]
+        out.flush()
+        del raw, out
+        self.tmp_path.unlink()
+        self.current = None
+        return self.clipwise
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncSoftLabelWriter:
+    """
+    Hands the soft labels to `n_threads` background threads which write
+    them, so that inference does not wait for the filesystem. Each thread
+    owns a writer `make_writer(thread_index)` (e.g. a `SoftLabelNpyWriter`,
+    or a `SoftLabelStoreWriter` part per thread) and a queue of at most
+    `max_queue` pending arrays. A recording goes to a single thread, so its
+    `begin`, `extend`, `end` calls are applied in order. When the queue is
+    full the caller blocks (backpressure), `flush` waits for the pending
+    writes and `close` (also called at exit) flushes and closes the writers.
+
+    `end` returns the clipwise max computed on the caller side and
+    `pop_completed` the recordings whose writes are done, e.g. to record
+    them in a manifest only once they are on disk.
+    """
+    def __init__(self, make_writer, n_threads=1, max_queue=16):
+        self.writers = [make_writer(i) for i in range(n_threads)]
+        self.queues = [queue.Queue(maxsize=max_queue) for _ in range(n_threads)]
+        self.threads = [
+            threading.Thread(target=self._work, args=(writer, queue_), daemon=True)
+            for writer, queue_ in zip(self.writers, self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        self.lock = threading.Lock()
+        self.completed = []
+        self.error = None
+        self.n_bytes = 0
+        self.write_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_queue_depth = 0
+        self.first_put = None
+        self.last_done = None
+        self.n_recordings = 0
+        self.current = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def _work(self, writer, queue_):
+        current = None
+        while True:
+            task = queue_.get()
+            if task is None:
+                queue_.task_done()
+                break
+            method, args, n_bytes = task
+            if method == "begin":
+                current = args[0]
+            t0 = time.time()
+            try:
+                if self.error is None:
+                    getattr(writer, method)(*args)
+            except Exception as e:
+                self.error = e
+            with self.lock:
+                self.write_seconds += time.time() - t0
+                self.last_done = time.time()
+                self.n_bytes += n_bytes
+                if self.error is None and method in ["append", "end"]:
+                    self.completed.append(args[0] if method == "append" else current)
+            queue_.task_done()
+
+    def _put(self, queue_, method: str, args: tuple, n_bytes=0):
+        if self.error is not None:
+            raise RuntimeError("A background soft label write failed") from self.error
+        t0 = time.time()
+        if self.first_put is None:
+            self.first_put = t0
+        queue_.put((method, args, n_bytes))
+        self.blocked_seconds += time.time() - t0
+        self.max_queue_depth = max(self.max_queue_depth, queue_.qsize())
+
+    def append(self, wav_name: str, soft_label: np.ndarray):
+        soft_label = np.asarray(soft_label, dtype=np.float16)
+        queue_ = self.queues[self.n_recordings % len(self.queues)]
+        self.n_recordings += 1
+        self._put(queue_, "append", (wav_name, soft_label), soft_label.nbytes)
+
+    def begin(self, wav_name: str):
+        if self.current is not None:
+            raise RuntimeError(f"{self.current} is not ended")
+        self.current = wav_name
+        self.clipwise = None
+        self.current_queue = self.queues[self.n_recordings % len(self.queues)]
+        self.n_recordings += 1
+        self._put(self.current_queue, "begin", (wav_name, ))
+
+    def extend(self, soft_label: np.ndarray):
+        soft_label = np.ascontiguousarray(soft_label, dtype=np.float16)
+        if len(soft_label) == 0:
+            return
+        clipwise = soft_label.max(axis=0)
+        self.clipwise = clipwise if self.clipwise is None else np.maximum(self.clipwise, clipwise)
+        self._put(self.current_queue, "extend", (soft_label, ), soft_label.nbytes)
+
+    def end(self):
+        if self.clipwise is None:
+            raise ValueError(f"No soft label is given for {self.current}")
+        self._put(self.current_queue, "end", ())
+        self.current = None
+        return self.clipwise
+
+    def pop_completed(self):
+        with self.lock:
+            completed = self.completed
+            self.completed = []
+        return completed
+
+    def flush(self):
+        for queue_ in self.queues:
+            queue_.join()
+        if self.error is not None:
+            raise RuntimeError("A background soft label write failed") from self.error
+
+    def stats(self):
+        """
+        Bytes written, write throughput (from the first queued array to the
+        last finished write), time spent writing by the background threads,
+        time the caller was blocked by full queues and queue depths.
+        """
+        elapsed = 0.0 if self.last_done is None else self.last_done - self.first_put
+        return {
+            "bytes": self.n_bytes,
+            "bytes_per_second": self.n_bytes / max(elapsed, 1e-9),
+            "write_seconds": self.write_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "queue_depth": sum(queue_.qsize() for queue_ in self.queues),
+            "max_queue_depth": self.max_queue_depth
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"wrote {stats['bytes'] / 2 ** 20:.1f} MiB at {stats['bytes_per_second'] / 2 ** 20:.1f} MiB/s, "
+                f"max queue depth {stats['max_queue_depth']}, caller blocked {stats['blocked_seconds']:.1f} s")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for queue_ in self.queues:
+            queue_.put(None)
+        for thread in self.threads:
+            thread.join()
+        for writer in self.writers:
+            writer.close()
+        atexit.unregister(self.close)
+        if self.error is not None:
+            raise RuntimeError("A background soft label write failed") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SoftLabelStore:
+    """
+    Reader of the parts written by `SoftLabelStoreWriter`. Values are
+    memory-mapped lazily, so only the segments which are sliced are read.
+    If a recording appears in several parts, the last one wins.
+    """
+    def __init__(self, root: Path, n_classes=264):
+        self.root = Path(root)
+        self.n_classes = n_classes
+        self.parts = sorted(path.name.replace(".index.csv", "")
+                            for path in self.root.glob("*.index.csv"))
+
+        wav_names = []
+        part_ids = []
+        offsets = []
+        lengths = []
+        clip_offsets = []
+        self.part_ids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.clip_offsets = np.zeros(0, dtype=np.int64)
+        for i, part in enumerate(self.parts):
+            index = pd.read_csv(self.root / f"{part}.index.csv")
+            wav_names.append(index["wav_name"].values)
+            part_ids.append(np.full(len(index), i, dtype=np.int64))
+            offsets.append(index["offset"].values.astype(np.int64))
+            lengths.append(index["length"].values.astype(np.int64))
+            clip_offsets.append(index["clip_offset"].values.astype(np.int64))
+
+        if len(self.parts) > 0:
+            wav_names = np.concatenate(wav_names)
+            self.part_ids = np.concatenate(part_ids)
+            self.offsets = np.concatenate(offsets)
+            self.lengths = np.concatenate(lengths)
+            self.clip_offsets = np.concatenate(clip_offsets)
+        self.key_index = KeyIndex(wav_names)
+        self.values = None
+        self.clipwise = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["values"] = None
+        state["clipwise"] = None
+        return state
+
+    def __contains__(self, wav_name: str):
+        return wav_name in self.key_index
+
+    def _open(self):
+        self.values = []
+        self.clipwise = []
+        for part in self.parts:
+            for name, arrays in zip(["values", "clipwise"], [self.values, self.clipwise]):
+                path = self.root / f"{part}.{name}.f16"
+                n_rows = path.stat().st_size // (2 * self.n_classes)
+                if n_rows == 0:
+                    arrays.append(np.zeros((0, self.n_classes), dtype=np.float16))
+                else:
+                    arrays.append(np.memmap(path, dtype=np.float16, mode="r",
+                                            shape=(n_rows, self.n_classes)))
+
+    def _get_row(self, wav_name: str):
+        row = self.key_index.get(wav_name)
+        if row is None:
+            raise FileNotFoundError(f"{wav_name} is not in {self.root}")
+        return row
+
+    def get_length(self, wav_name: str):
+        return int(self.lengths[self._get_row(wav_name)])
+
+    def get(self, wav_name: str, start=0, stop=None):
+        if self.values is None:
+            self._open()
+        row = self._get_row(wav_name)
+        length = self.lengths[row]
+        stop = length if stop is None else min(stop, length)
+        begin = self.offsets[row] + start
+        end = self.offsets[row] + max(stop, start)
+        return self.values[self.part_ids[row]][begin:end]
+
+    def get_clipwise(self, wav_name: str):
+        if self.clipwise is None:
+            self._open()
+        row = self._get_row(wav_name)
+        return self.clipwise[self.part_ids[row]][self.clip_offsets[row]]
+
+
+def load_soft_label(soft_label_dir: Union[Path, SoftLabelStore], wav_name: str, start=0, stop=None):
+    if isinstance(soft_label_dir, SoftLabelStore):
+        return soft_label_dir.get(wav_name, start, stop)
+    return np.load(soft_label_dir / (wav_name + ".npy"), mmap_mode="r")[start:stop]
+
+
+EVENT_COLUMNS = {
+    "filename": np.int32,
+    "ebird_code": np.int16,
+    "onset": np.float32,
+    "offset": np.float32
+}
+CATEGORICAL_EVENT_COLUMNS = ["filename", "ebird_code"]
+
+
+class EventStoreWriter:
+    """
+    Append-only partition (`part`, e.g. one per fold / shard) of an event
+    store. Each column is a raw binary file `{part}.{column}.bin`, the
+    categorical columns (filename, ebird_code) are stored as integer codes
+    into `{part}.{column}.txt`, one category per line. Categories are
+    flushed before the codes referencing them and readers only use the
+    rows present in every column, so an interrupted writer never exposes
+    partial rows. Parts are independent, so concurrent folds / shards can
+    write to the same store. Unless `append=True`, an existing part is
+    replaced.
+    """
+    def __init__(self, root: Path, part: str, append=False):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.part = part
+
+        if not append:
+            for path in self.root.glob(f"{part}.*"):
+                path.unlink()
+        n_rows = get_event_part_length(self.root, part)
+        self.columns = {}
+        for column, dtype in EVENT_COLUMNS.items():
+            path = self.root / f"{part}.{column}.bin"
+            if path.exists():
+                os.truncate(path, n_rows * np.dtype(dtype).itemsize)
+            self.columns[column] = open(path, "ab")
+
+        self.categories = {}
+        self.category_files = {}
+        for column in CATEGORICAL_EVENT_COLUMNS:
+            path = self.root / f"{part}.{column}.txt"
+            text = path.read_text() if path.exists() else ""
+            if not text.endswith("\n"):
+                # drop a partially written category
+                text = text[:text.rfind("\n") + 1]
+                path.write_text(text)
+            categories = text.splitlines()
+            self.categories[column] = {category: i for i, category in enumerate(categories)}
+            self.category_files[column] = open(path, "a")
+
+    def append(self, events: pd.DataFrame):
+        """
+        Append a DataFrame of events (filename, ebird_code, onset, offset).
+        """
+        if len(events) == 0:
+            return
+        codes = {}
+        for column in CATEGORICAL_EVENT_COLUMNS:
+            values = events[column].values.astype(str)
+            unique, inverse = np.unique(values, return_inverse=True)
+            categories = self.categories[column]
+            for value in unique:
+                if value not in categories:
+                    categories[value] = len(categories)
+                    self.category_files[column].write(value + "\n")
+            self.category_files[column].flush()
+            codes[column] = np.array([categories[value] for value in unique], dtype=np.int64)[inverse]
+
+        for column, dtype in EVENT_COLUMNS.items():
+            values = codes[column] if column in codes else events[column].values
+            self.columns[column].write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            self.columns[column].flush()
+
+    def close(self):
+        for f in list(self.columns.values()) + list(self.category_files.values()):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_event_part_length(root: Path, part: str):
+    """
+    Number of rows present in every column of a part of an event store.
+    """
+    lengths = []
+    for column, dtype in EVENT_COLUMNS.items():
+        path = Path(root) / f"{part}.{column}.bin"
+        lengths.append(path.stat().st_size // np.dtype(dtype).itemsize if path.exists() else 0)
+    return min(lengths)
+
+
+def read_events(root: Path, parts=None):
+    """
+    Events of all the parts (or of `parts`) of an event store as a DataFrame
+    with categorical filename / ebird_code columns, which makes grouping by
+    recording or species cheap.
+    """
+    root = Path(root)
+    if parts is None:
+        parts = sorted(path.name[:-len(".onset.bin")] for path in root.glob("*.onset.bin"))
+
+    columns = {column: [] for column in EVENT_COLUMNS}
+    categories = {column: [] for column in CATEGORICAL_EVENT_COLUMNS}
+    for part in parts:
+        n_rows = get_event_part_length(root, part)
+        for column, dtype in EVENT_COLUMNS.items():
+            columns[column].append(np.fromfile(root / f"{part}.{column}.bin", dtype=dtype, count=n_rows))
+        for column in CATEGORICAL_EVENT_COLUMNS:
+            path = root / f"{part}.{column}.txt"
+            categories[column].append(np.array(path.read_text().splitlines() if path.exists() else [], dtype=str))
+
+    data = {}
+    for column, dtype in EVENT_COLUMNS.items():
+        if column in categories:
+            # codes of each part are remapped to the union of the categories
+            union = np.unique(np.concatenate(categories[column] + [np.zeros(0, dtype=str)]))
+            codes = [np.searchsorted(union, part_categories)[part_codes] if len(part_codes) > 0
+                     else np.zeros(0, dtype=np.int64)
+                     for part_codes, part_categories in zip(columns[column], categories[column])]
+            codes = np.concatenate(codes + [np.zeros(0, dtype=np.int64)])
+            data[column] = pd.Categorical.from_codes(codes, categories=union)
+        else:
+            data[column] = np.concatenate(columns[column] + [np.zeros(0, dtype=dtype)])
+    return pd.DataFrame(data)
+
+
+def get_event_matrix(events: pd.DataFrame, species: list):
+    """
+    (n_files, n_species) 0/1 DataFrame indexed by filename, 1 where the
+    recording has at least one event of the species.
+    """
+    filenames = pd.Categorical(events["filename"])
+    codes = pd.Categorical(events["ebird_code"], categories=species)
+    matrix = np.zeros((len(filenames.categories), len(species)), dtype=np.float32)
+    keep = codes.codes >= 0
+    matrix[filenames.codes[keep], codes.codes[keep]] = 1.0
+    return pd.DataFrame(matrix, index=filenames.categories.values, columns=species)
+
+
+def get_hash(*values):
+    dumped = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.md5(dumped.encode("utf-8")).hexdigest()
+
+
+class PredictionCache:
+    """
+    On-disk cache of raw model outputs of recordings (e.g. framewise_output,
+    segmentwise_output), stored as compressed float16 `{key}.npz` files.
+    Keys combine the hashes of the audio file, of the checkpoint and of the
+    configuration which affects the outputs (see `get_prediction_key`), so a
+    rerun which only changes post-processing reads the outputs back instead
+    of running the model.
+
+    Content hashes of files are memoized in `file_hashes.csv` by (path,
+    size, mtime), so a file is only read again when it changes. With
+    `max_bytes`, the least recently used entries are evicted once the cache
+    grows larger (the mtime of an entry is refreshed when it is read).
+    """
+    def __init__(self, root: Path, max_bytes=None):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+
+        self.hashes_path = self.root / "file_hashes.csv"
+        self.file_hashes = {}
+        if self.hashes_path.exists():
+            with open(self.hashes_path) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    path, size, mtime, digest = line.rstrip("\n").rsplit(",", 3)
+                    self.file_hashes[(path, int(size), int(mtime))] = digest
+
+        self.entries = {}
+        for path in self.root.glob("*.npz"):
+            stat = path.stat()
+            self.entries[path.stem] = (stat.st_size, stat.st_mtime)
+        self.n_bytes = sum(size for size, _ in self.entries.values())
+
+    def hash_file(self, path: Path):
+        path = Path(path)
+        stat = path.stat()
+        memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+        digest = self.file_hashes.get(memo_key)
+        if digest is None:
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    md5.update(block)
+            digest = md5.hexdigest()
+            self.file_hashes[memo_key] = digest
+            with open(self.hashes_path, "a") as f:
+                f.write(f"{memo_key[0]},{memo_key[1]},{memo_key[2]},{digest}\n")
+        return digest
+
+    def hash_audio(self, datadir: Union[Path, PackedAudioStore], ebird_code: str, wav_name: str):
+        if isinstance(datadir, PackedAudioStore):
+            # the samples of a packed recording are identified by its slice
+            # of a shard, without reading them
+            row = datadir._get_row(ebird_code, wav_name)
+            shard = datadir.root / get_shard_name(int(datadir.shard_ids[row]))
+            stat = shard.stat()
+            return get_hash(str(shard.resolve()), stat.st_size, stat.st_mtime_ns,
+                            int(datadir.offsets[row]), int(datadir.lengths[row]), int(datadir.srs[row]))
+        return self.hash_file(Path(datadir) / ebird_code / wav_name)
+
+    def __contains__(self, key: str):
+        return key in self.entries
+
+    def touch(self, key: str):
+        path = self.root / f"{key}.npz"
+        os.utime(path)
+        self.entries[key] = (self.entries[key][0], path.stat().st_mtime)
+
+    def drop(self, key: str):
+        """
+        Forget an entry whose file was evicted by another process.
+        """
+        size, _ = self.entries.pop(key)
+        self.n_bytes -= size
+
+    def get(self, key: str):
+        """
+        Cached outputs as float32 arrays, None if `key` is not cached.
+        """
+        if key not in self.entries:
+            return None
+        try:
+            with np.load(self.root / f"{key}.npz") as f:
+                outputs = {name: f[name].astype(np.float32) for name in f.files}
+            self.touch(key)
+        except FileNotFoundError:
+            # evicted by another process
+            self.drop(key)
+            return None
+        return outputs
+
+    def put(self, key: str, outputs: dict):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **{name: np.asarray(value, dtype=np.float16) for name, value in outputs.items()})
+        path = self.root / f"{key}.npz"
+        tmp_path = self.root / f"{key}.{os.getpid()}.tmp"
+        tmp_path.write_bytes(buffer.getvalue())
+        tmp_path.replace(path)
+
+        if key in self.entries:
+            self.n_bytes -= self.entries[key][0]
+        stat = path.stat()
+        self.entries[key] = (stat.st_size, stat.st_mtime)
+        self.n_bytes += stat.st_size
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None or self.n_bytes <= self.max_bytes:
+            return
+        for key in sorted(self.entries, key=lambda key: self.entries[key][1]):
+            if self.n_bytes <= self.max_bytes:
+                break
+            size, _ = self.entries.pop(key)
+            self.n_bytes -= size
+            path = self.root / f"{key}.npz"
+            if path.exists():
+                path.unlink()
+
+
+def get_prediction_key(audio_hash: str, checkpoint_hash: str, config_hash: str):
+    return get_hash(audio_hash, checkpoint_hash, config_hash)
@@ -1,9 +1,17 @@
+import os
+
 import albumentations as A
 import colorednoise as cn
 import librosa
 import numpy as np
+import scipy.signal
+import torch
+import torch.nn as nn
 
 from albumentations.core.transforms_interface import ImageOnlyTransform
+from fractions import Fraction
+
+from src.storage import VariantBank
 
 
 def get_transforms(config: dict, phase: str):
@@ -19,6 +27,12 @@ def get_transforms(config: dict, phase: str):
             trns_params = {} if trns_conf.get("params") is None else \
                 trns_conf["params"]
             if globals().get(trns_name) is not None:
+                if trns_name == "StoredVariants" and len(trns_list) > 0:
+                    # the variants are read from the raw recordings, the
+                    # output of the transforms before it would be discarded
+                    raise ValueError(
+                        f"StoredVariants must be the first of transforms.{phase}, "
+                        f"it comes after {[type(trns).__name__ for trns in trns_list]}")
                 trns_cls = globals()[trns_name]
                 trns_list.append(trns_cls(**trns_params))
 
@@ -32,6 +46,59 @@ def get_waveform_transforms(config: dict, phase: str):
     return get_transforms(config, phase)
 
 
+# constant gains: `normalize_melspec` of the log-melspectrogram channels
+# removes them (PCEN, with gain < 1, only almost)
+SCALE_ONLY_TRANSFORMS = ["Normalize", "RandomVolume"]
+
+
+def get_feature_changing_transforms(transforms):
+    """
+    Names of the waveform transforms of a `Compose` / `OneOf` which change
+    the normalized image, i.e. all but `SCALE_ONLY_TRANSFORMS`.
+    """
+    if transforms is None:
+        return []
+    if isinstance(transforms, (Compose, OneOf)):
+        names = []
+        for trns in transforms.transforms:
+            names += get_feature_changing_transforms(trns)
+        return names
+    name = type(transforms).__name__
+    return [] if name in SCALE_ONLY_TRANSFORMS else [name]
+
+
+def get_batch_transforms(config: dict, phase: str, key="batch_transforms"):
+    """
+    Batched waveform transforms (`batch_transforms` section of the config,
+    same names and params as in `transforms`) applied to whole
+    (batch_size, n_samples) tensors in the training loop.
+    """
+    transforms = config.get(key)
+    if transforms is None or transforms.get(phase) is None:
+        return None
+    trns_list = []
+    for trns_conf in transforms[phase]:
+        trns_params = {} if trns_conf.get("params") is None else \
+            trns_conf["params"]
+        trns_cls = globals().get("Batch" + trns_conf["name"])
+        if trns_cls is not None:
+            trns_list.append(trns_cls(**trns_params))
+
+    if len(trns_list) > 0:
+        return BatchCompose(trns_list)
+    else:
+        return None
+
+
+def get_batch_spectrogram_transforms(config: dict, phase: str):
+    """
+    Batched image transforms (`batch_spectrogram_transforms` section of the
+    config, e.g. TimeFreqMasking) applied to whole
+    (batch_size, n_channels, n_freqs, n_frames) tensors after collation.
+    """
+    return get_batch_transforms(config, phase, "batch_spectrogram_transforms")
+
+
 def get_spectrogram_transforms(config: dict, phase: str):
     transforms = config.get('spectrogram_transforms')
     if transforms is None:
@@ -59,14 +126,14 @@ def get_spectrogram_transforms(config: dict, phase: str):
 
 
 class Normalize:
-    def __call__(self, y: np.ndarray):
+    def __call__(self, y: np.ndarray, **params):
         max_vol = np.abs(y).max()
         y_vol = y * 1 / max_vol
         return np.asfortranarray(y_vol)
 
 
 class NewNormalize:
-    def __call__(self, y: np.ndarray):
+    def __call__(self, y: np.ndarray, **params):
         y_mm = y - y.mean()
         return y_mm / y_mm.abs().max()
 
@@ -75,9 +142,11 @@ class Compose:
     def __init__(self, transforms: list):
         self.transforms = transforms
 
-    def __call__(self, y: np.ndarray):
+    def __call__(self, y: np.ndarray, **params):
+        # params (ebird_code, wav_name, offset) identify the crop for
+        # transforms which need it, e.g. `StoredVariants`
         for trns in self.transforms:
-            y = trns(y)
+            y = trns(y, **params)
         return y
 
 
@@ -86,46 +155,102 @@ class AudioTransform:
         self.always_apply = always_apply
         self.p = p
 
-    def __call__(self, y: np.ndarray):
+    def __call__(self, y: np.ndarray, **params):
         if self.always_apply:
-            return self.apply(y)
+            return self.apply(y, **params)
         else:
             if np.random.rand() < self.p:
-                return self.apply(y)
+                return self.apply(y, **params)
             else:
                 return y
 
-    def apply(self, y: np.ndarray):
+    def apply(self, y: np.ndarray, **params):
         raise NotImplementedError
 
 
+NOISE_BANK_LENGTH = 2 ** 22
+
+_noise_banks = {}
+
+
+def get_noise_bank(kind: str, min_length=0):
+    """
+    Long float32 buffer of unit variance "white" or "pink" noise, generated
+    once per process from its numpy random state, so that each DataLoader
+    worker has its own (a bank inherited through fork is regenerated).
+    """
+    key = (os.getpid(), kind)
+    bank = _noise_banks.get(key)
+    if bank is None or len(bank) < min_length:
+        length = max(NOISE_BANK_LENGTH, 4 * min_length)
+        if kind == "white":
+            bank = np.random.randn(length).astype(np.float32)
+        elif kind == "pink":
+            bank = cn.powerlaw_psd_gaussian(1, length).astype(np.float32)
+        else:
+            raise NotImplementedError(f"noise bank {kind} is not supported")
+        for other in [k for k in _noise_banks if k[0] != key[0]]:
+            del _noise_banks[other]
+        _noise_banks[key] = bank
+    return bank
+
+
+def get_noise_window(kind: str, length: int):
+    """
+    Zero-copy window of `length` samples at a random offset of the noise
+    bank, reversed half of the time. Together with the random sign of
+    `add_noise` this decorrelates overlapping windows of a bank.
+    """
+    bank = get_noise_bank(kind, length)
+    offset = np.random.randint(len(bank) - length + 1)
+    window = bank[offset:offset + length]
+    if np.random.rand() < 0.5:
+        window = window[::-1]
+    return window
+
+
+def add_noise(y: np.ndarray, window: np.ndarray, scale: float):
+    # the window is scaled into the output buffer, the bank is left untouched
+    augmented = np.empty_like(y)
+    np.multiply(window, scale if np.random.rand() < 0.5 else -scale, out=augmented)
+    augmented += y
+    return augmented
+
+
 class NoiseInjection(AudioTransform):
-    def __init__(self, always_apply=False, p=0.5, max_noise_level=0.5, sr=32000):
+    def __init__(self, always_apply=False, p=0.5, max_noise_level=0.5, sr=32000, noise_bank=True):
         super().__init__(always_apply, p)
 
         self.noise_level = (0.0, max_noise_level)
         self.sr = sr
+        self.noise_bank = noise_bank
 
     def apply(self, y: np.ndarray, **params):
         noise_level = np.random.uniform(*self.noise_level)
+        if self.noise_bank:
+            return add_noise(y, get_noise_window("white", len(y)), noise_level)
         noise = np.random.randn(len(y))
         augmented = (y + noise * noise_level).astype(y.dtype)
         return augmented
 
 
 class GaussianNoise(AudioTransform):
-    def __init__(self, always_apply=False, p=0.5, min_snr=5, max_snr=20, sr=32000):
+    def __init__(self, always_apply=False, p=0.5, min_snr=5, max_snr=20, sr=32000, noise_bank=True):
         super().__init__(always_apply, p)
 
         self.min_snr = min_snr
         self.max_snr = max_snr
         self.sr = sr
+        self.noise_bank = noise_bank
 
     def apply(self, y: np.ndarray, **params):
         snr = np.random.uniform(self.min_snr, self.max_snr)
-        a_signal = np.sqrt(y ** 2).max()
+        a_signal = np.abs(y).max()
         a_noise = a_signal / (10 ** (snr / 20))
 
+        if self.noise_bank:
+            white_noise = get_noise_window("white", len(y))
+            return add_noise(y, white_noise, a_noise / np.abs(white_noise).max())
         white_noise = np.random.randn(len(y))
         a_white = np.sqrt(white_noise ** 2).max()
         augmented = (y + white_noise * 1 / a_white * a_noise).astype(y.dtype)
@@ -133,34 +258,91 @@ class GaussianNoise(AudioTransform):
 
 
 class PinkNoise(AudioTransform):
-    def __init__(self, always_apply=False, p=0.5, min_snr=5, max_snr=20, sr=32000):
+    """
+    With `noise_bank`, the noise is a window of a long pink noise buffer
+    instead of being generated for the length of each clip, which removes
+    the FFT from every call. The window is scaled by its own peak as before.
+    """
+    def __init__(self, always_apply=False, p=0.5, min_snr=5, max_snr=20, sr=32000, noise_bank=True):
         super().__init__(always_apply, p)
 
         self.min_snr = min_snr
         self.max_snr = max_snr
         self.sr = sr
+        self.noise_bank = noise_bank
 
     def apply(self, y: np.ndarray, **params):
         snr = np.random.uniform(self.min_snr, self.max_snr)
-        a_signal = np.sqrt(y ** 2).max()
+        a_signal = np.abs(y).max()
         a_noise = a_signal / (10 ** (snr / 20))
 
+        if self.noise_bank:
+            pink_noise = get_noise_window("pink", len(y))
+            return add_noise(y, pink_noise, a_noise / np.abs(pink_noise).max())
         pink_noise = cn.powerlaw_psd_gaussian(1, len(y))
         a_pink = np.sqrt(pink_noise ** 2).max()
         augmented = (y + pink_noise * 1 / a_pink * a_noise).astype(y.dtype)
         return augmented
 
 
+def resample_pitch_shift(y: np.ndarray, n_steps: int, max_denominator=32):
+    """
+    Shift the pitch of `y` by `n_steps` semitones by playing it
+    2 ** (n_steps / 12) times faster with a polyphase resampler (the
+    ratio is approximated by a fraction of denominator at most
+    `max_denominator`), then crop it back to its length. Upward shifts
+    need more source samples than `y` has, it is reflect padded to
+    ceil(len(y) * ratio) samples so that the output is never zero padded.
+    Unlike the phase vocoder the tempo changes along with the pitch.
+    """
+    if n_steps == 0:
+        return y
+    ratio = Fraction(2 ** (n_steps / 12)).limit_denominator(max_denominator)
+    length = len(y)
+    n_source = -(-length * ratio.numerator // ratio.denominator)
+    if n_source > length:
+        y = np.pad(y, (0, n_source - length), mode="reflect")
+    shifted = scipy.signal.resample_poly(y, ratio.denominator, ratio.numerator)
+    return shifted[:length].astype(y.dtype)
+
+
 class PitchShift(AudioTransform):
-    def __init__(self, always_apply=False, p=0.5, max_range=5, sr=32000):
+    """
+    mode: "phase_vocoder" (librosa.effects.pitch_shift, keeps the tempo) or
+    "resample" (`resample_pitch_shift`, an order of magnitude faster)
+    """
+    # the shift which leaves the recording as it is
+    identity_variant = 0
+
+    def __init__(self, always_apply=False, p=0.5, max_range=5, sr=32000, mode="phase_vocoder"):
         super().__init__(always_apply, p)
         self.max_range = max_range
         self.sr = sr
+        if mode not in ["phase_vocoder", "resample"]:
+            raise ValueError(f"PitchShift mode {mode} is not supported")
+        self.mode = mode
+
+    def get_variants(self, n_variants=None):
+        """
+        The shifts `apply` draws from, or `n_variants` of them evenly spaced,
+        but 0 which would only store a copy of the recording.
+        """
+        variants = [n_steps for n_steps in range(-self.max_range, self.max_range) if n_steps != 0]
+        if n_variants is not None and n_variants < len(variants):
+            variants = [variants[i] for i in np.linspace(0, len(variants) - 1, n_variants).round().astype(int)]
+        return variants
+
+    def apply_variant(self, y: np.ndarray, n_steps: int):
+        if n_steps == 0:
+            return y
+        if self.mode == "resample":
+            return resample_pitch_shift(y, n_steps)
+        augmented = librosa.effects.pitch_shift(y, sr=self.sr, n_steps=n_steps)
+        return augmented
 
     def apply(self, y: np.ndarray, **params):
         n_steps = np.random.randint(-self.max_range, self.max_range)
-        augmented = librosa.effects.pitch_shift(y, self.sr, n_steps)
-        return augmented
+        return self.apply_variant(y, n_steps)
 
 
 class TimeStretch(AudioTransform):
@@ -169,12 +351,57 @@ class TimeStretch(AudioTransform):
         self.max_rate = max_rate
         self.sr = sr
 
+    def get_variants(self, n_variants=8):
+        """
+        Midpoints of `n_variants` equal bins of the rates `apply` draws from.
+        """
+        return [self.max_rate * (i + 0.5) / n_variants for i in range(n_variants)]
+
+    def apply_variant(self, y: np.ndarray, rate: float):
+        augmented = librosa.effects.time_stretch(y, rate=rate)
+        return augmented
+
     def apply(self, y: np.ndarray, **params):
         rate = np.random.uniform(0, self.max_rate)
         augmented = librosa.effects.time_stretch(y, rate)
         return augmented
 
 
+class StoredVariants(AudioTransform):
+    """
+    Serve a deterministic transform (PitchShift, TimeStretch) from the
+    variants of each recording precomputed by `augmentation_bank.py`
+    instead of computing it. The variant is drawn uniformly among the
+    values of the bank and the crop is read at the position given by the
+    dataset (ebird_code, wav_name and offset, the index in the recording of
+    the first sample of `y`, negative when `y` is zero padded). Variants
+    left out by the size budget of the bank, and calls without these
+    params, fall back to computing the drawn variant online. The identity
+    variant of the transform (no shift for PitchShift) is drawn too but
+    never stored, it returns `y` as it is.
+
+    The variants are computed from the raw recordings and `y` is replaced,
+    so this must be the first of the waveform transforms (`get_transforms`
+    raises otherwise).
+    """
+    def __init__(self, always_apply=False, p=0.5, bank_dir=None):
+        super().__init__(always_apply, p)
+        self.bank = VariantBank(bank_dir)
+        transform = self.bank.transform
+        params = {} if transform.get("params") is None else transform["params"]
+        self.transform = globals()[transform["name"]](**params)
+        self.variants = list(self.bank.variants)
+        identity = getattr(self.transform, "identity_variant", None)
+        if identity is not None and identity not in self.variants:
+            self.variants.append(identity)
+
+    def apply(self, y: np.ndarray, ebird_code=None, wav_name=None, offset=0, **params):
+        variant = self.variants[np.random.randint(len(self.variants))]
+        if wav_name is None or not self.bank.contains(ebird_code, wav_name, variant):
+            return self.transform.apply_variant(y, variant)
+        return self.bank.crop(ebird_code, wav_name, variant, offset, len(y)).astype(y.dtype)
+
+
 def _db2float(db: float, amplitude=True):
     if amplitude:
         return 10**(db / 20)
@@ -235,11 +462,11 @@ class OneOf:
     def __init__(self, transforms: list):
         self.transforms = transforms
 
-    def __call__(self, y: np.ndarray):
+    def __call__(self, y: np.ndarray, **params):
         n_trns = len(self.transforms)
         trns_idx = np.random.choice(n_trns)
         trns = self.transforms[trns_idx]
-        y = trns(y)
+        y = trns(y, **params)
         return y
 
 
@@ -255,6 +482,79 @@ class CosineVolume(AudioTransform):
         return y * dbs
 
 
+class BatchCompose(nn.Module):
+    def __init__(self, transforms: list):
+        super().__init__()
+        self.transforms = nn.ModuleList(transforms)
+
+    def forward(self, x: torch.Tensor):
+        for trns in self.transforms:
+            x = trns(x)
+        return x
+
+
+class BatchAudioTransform(nn.Module):
+    """
+    Batched counterpart of `AudioTransform` for (batch_size, n_samples)
+    tensors. The random parameters are drawn as vectors, one per sample,
+    and the samples which are not selected (probability 1 - p) get the
+    parameter of the identity.
+    """
+    def __init__(self, always_apply=False, p=0.5):
+        super().__init__()
+        self.always_apply = always_apply
+        self.p = p
+
+    def get_mask(self, x: torch.Tensor):
+        if self.always_apply:
+            return torch.ones(len(x), dtype=x.dtype, device=x.device)
+        return (torch.rand(len(x), device=x.device) < self.p).to(x.dtype)
+
+    def uniform(self, x: torch.Tensor, low: float, high: float):
+        return torch.empty(len(x), dtype=x.dtype, device=x.device).uniform_(low, high)
+
+
+class BatchNoiseInjection(BatchAudioTransform):
+    def __init__(self, always_apply=False, p=0.5, max_noise_level=0.5, sr=32000):
+        super().__init__(always_apply, p)
+        self.max_noise_level = max_noise_level
+        self.sr = sr
+
+    def forward(self, x: torch.Tensor):
+        noise_level = self.uniform(x, 0.0, self.max_noise_level) * self.get_mask(x)
+        return x + torch.randn_like(x) * noise_level[:, None]
+
+
+class BatchRandomVolume(BatchAudioTransform):
+    def __init__(self, always_apply=False, p=0.5, limit=10):
+        super().__init__(always_apply, p)
+        self.limit = limit
+
+    def forward(self, x: torch.Tensor):
+        # `RandomVolume` passes the negative db to `volume_down`, so both of
+        # its branches raise the volume by |db|
+        db = self.uniform(x, -self.limit, self.limit).abs() * self.get_mask(x)
+        return x * (10 ** (db / 20))[:, None]
+
+
+class BatchCosineVolume(BatchAudioTransform):
+    def __init__(self, always_apply=False, p=0.5, limit=10):
+        super().__init__(always_apply, p)
+        self.limit = limit
+
+    def forward(self, x: torch.Tensor):
+        db = self.uniform(x, -self.limit, self.limit) * self.get_mask(x)
+        n_samples = x.size(1)
+        cosine = torch.cos(torch.arange(n_samples, dtype=x.dtype, device=x.device) / n_samples * np.pi * 2)
+        return x * 10 ** (cosine[None, :] * db[:, None] / 20)
+
+
+class BatchNormalize(nn.Module):
+    def forward(self, x: torch.Tensor):
+        max_vol = x.abs().max(dim=1, keepdim=True)[0]
+        return x / max_vol
+
+
 def drop_stripes(image: np.ndarray, dim: int, drop_width: int, stripes_num: int):
     total_width = image.shape[dim]
     lowest_value = image.min()
@@ -265,9 +565,9 @@ def drop_stripes(image: np.ndarray, dim: int, drop_width: int, stripes_num: int)
         if dim == 0:
             image[begin:begin + distance] = lowest_value
         elif dim == 1:
-            image[:, begin + distance] = lowest_value
+            image[:, begin:begin + distance] = lowest_value
         elif dim == 2:
-            image[:, :, begin + distance] = lowest_value
+            image[:, :, begin:begin + distance] = lowest_value
     return image
 
 
@@ -291,3 +591,70 @@ class TimeFreqMasking(ImageOnlyTransform):
             img_ = drop_stripes(img_, dim=0, drop_width=self.freq_drop_width, stripes_num=self.freq_stripes_num)
             img_ = drop_stripes(img_, dim=1, drop_width=self.time_drop_width, stripes_num=self.time_stripes_num)
         return img_
+
+
+def get_stripes_mask(shape: tuple, n_bins: int, drop_width: int, stripes_num: int, device=None):
+    """
+    Draw `stripes_num` stripes of width in [0, drop_width) for each of
+    `shape` images, like `drop_stripes`, and return the (*shape, n_bins)
+    bool mask of the bins inside one of them.
+    """
+    widths = torch.randint(0, drop_width, (*shape, stripes_num, 1), device=device)
+    begins = (torch.rand((*shape, stripes_num, 1), device=device) * (n_bins - widths).float()).long()
+    bins = torch.arange(n_bins, device=device)
+    return ((bins >= begins) & (bins < begins + widths)).any(dim=-2)
+
+
+class BatchTimeFreqMasking(nn.Module):
+    """
+    Batched `TimeFreqMasking` for (batch_size, n_channels, n_freqs, n_frames)
+    images, which can run after collation. The stripes of the whole batch
+    are drawn at once and turned into frequency and time masks by comparing
+    their bounds with the bin indices, then the masked rows and columns are
+    set to the min of each channel image with a single indexed assignment
+    each.
+
+    Like the albumentations transform applied to each channel image, each
+    channel gets its own stripes and its own draw of `p`, unless
+    `per_channel` is False. Widths are in bins of the input, i.e. in
+    pixels of the resized image after collation. With `inplace`, the
+    collated batch is masked without a copy.
+    """
+    def __init__(self,
+                 time_drop_width: int,
+                 time_stripes_num: int,
+                 freq_drop_width: int,
+                 freq_stripes_num: int,
+                 always_apply=False,
+                 p=0.5,
+                 per_channel=True,
+                 inplace=False):
+        super().__init__()
+        self.time_drop_width = time_drop_width
+        self.time_stripes_num = time_stripes_num
+        self.freq_drop_width = freq_drop_width
+        self.freq_stripes_num = freq_stripes_num
+        self.always_apply = always_apply
+        self.p = p
+        self.per_channel = per_channel
+        self.inplace = inplace
+
+    def forward(self, x: torch.Tensor):
+        batch_size, n_channels, n_freqs, n_frames = x.shape
+        shape = (batch_size, n_channels if self.per_channel else 1)
+        freq_mask = get_stripes_mask(shape, n_freqs, self.freq_drop_width, self.freq_stripes_num, x.device)
+        time_mask = get_stripes_mask(shape, n_frames, self.time_drop_width, self.time_stripes_num, x.device)
+        if not self.always_apply:
+            selected = (torch.rand(shape, device=x.device) < self.p)[..., None]
+            freq_mask = freq_mask & selected
+            time_mask = time_mask & selected
+        freq_mask = freq_mask.expand(batch_size, n_channels, n_freqs)
+        time_mask = time_mask.expand(batch_size, n_channels, n_frames)
+
+        lowest_value = x.reshape(batch_size, n_channels, -1).min(dim=2)[0]
+        augmented = x if self.inplace else x.clone()
+        batch_idx, channel_idx, freq_idx = freq_mask.nonzero(as_tuple=True)
+        augmented[batch_idx, channel_idx, freq_idx] = lowest_value[batch_idx, channel_idx, None]
+        batch_idx, channel_idx, time_idx = time_mask.nonzero(as_tuple=True)
+        augmented.transpose(2, 3)[batch_idx, channel_idx, time_idx] = lowest_value[batch_idx, channel_idx, None]
+        return augmented
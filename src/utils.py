@@ -1,5 +1,6 @@
 import argparse
 import codecs
+import gc
 import json
 import logging
 import os
@@ -43,6 +44,19 @@ def set_seed(seed: int = 42):
     torch.backends.cudnn.benchmark = False  # type: ignore
 
 
+def freeze_gc():
+    """
+    Collect the garbage, then move everything allocated so far (metadata
+    DataFrames, labels) out of the reach of the garbage collector, which
+    would otherwise write to every object header in each forked DataLoader
+    worker and copy the pages. Call it once per entry point, before the
+    first loader is iterated, so that garbage of later folds stays
+    collectable.
+    """
+    gc.collect()
+    gc.freeze()
+
+
 @contextmanager
 def timer(name: str, logger: Optional[logging.Logger] = None):
     t0 = time.time()
@@ -89,6 +103,10 @@ def get_parser() -> argparse.ArgumentParser:
 def get_sed_parser() -> argparse.ArgumentParser:
     parser = get_parser()
     parser.add_argument("--threshold", default=0.7, type=float)
+    parser.add_argument("--min_duration", default=0.0, type=float,
+                        help="drop events shorter than this (seconds)")
+    parser.add_argument("--merge_gap", default=0.0, type=float,
+                        help="merge events of the same class separated by at most this (seconds)")
     return parser
 
 
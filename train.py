@@ -9,6 +9,21 @@ from pathlib import Path
 
 from catalyst.dl import SupervisedRunner
 
+from src.transforms import get_batch_spectrogram_transforms, get_batch_transforms
+
+
+def get_batch_transform_callback(config: dict, get_transforms, input_key: str, device):
+    batch_transforms = {
+        phase: get_transforms(config, phase) for phase in ["train", "valid"]
+    }
+    if all(transforms is None for transforms in batch_transforms.values()):
+        return None
+    batch_transforms = {
+        phase: transforms.to(device) if transforms is not None else None
+        for phase, transforms in batch_transforms.items()
+    }
+    return clb.BatchTransformCallback(batch_transforms, input_key)
+
 
 if __name__ == "__main__":
     warnings.filterwarnings("ignore")
@@ -33,6 +48,7 @@ if __name__ == "__main__":
     else:
         event_level_labels = None
 
+    utils.freeze_gc()
     for i, (trn_idx, val_idx) in enumerate(
             splitter.split(df, y=df["ebird_code"])):
         if i not in global_params["folds"]:
@@ -53,6 +69,24 @@ if __name__ == "__main__":
         optimizer = C.get_optimizer(model, config)
         scheduler = C.get_scheduler(optimizer, config)
         callbacks = clb.get_callbacks(config)
+        # waveform transforms, feature extraction, then image transforms.
+        # datasets with `batch_feature_extraction` return raw waveforms and
+        # the images are computed for the whole batch before the forward pass
+        feature_extractor = C.get_feature_extractor(config)
+        if feature_extractor is not None:
+            waveform_key = "waveform"
+        else:
+            waveform_key = global_params["input_key"]
+        callback = get_batch_transform_callback(config, get_batch_transforms, waveform_key, device)
+        if callback is not None:
+            callbacks.append(callback)
+        if feature_extractor is not None:
+            callbacks.append(clb.FeatureExtractorCallback(
+                feature_extractor.to(device), global_params["input_key"], waveform_key))
+        callback = get_batch_transform_callback(
+            config, get_batch_spectrogram_transforms, global_params["input_key"], device)
+        if callback is not None:
+            callbacks.append(callback)
 
         runner = SupervisedRunner(
             device=device,